@@ -8,13 +8,48 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 TEST_LOGGER_LEVEL = 'OFF'
 LOGGER_LEVEL = 'DEBUG'
 LOG_FILES_FOLDER = 'logs'
-THREAD_LOGGER_FORMAT = '{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {thread.name} | ' \
-                       '{name}:{function}:{line} - {message}{exception}'
+# session_id is bound by telegram parsers, they all run as tasks in one event loop
+SESSION_LOGGER_FORMAT = '{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | session {extra[session_id]} | ' \
+                        '{name}:{function}:{line} - {message}{exception}'
 PROCESS_LOGGER_FORMAT = '{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {process.name} | ' \
                         '{name}:{function}:{line} - {message}{exception}'
 
 SESSIONS_FILE_PATH = 'sessions'
+TG_SCAN_CONCURRENCY = 4  # chats scanned at once by one telegram session
+TG_UPLOAD_QUEUE_SIZE = 16  # results of scanned chats waiting for upload, scans wait when the queue is full
 
 API_IDS = os.getenv('API_IDS')
 API_HASHES = os.getenv('API_HASHES')
 SESSION_COUNT = len(API_IDS)
+
+MENTIONS_CACHE_SIZE = 1024
+MENTIONS_CACHE_TTL = 600  # seconds
+DATA_VERSION_CHECK_INTERVAL = 10  # seconds
+
+BULK_LOAD = os.getenv('BULK_LOAD', 'false').lower() == 'true'  # tgstat backfills load posts with COPY
+BULK_LOAD_BATCH_SIZE = 10000  # posts per COPY batch in bulk load mode
+
+FSM_STORAGE_URI = os.getenv('FSM_STORAGE_URI')  # e.g. sqlite+aiosqlite:///fsm.db for local runs, bot db if not set
+FSM_STATE_TTL = 7 * 24 * 60 * 60  # seconds
+FSM_CLEANUP_INTERVAL = 60 * 60  # seconds
+
+REQUEST_LOG_FLUSH_INTERVAL = 5  # seconds between writes of queued user requests
+REQUEST_LOG_BATCH_SIZE = 500  # queued user requests that trigger write
+REQUEST_LOG_MAX_BACKLOG = 50000  # queued user requests kept while db is unavailable, the oldest are dropped
+
+BROADCAST_RATE = 25  # messages per second, telegram allows about 30
+BROADCAST_CONCURRENCY = 25  # messages sent at once
+BROADCAST_PROGRESS_BATCH_SIZE = 100  # deliveries saved to db at once
+
+METRICS_LOG_INTERVAL = 300  # seconds between summary log lines of handler latency
+METRICS_PATH = '/metrics'  # prometheus endpoint of webhook app
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')  # public https url of the bot, e.g. https://bot.example.com
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # X-Telegram-Bot-Api-Secret-Token of webhook requests
+WEBHOOK_MAX_CONNECTIONS = 40  # concurrent connections telegram opens to webhook
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 8080))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1))  # processes serving webhook on the same port
+WEBHOOK_MAX_CONCURRENT_UPDATES = 64  # updates processed at once by one worker
+GRACEFUL_SHUTDOWN_TIMEOUT = 30  # seconds to finish updates in progress on shutdown
@@ -1,37 +1,218 @@
 import asyncio
 import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Awaitable, AsyncContextManager, AsyncIterator
 from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter, BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation
 from loguru import logger
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_BATCH_SIZE
 from src.bot.keyboards import main_menu_keyboard
-from src.dao.db_config import get_db
-from src.dao.mentions_db import MentionsDatabase
-from src.dao.users_db import UserDatabase, User
+from src.dao.db_config import get_async_db, async_engine
+from src.dao.users_db import AsyncUserDatabase, BroadcastDelivery, Base as UsersBase
 
 TOKEN = os.getenv("BOT_TOKEN")
 
+# errors after which message will never be delivered to user, other errors (network, timeouts) are transient
+PERMANENT_DELIVERY_ERRORS = (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation)
 
-async def spam(user_ids: list[int]) -> None:
+
+@asynccontextmanager
+async def open_user_database() -> AsyncIterator[AsyncUserDatabase]:
     """
-    sends message to all users with ids from user_ids
-    :param user_ids: list of ids to send to
+    AsyncUserDatabase on its own session, session is closed on exit
     """
-    bot = Bot(token=TOKEN)
-    for user_id in user_ids:
+    async with get_async_db() as session:
+        yield AsyncUserDatabase(session)
+
+
+class TokenBucket:
+    """
+    Rate limiter, tokens are refilled with rate per second up to capacity, every message takes one token
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        :param rate: tokens per second
+        :param capacity: max count of tokens, burst size
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        waits for a token, waiters get tokens in order of arrival
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + max(0., now - self.updated_at) * self.rate)
+                self.updated_at = max(self.updated_at, now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate + max(0., self.updated_at - now))
+
+    def pause(self, seconds: float) -> None:
+        """
+        takes all tokens for seconds, e.g. when telegram asks to retry after flood control
+        """
+        self.tokens = 0
+        self.updated_at = max(self.updated_at, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """
+    Sends message to many users concurrently within telegram limits. Messages are sent by concurrency workers that
+    share one token bucket with rate below telegram global limit (30 messages per second), every user gets one
+    message, so per-chat limit (1 message per second) is not reached. On RetryAfter all workers wait for
+    the requested time and the user is put back into the queue. Progress is saved into table users.broadcast_delivery
+    by batches, users that broadcast was already sent to are skipped, so interrupted broadcast resumes where it stopped.
+    Only permanent failures (PERMANENT_DELIVERY_ERRORS) are saved, users with transient errors are retried on resume
+    """
+
+    def __init__(self, broadcast: str, send: Callable[[int], Awaitable],
+                 database_factory: Callable[[], AsyncContextManager[AsyncUserDatabase]] = open_user_database,
+                 rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 progress_batch_size: int = BROADCAST_PROGRESS_BATCH_SIZE):
+        """
+        :param broadcast: name of broadcast, progress is kept per name
+        :param send: sends message to user with id
+        :param database_factory: opens connection with db of users
+        :param rate: messages per second
+        :param concurrency: count of messages that are sent at once
+        :param progress_batch_size: count of deliveries that are saved at once
+        """
+        self.broadcast = broadcast
+        self.send = send
+        self.database_factory = database_factory
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.concurrency = concurrency
+        self.progress_batch_size = progress_batch_size
+        self.deliveries: list[dict] = []
+        self.sent_count = 0
+        self.failed_count = 0
+        self.transient_failed_count = 0  # not saved, so they are sent again on resume
+        self.rescheduled_count = 0
+
+    async def run(self, user_ids: list[str]) -> None:
+        """
+        sends message to users from user_ids that didn't get it yet, returns when all of them are processed
+        :param user_ids: user_id of users to send to
+        """
+        async with self.database_factory() as database:
+            processed_user_ids = await database.get_broadcast_user_ids(self.broadcast)
+        queue = asyncio.Queue()
+        for user_id in user_ids:
+            if user_id not in processed_user_ids:
+                queue.put_nowait(user_id)
+        # <editor-fold desc="log">
+        logger.info(f'BROADCAST {self.broadcast}: {queue.qsize()} USERS TO SEND, '
+                    f'{len(processed_user_ids)} ALREADY PROCESSED')
+        # </editor-fold>
+        workers = [asyncio.create_task(self.work(queue)) for _ in range(self.concurrency)]
         try:
-            await bot.send_message(user_id, text='Главное меню', reply_markup=main_menu_keyboard,
-                                   parse_mode='html', disable_web_page_preview=True)
-        except Exception as e:
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.save_progress()
+        logger.info(f'BROADCAST {self.broadcast} IS DONE: SENT {self.sent_count}, FAILED {self.failed_count}, '
+                    f'FAILED TRANSIENTLY {self.transient_failed_count}, RESCHEDULED {self.rescheduled_count}')
+
+    async def work(self, queue: asyncio.Queue) -> None:
+        while True:
+            user_id = await queue.get()
+            try:
+                await self.deliver(queue, user_id)
+            finally:
+                queue.task_done()
+
+    async def deliver(self, queue: asyncio.Queue, user_id: str) -> None:
+        await self.bucket.acquire()
+        try:
+            await self.send(int(user_id))
+        except RetryAfter as e:
+            logger.warning(f'FLOOD CONTROL ON {user_id}, RETRY IN {e.timeout} SECONDS')
+            self.bucket.pause(e.timeout)
+            self.rescheduled_count += 1
+            # put before task_done of current attempt, so queue is not considered finished
+            queue.put_nowait(user_id)
+            return
+        except PERMANENT_DELIVERY_ERRORS as e:
             logger.error(f'ERROR: {e} ON {user_id}')
-            logger.exception('')
+            self.failed_count += 1
+            self.add_delivery(user_id, False, str(e))
+        except Exception as e:
+            logger.error(f'TRANSIENT ERROR: {e} ON {user_id}, IT IS RETRIED ON RESUME')
+            self.transient_failed_count += 1
+            return
+        else:
+            self.sent_count += 1
+            self.add_delivery(user_id, True, None)
+        if len(self.deliveries) >= self.progress_batch_size:
+            await self.save_progress()
 
+    def add_delivery(self, user_id: str, delivered: bool, error: str | None) -> None:
+        self.deliveries.append({'broadcast': self.broadcast, 'user_id': user_id, 'delivered': delivered,
+                                'error': error, 'created_at': datetime.now()})
 
-if __name__ == "__main__":
-    logger.info('starting')
+    async def save_progress(self) -> None:
+        deliveries, self.deliveries = self.deliveries, []
+        if len(deliveries) == 0:
+            return
+        try:
+            async with self.database_factory() as database:
+                await database.add_broadcast_deliveries(deliveries)
+        except Exception as e:
+            logger.error(f'ERROR OCCURRED WHILE SAVING PROGRESS OF BROADCAST {self.broadcast} {e}')
+            self.deliveries[:0] = deliveries
+
+
+async def spam(broadcast: str, user_ids: list[str]) -> None:
+    """
+    sends main menu to all users with ids from user_ids
+    :param broadcast: name of broadcast, broadcast with the same name is resumed
+    :param user_ids: list of ids to send to
+    """
+    bot = Bot(token=TOKEN)
+
+    async def send_main_menu(user_id: int) -> None:
+        await bot.send_message(user_id, text='Главное меню', reply_markup=main_menu_keyboard,
+                               parse_mode='html', disable_web_page_preview=True)
 
-    db = MentionsDatabase(session=next(get_db()))
-    user_db = UserDatabase(next(get_db()))
-    user_ids_ = [int(user_id[0]) for user_id in user_db.session.query(User.user_id)]
+    try:
+        await Broadcaster(broadcast, send_main_menu).run(user_ids)
+    finally:
+        await (await bot.get_session()).close()
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(spam(user_ids_))
+
+async def launch_broadcast(broadcast: str, active_days: int | None) -> None:
+    """
+    :param broadcast: name of broadcast
+    :param active_days: send only to users that interacted with the bot in this count of last days, None for all
+    """
+    async with async_engine.begin() as connection:
+        await connection.run_sync(UsersBase.metadata.create_all, tables=[BroadcastDelivery.__table__])
+    active_since = None if active_days is None else datetime.now() - timedelta(days=active_days)
+    async with open_user_database() as database:
+        user_ids = await database.get_user_ids(active_since)
+    await spam(broadcast, user_ids)
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    # python -m src.bot.broadcast_message <broadcast name> [--active-days N]
+    logger.info('starting')
+    if os.name == 'nt':
+        # psycopg async connections don't work with default proactor event loop on Windows
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    args = sys.argv[1:]
+    active_days_ = int(args[args.index('--active-days') + 1]) if '--active-days' in args else None
+    asyncio.run(launch_broadcast(args[0] if len(args) != 0 else 'main_menu', active_days_))
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import typing
+from datetime import datetime, timedelta
+from aiogram.dispatcher.storage import BaseStorage
+from loguru import logger
+from sqlalchemy import select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, AsyncSession
+from config import FSM_STATE_TTL, FSM_CLEANUP_INTERVAL
+from src.dao.users_db import FsmState, Base as UsersBase
+
+
+def dump_json(value: dict | None) -> str:
+    return json.dumps(value or {}, separators=(',', ':'), ensure_ascii=False)
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    aiogram fsm storage in table users.fsm_state, states are shared by bot workers and survive restarts.
+    Works with postgres (db of the bot) and sqlite for local runs. States that were not updated for ttl seconds
+    are treated as empty and are deleted by cleanup task
+    """
+
+    def __init__(self, engine: AsyncEngine, ttl: float = FSM_STATE_TTL, cleanup_interval: float = FSM_CLEANUP_INTERVAL):
+        """
+        :param engine: async engine of postgres or sqlite db
+        :param ttl: seconds after last update when state expires
+        :param cleanup_interval: seconds between deletions of expired states
+        """
+        if engine.dialect.name == 'sqlite':
+            # sqlite has no schemas
+            engine = engine.execution_options(schema_translate_map={UsersBase.metadata.schema: None})
+            self.insert = sqlite.insert
+        else:
+            self.insert = postgresql.insert
+        self.engine = engine
+        self.session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        self.ttl = timedelta(seconds=ttl)
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_task: asyncio.Task | None = None
+
+    async def create_table(self) -> None:
+        async with self.engine.begin() as connection:
+            await connection.run_sync(UsersBase.metadata.create_all, tables=[FsmState.__table__])
+
+    def start_cleanup(self) -> None:
+        """
+        starts periodic deletion of expired states in running event loop
+        """
+        self.cleanup_task = asyncio.create_task(self.run_cleanup())
+
+    async def run_cleanup(self) -> None:
+        while True:
+            try:
+                deleted_count = await self.cleanup()
+                # <editor-fold desc="log">
+                logger.debug(f'DELETED {deleted_count} EXPIRED FSM STATES')
+                # </editor-fold>
+            except Exception as e:
+                logger.error(f'ERROR OCCURRED WHILE DELETING EXPIRED FSM STATES {e}')
+            await asyncio.sleep(self.cleanup_interval)
+
+    async def cleanup(self) -> int:
+        """
+        :return: count of deleted expired states
+        """
+        async with self.session_factory() as session:
+            result = await session.execute(delete(FsmState).where(FsmState.updated_at <= self.get_expiration_time()))
+            await session.commit()
+            return result.rowcount
+
+    async def close(self):
+        if self.cleanup_task is not None:
+            self.cleanup_task.cancel()
+
+    async def wait_closed(self):
+        if self.cleanup_task is not None:
+            await asyncio.gather(self.cleanup_task, return_exceptions=True)
+
+    def get_expiration_time(self) -> datetime:
+        return datetime.now() - self.ttl
+
+    def resolve_address(self, chat, user) -> tuple[str, str]:
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def get_record(self, session: AsyncSession, chat: str, user: str) -> FsmState | None:
+        """
+        :return: not expired state of user in chat, None if there is no state
+        """
+        return await session.scalar(select(FsmState).where(FsmState.chat == chat, FsmState.user == user,
+                                                           FsmState.updated_at > self.get_expiration_time()))
+
+    async def lock_record(self, session: AsyncSession, chat: str, user: str) -> FsmState | None:
+        """
+        locks state of user in chat till commit, missing state is inserted empty first, so there is always a row
+        to lock and concurrent read-modify-write updates of other workers wait for this one
+        :return: not expired state of user in chat, None if there is no state
+        """
+        await session.execute(self.insert(FsmState).values(chat=chat, user=user, updated_at=datetime.now())
+                              .on_conflict_do_nothing(index_elements=['chat', 'user']))
+        record = await session.scalar(select(FsmState).where(FsmState.chat == chat, FsmState.user == user)
+                                      .with_for_update())
+        return None if record.updated_at <= self.get_expiration_time() else record
+
+    async def save(self, session: AsyncSession, chat: str, user: str, **values) -> None:
+        """
+        upserts values of state, expired state is replaced and empty state is deleted. commit is made by caller
+        :param values: values of FsmState columns (state, data, bucket)
+        """
+        key = (FsmState.chat == chat, FsmState.user == user)
+        await session.execute(delete(FsmState).where(*key, FsmState.updated_at <= self.get_expiration_time()))
+        values['updated_at'] = datetime.now()
+        stmt = self.insert(FsmState).values(chat=chat, user=user, **values)
+        await session.execute(stmt.on_conflict_do_update(index_elements=['chat', 'user'], set_=values))
+        await session.execute(delete(FsmState).where(*key, FsmState.state.is_(None), FsmState.data == '{}',
+                                                     FsmState.bucket == '{}'))
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            record = await self.get_record(session, chat, user)
+        return self.resolve_state(default) if record is None else record.state
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[typing.Dict] = None) -> typing.Dict:
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            record = await self.get_record(session, chat, user)
+        return dict(default or {}) if record is None else json.loads(record.data)
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            await self.save(session, chat, user, state=self.resolve_state(state))
+            await session.commit()
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            await self.save(session, chat, user, data=dump_json(data))
+            await session.commit()
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            # row is locked till commit, so concurrent updates of other workers are not lost
+            record = await self.lock_record(session, chat, user)
+            merged_data = {} if record is None else json.loads(record.data)
+            merged_data.update(data or {}, **kwargs)
+            await self.save(session, chat, user, data=dump_json(merged_data))
+            await session.commit()
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        chat, user = self.resolve_address(chat, user)
+        values = {'state': None, 'data': '{}'} if with_data else {'state': None}
+        async with self.session_factory() as session:
+            await self.save(session, chat, user, **values)
+            await session.commit()
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            record = await self.get_record(session, chat, user)
+        return dict(default or {}) if record is None else json.loads(record.bucket)
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            await self.save(session, chat, user, bucket=dump_json(bucket))
+            await session.commit()
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None,
+                            **kwargs):
+        chat, user = self.resolve_address(chat, user)
+        async with self.session_factory() as session:
+            record = await self.lock_record(session, chat, user)
+            merged_bucket = {} if record is None else json.loads(record.bucket)
+            merged_bucket.update(bucket or {}, **kwargs)
+            await self.save(session, chat, user, bucket=dump_json(merged_bucket))
+            await session.commit()
@@ -22,11 +22,16 @@ back_button = types.InlineKeyboardButton(text='Назад', callback_data='back_
 back_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[back_button]])
 
 
-def get_pagination_keyboard(current_page: int, pages_count: int) -> InlineKeyboardMarkup:
-    if pages_count > 1:
+def get_pagination_keyboard(current_page: int, pages_count: int | None) -> InlineKeyboardMarkup:
+    """
+    :param current_page: number of current page
+    :param pages_count: count of pages, None if it is not known yet
+    """
+    if pages_count is None or pages_count > 1:
 
         previous_page_button = InlineKeyboardButton(text='←', callback_data='go_to_prev_page')
-        current_page_button = InlineKeyboardButton(text=f'{current_page}/{pages_count}', callback_data='none')
+        pages_text = f'{current_page}/{pages_count}' if pages_count is not None else f'{current_page}/…'
+        current_page_button = InlineKeyboardButton(text=pages_text, callback_data='none')
         next_page_button = InlineKeyboardButton(text='→', callback_data='go_to_next_page')
 
         return InlineKeyboardMarkup(inline_keyboard=[
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import signal
+import sys
+from multiprocessing import Process
+from aiogram.utils import executor
+from aiohttp import web
+from loguru import logger
+from config import WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS, WEBAPP_HOST, WEBAPP_PORT, \
+    WEBHOOK_WORKERS, GRACEFUL_SHUTDOWN_TIMEOUT
+from src.bot.message_handler import dp, bot, on_startup, on_shutdown, handler_metrics
+from src.bot.webhook import WebhookUpdateHandler, create_webhook_app
+
+
+def serve_webhook(reuse_port: bool) -> None:
+    """
+    serves webhook in current process until SIGINT/SIGTERM, updates in progress are processed before exit
+    :param reuse_port: several processes listen on the same port, kernel balances connections between them
+    """
+    app = create_webhook_app(WebhookUpdateHandler(dp), on_startup=on_startup, on_shutdown=on_shutdown,
+                             metrics=handler_metrics)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, reuse_port=reuse_port,
+                shutdown_timeout=GRACEFUL_SHUTDOWN_TIMEOUT, print=None)
+
+
+async def set_webhook() -> None:
+    await bot.set_webhook(WEBHOOK_HOST.rstrip('/') + WEBHOOK_PATH, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                          secret_token=WEBHOOK_SECRET)
+    # session of this event loop can't be used by workers
+    await (await bot.get_session()).close()
+
+
+def launch_webhook(workers: int = WEBHOOK_WORKERS) -> None:
+    """
+    sets webhook of the bot and serves it in workers processes, waits until all workers exit
+    :param workers: count of worker processes
+    """
+    if workers > 1 and os.name == 'nt':
+        # SO_REUSEPORT is not available on Windows
+        logger.warning('ONLY ONE WEBHOOK WORKER IS SUPPORTED ON WINDOWS')
+        workers = 1
+    asyncio.run(set_webhook())
+    # <editor-fold desc="log">
+    logger.info(f'WEBHOOK IS SET, STARTING {workers} WORKERS ON {WEBAPP_HOST}:{WEBAPP_PORT}')
+    # </editor-fold>
+    if workers == 1:
+        serve_webhook(reuse_port=False)
+        return
+
+    processes = [Process(target=serve_webhook, args=[True]) for _ in range(workers)]
+    for p in processes:
+        p.start()
+
+    def stop_workers(*_) -> None:
+        for process in processes:
+            process.terminate()  # SIGTERM, worker shuts down gracefully
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    # on Ctrl+C SIGINT is sent to the whole process group, workers shut down by themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for p in processes:
+        p.join()
+    logger.info('ALL WEBHOOK WORKERS ARE DONE')
+
+
+def launch_polling() -> None:
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    logger.info('starting')
+    if os.name == 'nt':
+        # psycopg async connections don't work with default proactor event loop on Windows
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    if '--webhook' in sys.argv[1:]:
+        launch_webhook()
+    else:
+        launch_polling()
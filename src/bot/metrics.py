@@ -0,0 +1,226 @@
+import asyncio
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from config import METRICS_LOG_INTERVAL
+
+PHASES = ('db', 'render', 'send', 'other')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """
+    Prometheus-like histogram with fixed upper bounds of buckets
+    """
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_quantile_bound(self, quantile: float) -> float:
+        """
+        :return: upper bound of bucket that contains quantile, inf if it is in the last bucket
+        """
+        rank = quantile * self.count
+        cumulative_count = 0
+        for bound, bucket_count in zip(self.bounds, self.bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= rank:
+                return bound
+        return float('inf')
+
+
+class HandlerTimings:
+    """
+    Time spent by one handler call in phases, time of nested phases is not counted in outer phase
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases: dict[str, float] = defaultdict(float)
+        self.accounted = 0.
+        self.queries = 0
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] += seconds
+        self.accounted += seconds
+
+
+# timings of handler call in progress, every update is processed in its own task, so calls don't mix
+current_timings: ContextVar[HandlerTimings | None] = ContextVar('current_timings', default=None)
+
+
+@contextmanager
+def measure(phase: str) -> Iterator[None]:
+    """
+    adds time of block to phase of current handler call, does nothing outside handlers
+    :param phase: one of PHASES
+    """
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    accounted = timings.accounted
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - started_at - (timings.accounted - accounted))
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    counts queries of engine and their time as db phase of current handler call
+    """
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started_at = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add('db', time.perf_counter() - context.metrics_started_at)
+            timings.queries += 1
+
+
+class TimedBot(Bot):
+    """
+    Bot that counts time of telegram api requests as send phase of current handler call
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        with measure('send'):
+            return await super().request(method, data, files, **kwargs)
+
+
+class HandlerMetrics:
+    """
+    Latency histograms of handlers split into phases and counts of db queries per handler
+    """
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.queries: dict[str, int] = defaultdict(int)
+        self.log_task: asyncio.Task | None = None
+
+    def observe(self, handler: str, timings: HandlerTimings) -> None:
+        total = time.perf_counter() - timings.started_at
+        self.histograms[(handler, 'total')].observe(total)
+        for phase in PHASES[:-1]:
+            self.histograms[(handler, phase)].observe(timings.phases[phase])
+        self.histograms[(handler, 'other')].observe(max(0., total - timings.accounted))
+        self.queries[handler] += timings.queries
+
+    def render_prometheus(self) -> str:
+        """
+        :return: metrics in prometheus text format
+        """
+        lines = ['# TYPE bot_handler_seconds histogram']
+        for (handler, phase), histogram in sorted(self.histograms.items()):
+            labels = f'handler="{handler}",phase="{phase}"'
+            cumulative_count = 0
+            for bound, bucket_count in zip(histogram.bounds, histogram.bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(f'bot_handler_seconds_bucket{{{labels},le="{bound}"}} {cumulative_count}')
+            lines.append(f'bot_handler_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'bot_handler_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'bot_handler_seconds_count{{{labels}}} {histogram.count}')
+        lines.append('# TYPE bot_handler_queries_total counter')
+        for handler, queries in sorted(self.queries.items()):
+            lines.append(f'bot_handler_queries_total{{handler="{handler}"}} {queries}')
+        return '\n'.join(lines) + '\n'
+
+    def get_summary(self) -> list[str]:
+        """
+        :return: one line per handler with count of calls, p95 of total time, mean time of phases, queries per call
+        """
+        summary = []
+        for handler in sorted({handler for handler, _ in self.histograms}):
+            total = self.histograms[(handler, 'total')]
+            phases = ', '.join(f'{phase} {self.histograms[(handler, phase)].sum / total.count:.3f}s'
+                               for phase in PHASES)
+            summary.append(f'{handler}: {total.count} calls, mean {total.sum / total.count:.3f}s, '
+                           f'p95 <= {total.get_quantile_bound(0.95)}s ({phases}), '
+                           f'{self.queries[handler] / total.count:.1f} queries')
+        return summary
+
+    def log_summary(self) -> None:
+        for line in self.get_summary():
+            logger.info(f'HANDLER LATENCY {line}')
+
+    def start_logging(self, interval: float = METRICS_LOG_INTERVAL) -> None:
+        """
+        starts periodic summary log lines in running event loop
+        """
+        async def run_logging():
+            while True:
+                await asyncio.sleep(interval)
+                self.log_summary()
+
+        self.log_task = asyncio.create_task(run_logging())
+
+    async def close(self) -> None:
+        if self.log_task is not None:
+            self.log_task.cancel()
+            await asyncio.gather(self.log_task, return_exceptions=True)
+        self.log_summary()
+
+
+class LatencyMiddleware(BaseMiddleware):
+    """
+    aiogram middleware that measures handlers of messages and callback queries, time of filters (fsm state lookups)
+    is included
+    """
+
+    def __init__(self, metrics: HandlerMetrics):
+        super().__init__()
+        self.metrics = metrics
+
+    async def start(self, data: dict) -> None:
+        data['latency_timings'] = HandlerTimings()
+        data['latency_token'] = current_timings.set(data['latency_timings'])
+
+    async def set_handler(self, data: dict) -> None:
+        data['latency_handler'] = current_handler.get().__name__
+
+    async def finish(self, data: dict) -> None:
+        current_timings.reset(data.pop('latency_token'))
+        timings = data.pop('latency_timings')
+        handler = data.pop('latency_handler', None)
+        if handler is not None:
+            self.metrics.observe(handler, timings)
+
+    async def on_pre_process_message(self, message, data: dict) -> None:
+        await self.start(data)
+
+    async def on_process_message(self, message, data: dict) -> None:
+        await self.set_handler(data)
+
+    async def on_post_process_message(self, message, results, data: dict) -> None:
+        await self.finish(data)
+
+    async def on_pre_process_callback_query(self, call, data: dict) -> None:
+        await self.start(data)
+
+    async def on_process_callback_query(self, call, data: dict) -> None:
+        await self.set_handler(data)
+
+    async def on_post_process_callback_query(self, call, results, data: dict) -> None:
+        await self.finish(data)
@@ -0,0 +1,257 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable
+from src.bot.rendering import MESSAGE_LIMIT, split_fragment, render_sku_header, render_sku_chat_header, \
+    render_sku_post, render_brand_header, render_brand_chat_header, render_brand_post
+from src.dao.mentions_db import AsyncMentionsDatabase, Chat, Post, SkuPerPost, get_post_key
+
+POSTS_PER_QUERY = 50
+# count of page cursors kept in fsm state around the current page
+PAGE_CURSORS_LIMIT = 10
+
+# cursor of page: [chat_id, date, post_id] of last post of previous page (None values if page starts from
+# the first post) and count of pieces of next post that were already sent, when post doesn't fit into one page.
+# cursor of the first page is None. cursor consists of plain values, so it can be kept in fsm state
+PageCursor = list | None
+
+
+@dataclass(frozen=True)
+class Page:
+    text: str
+    next_cursor: PageCursor  # None for last page
+
+
+class PageCursors:
+    """
+    Cursors of visited pages kept in fsm state. Only PAGE_CURSORS_LIMIT cursors nearest to the current page and
+    the cursor of the last page are kept, so state doesn't grow with count of visited pages. Cursor of the first
+    page is None and isn't stored
+    """
+
+    def __init__(self, cursors: list[list] | None = None):
+        """
+        :param cursors: [page_number, cursor] pairs as dumped to state
+        """
+        self.cursors: dict[int, PageCursor] = {page_number: cursor for page_number, cursor in cursors or []}
+
+    def add(self, page_number: int, cursor: PageCursor) -> None:
+        if page_number != 1:
+            self.cursors[page_number] = cursor
+
+    def get_nearest(self, page_number: int) -> tuple[int, PageCursor]:
+        """
+        :return: number and cursor of the nearest known page not after page_number
+        """
+        known_page_number = max((number for number in self.cursors if number <= page_number), default=1)
+        return known_page_number, self.cursors.get(known_page_number)
+
+    def trim(self, current_page: int, pages_count: int | None) -> None:
+        """
+        leaves PAGE_CURSORS_LIMIT cursors nearest to current page and cursor of the last page
+        :param current_page: number of shown page
+        :param pages_count: count of pages, None if the last page is not reached yet
+        """
+        nearest = sorted(self.cursors, key=lambda number: abs(number - current_page))[:PAGE_CURSORS_LIMIT]
+        self.cursors = {number: cursor for number, cursor in self.cursors.items()
+                        if number in nearest or number == pages_count}
+
+    def dump(self) -> list[list]:
+        return [[page_number, cursor] for page_number, cursor in sorted(self.cursors.items())]
+
+
+async def get_page_by_number(page_cursors: PageCursors, page_number: int,
+                             render_page: Callable[[PageCursor], Awaitable[Page]]) -> tuple[int, Page]:
+    """
+    renders page by its number, if cursor of the page was dropped from state, pages are rendered from the nearest
+    known one to find it. cursor of the next page is added to page_cursors
+    :param page_cursors: cursors from state
+    :param page_number: number of page to render
+    :param render_page: renders page from cursor
+    :return: number of rendered page and page, number is less than page_number if mentions were deleted meanwhile
+    """
+    known_page_number, cursor = page_cursors.get_nearest(page_number)
+    page = await render_page(cursor)
+    while known_page_number < page_number and page.next_cursor is not None:
+        known_page_number += 1
+        page_cursors.add(known_page_number, page.next_cursor)
+        page = await render_page(page.next_cursor)
+    if page.next_cursor is not None:
+        page_cursors.add(known_page_number + 1, page.next_cursor)
+    return known_page_number, page
+
+
+class MentionsQuery(ABC):
+    """
+    Request of user for mentions, renders reply page by page from keyset paginated queries
+    """
+
+    def __init__(self, request: str):
+        """
+        :param request: sku or brand as entered by user
+        """
+        self.request = request
+
+    @abstractmethod
+    async def get_totals(self, database: AsyncMentionsDatabase) -> tuple[int, int] | None:
+        """
+        :return: count of mentions and count of chats, None if there are no mentions
+        """
+        pass
+
+    @abstractmethod
+    async def get_mentions_page(self, database: AsyncMentionsDatabase, after: tuple | None) -> \
+            dict[Chat, dict[Post, set[SkuPerPost]]]:
+        pass
+
+    @abstractmethod
+    async def get_chat_mentions_counts(self, database: AsyncMentionsDatabase, chat_ids: set[int]) -> dict[int, int]:
+        pass
+
+    @abstractmethod
+    def get_not_found_text(self) -> str:
+        pass
+
+    @abstractmethod
+    def render_header(self, mentions_count: int, chats_count: int) -> str:
+        pass
+
+    @abstractmethod
+    def render_chat_header(self, chat: Chat, mentions_count: int) -> str:
+        pass
+
+    @abstractmethod
+    def render_post(self, chat: Chat, post: Post, post_mentions: set[SkuPerPost], is_last_in_chat: bool) -> str:
+        pass
+
+    async def render_page(self, database: AsyncMentionsDatabase, cursor: PageCursor) -> Page:
+        """
+        renders one page of reply starting from cursor, posts are requested by POSTS_PER_QUERY
+        :param database: connection with db
+        :param cursor: cursor of page, None for the first page
+        :return: page with cursor of the next page
+        """
+        parts: list[str] = []
+        length = 0
+        if cursor is None:
+            totals = await self.get_totals(database)
+            if totals is None:
+                return Page(self.get_not_found_text(), None)
+            header = self.render_header(*totals)
+            parts.append(header)
+            length += len(header)
+            previous_key, skip = None, 0
+        else:
+            chat_id, date, post_id, skip = cursor
+            previous_key = None if chat_id is None else (chat_id, datetime.fromisoformat(date), post_id)
+
+        async for chat, post, post_mentions, is_last_in_chat, chat_mentions_count in \
+                self.iter_posts(database, previous_key):
+            fragment = self.render_post(chat, post, post_mentions, is_last_in_chat)
+            if previous_key is None or previous_key[0] != chat.id:
+                fragment = self.render_chat_header(chat, chat_mentions_count) + fragment
+            pieces = list(split_fragment(fragment, MESSAGE_LIMIT)) if len(fragment) > MESSAGE_LIMIT else [fragment]
+            for i in range(skip, len(pieces)):
+                if length + len(pieces[i]) > MESSAGE_LIMIT and len(parts) != 0:
+                    return Page(''.join(parts), self.get_cursor(previous_key, i))
+                parts.append(pieces[i])
+                length += len(pieces[i])
+            skip = 0
+            previous_key = get_post_key(post)
+        return Page(''.join(parts), None)
+
+    async def iter_posts(self, database: AsyncMentionsDatabase, after: tuple | None) -> \
+            AsyncIterator[tuple[Chat, Post, set[SkuPerPost], bool, int]]:
+        """
+        iterates over posts after post key, next post is requested before current one is yielded to know
+        if current post is the last one in chat
+        :param database: connection with db
+        :param after: post key of last post of previous page, None to start from the first post
+        :return: chat, post, mentions of post, is post last in chat, count of mentions in chat
+        """
+        pending = None
+        chat_mentions_counts = dict()
+        while True:
+            mentions = await self.get_mentions_page(database, after)
+            if len(mentions) != 0:
+                chat_ids = {chat.id for chat in mentions}
+                chat_mentions_counts.update(await self.get_chat_mentions_counts(database, chat_ids))
+            posts_count = 0
+            for chat, posts in mentions.items():
+                for post, post_mentions in posts.items():
+                    if pending is not None:
+                        yield *pending, pending[0].id != chat.id, chat_mentions_counts.get(pending[0].id, 0)
+                    pending = (chat, post, post_mentions)
+                    posts_count += 1
+            if posts_count < POSTS_PER_QUERY:
+                break
+            after = get_post_key(pending[1])
+        if pending is not None:
+            yield *pending, True, chat_mentions_counts.get(pending[0].id, 0)
+
+    def get_cache_key(self, cursor: PageCursor) -> tuple:
+        return self.__class__.__name__, self.request, None if cursor is None else tuple(cursor)
+
+    @staticmethod
+    def get_cursor(previous_key: tuple | None, skip: int) -> PageCursor:
+        if previous_key is None:
+            return [None, None, None, skip]
+        chat_id, date, post_id = previous_key
+        return [chat_id, date.isoformat(), post_id, skip]
+
+
+class SkuMentionsQuery(MentionsQuery):
+
+    async def get_totals(self, database: AsyncMentionsDatabase) -> tuple[int, int] | None:
+        sku_summary = await database.get_sku_summary(int(self.request))
+        return None if sku_summary is None else (sku_summary.mentions_count, sku_summary.chats_count)
+
+    async def get_mentions_page(self, database: AsyncMentionsDatabase, after: tuple | None) -> \
+            dict[Chat, dict[Post, set[SkuPerPost]]]:
+        return await database.get_mentions_page_by_sku(int(self.request), after, POSTS_PER_QUERY)
+
+    async def get_chat_mentions_counts(self, database: AsyncMentionsDatabase, chat_ids: set[int]) -> dict[int, int]:
+        return await database.get_sku_chat_mentions_counts(int(self.request), chat_ids)
+
+    def get_not_found_text(self) -> str:
+        return f'Артикул <i>{self.request}</i> не упоминался ни в одном канале.'
+
+    def render_header(self, mentions_count: int, chats_count: int) -> str:
+        return render_sku_header(self.request, mentions_count, chats_count)
+
+    def render_chat_header(self, chat: Chat, mentions_count: int) -> str:
+        return render_sku_chat_header(chat, mentions_count)
+
+    def render_post(self, chat: Chat, post: Post, post_mentions: set[SkuPerPost], is_last_in_chat: bool) -> str:
+        return render_sku_post(chat, post, is_last_in_chat)
+
+
+class BrandMentionsQuery(MentionsQuery):
+
+    async def get_totals(self, database: AsyncMentionsDatabase) -> tuple[int, int] | None:
+        return await database.get_brand_totals(self.request.lower())
+
+    async def get_mentions_page(self, database: AsyncMentionsDatabase, after: tuple | None) -> \
+            dict[Chat, dict[Post, set[SkuPerPost]]]:
+        return await database.get_mentions_page_by_brand(self.request.lower(), after, POSTS_PER_QUERY)
+
+    async def get_chat_mentions_counts(self, database: AsyncMentionsDatabase, chat_ids: set[int]) -> dict[int, int]:
+        return await database.get_brand_chat_mentions_counts(self.request.lower(), chat_ids)
+
+    def get_not_found_text(self) -> str:
+        return f'Ни один артикул бренда <i>{self.request}</i> не упоминался ни в одном канале.'
+
+    def render_header(self, mentions_count: int, chats_count: int) -> str:
+        return render_brand_header(self.request, mentions_count, chats_count)
+
+    def render_chat_header(self, chat: Chat, mentions_count: int) -> str:
+        return render_brand_chat_header(chat, mentions_count)
+
+    def render_post(self, chat: Chat, post: Post, post_mentions: set[SkuPerPost], is_last_in_chat: bool) -> str:
+        return render_brand_post(chat, post, post_mentions)
+
+
+mentions_query_classes: dict[str, type[MentionsQuery]] = {
+    'sku': SkuMentionsQuery,
+    'brand': BrandMentionsQuery
+}
@@ -0,0 +1,109 @@
+import re
+from bisect import bisect_left
+from typing import Iterator
+from src.dao.mentions_db import Chat, Post, SkuPerPost
+
+MESSAGE_LIMIT = 4096
+
+html_tag_pattern = re.compile(r'<(/?)[a-zA-Z]+[^>]*>')
+
+
+def get_mentions_ending(mentions_count: int) -> str:
+    mentions_ending = 'е' if mentions_count == 1 else 'й'
+    return 'я' if mentions_count in range(2, 5) else mentions_ending
+
+
+def get_times_ending(mentions_count: int) -> str:
+    return 'а' if mentions_count in range(2, 5) else ''
+
+
+def get_channel_ending(channel_count: int) -> str:
+    return 'е' if channel_count == 1 else 'ах'
+
+
+def render_sku_header(sku: str, mentions_count: int, channel_count: int) -> str:
+    return f'<b>Артикул <a href="wb.ru/catalog/{sku}/detail.aspx">{sku}</a> упоминался <i>{mentions_count}</i> ' \
+           f'раз{get_times_ending(mentions_count)} в <i>{channel_count}</i> ' \
+           f'канал{get_channel_ending(channel_count)}:</b>'
+
+
+def render_sku_chat_header(chat: Chat, mentions_count: int) -> str:
+    return f'\n\n<i>{mentions_count}</i> упоминани{get_mentions_ending(mentions_count)} ' \
+           f'в канале <a href="{chat.link}">"{chat.title}"</a>:'
+
+
+def render_sku_post(chat: Chat, post: Post, is_last_in_chat: bool) -> str:
+    delimiter = '.' if is_last_in_chat else ';'
+    return f'\n<a href="t.me/c/{chat.tg_id}/{post.message_id}">Пост</a> от {post.date}{delimiter}'
+
+
+def render_brand_header(brand: str, mentions_count: int, channel_count: int) -> str:
+    return f'<b>Артикулы бренда {brand} упоминались <i>{mentions_count}</i> раз{get_times_ending(mentions_count)} ' \
+           f'в <i>{channel_count}</i> канал{get_channel_ending(channel_count)}:</b>'
+
+
+def render_brand_chat_header(chat: Chat, mentions_count: int) -> str:
+    return f'\n\n<i>{mentions_count}</i> упоминани{get_mentions_ending(mentions_count)} в канале ' \
+           f'<a href="{chat.link}">"{chat.title}"</a>:'
+
+
+def render_brand_post(chat: Chat, post: Post, post_mentions: set[SkuPerPost]) -> str:
+    sku_codes = sorted(mention.sku_code for mention in post_mentions)
+    sku_links = [f'<a href="wb.ru/catalog/{sku_code}/detail.aspx">{sku_code}</a>' for sku_code in sku_codes]
+    skus_title = 'Артикул: ' if len(sku_links) == 1 else 'Артикулы: '
+    return f'\n<a href="t.me/c/{chat.tg_id}/{post.message_id}">Пост</a> от {post.date}:' \
+           f'\n{skus_title}{"; ".join(sku_links)}.'
+
+
+def split_fragment(fragment: str, limit: int) -> Iterator[str]:
+    """
+    splits fragment that doesn't fit into one page, cuts are made before newline if possible and never inside
+    html element
+    :param fragment: fragment longer than limit
+    :param limit: max length of piece
+    :return: pieces of fragment
+    """
+    elements = get_html_element_spans(fragment)
+    element_starts = [element_start for element_start, _ in elements]
+
+    def get_element_start(position: int) -> int | None:
+        # start of top level html element that contains position, None if position is outside elements
+        i = bisect_left(element_starts, position) - 1
+        if i >= 0 and elements[i][0] < position < elements[i][1]:
+            return elements[i][0]
+        return None
+
+    start = 0
+    while len(fragment) - start > limit:
+        end = start + limit
+        cut = fragment.rfind('\n', start + 1, end + 1)
+        if cut == -1 or get_element_start(cut) is not None:
+            cut = end
+            element_start = get_element_start(cut)
+            if element_start is not None and element_start > start:
+                cut = element_start
+        yield fragment[start:cut]
+        start = cut
+    yield fragment[start:]
+
+
+def get_html_element_spans(text: str) -> list[tuple[int, int]]:
+    """
+    :param text: html text
+    :return: (start, end) of top level html elements in text
+    """
+    spans = []
+    depth = 0
+    element_start = 0
+    for match in html_tag_pattern.finditer(text):
+        if match.group(1):
+            if depth == 0:  # closing tag without opening one
+                continue
+            depth -= 1
+            if depth == 0:
+                spans.append((element_start, match.end()))
+        else:
+            if depth == 0:
+                element_start = match.start()
+            depth += 1
+    return spans
@@ -0,0 +1,113 @@
+import asyncio
+from typing import Callable, Awaitable
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from loguru import logger
+from config import WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENT_UPDATES, GRACEFUL_SHUTDOWN_TIMEOUT, \
+    METRICS_PATH
+from src.bot.metrics import HandlerMetrics
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookUpdateHandler:
+    """
+    aiohttp handler of telegram webhook requests. Update is acknowledged as soon as it is accepted and is processed
+    by dispatcher in background task, so telegram doesn't wait for replies of the bot. At most max_concurrent_updates
+    updates are processed at once, when the limit is reached requests wait for a free slot and telegram slows down
+    delivery
+    """
+
+    def __init__(self, dp: Dispatcher, max_concurrent_updates: int = WEBHOOK_MAX_CONCURRENT_UPDATES,
+                 secret_token: str | None = WEBHOOK_SECRET):
+        """
+        :param dp: dispatcher with handlers of the bot
+        :param max_concurrent_updates: max count of updates processed at once
+        :param secret_token: secret token of webhook, requests without it are rejected, None to accept all requests
+        """
+        self.dp = dp
+        self.secret_token = secret_token
+        self.semaphore = asyncio.Semaphore(max_concurrent_updates)
+        self.tasks: set[asyncio.Task] = set()
+        self.closing = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None and request.headers.get(SECRET_TOKEN_HEADER) != self.secret_token:
+            return web.Response(status=401)
+        if self.closing:
+            # telegram redelivers the update to the next worker
+            return web.Response(status=503)
+        update = types.Update.to_object(await request.json())
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self.process_update(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.on_update_processed)
+        return web.Response()
+
+    async def process_update(self, update: types.Update) -> None:
+        Dispatcher.set_current(self.dp)
+        Bot.set_current(self.dp.bot)
+        try:
+            await self.dp.process_update(update)
+        except Exception as e:
+            logger.error(f'ERROR OCCURRED WHILE PROCESSING UPDATE {update.update_id}: {e}')
+            logger.exception('')
+
+    def on_update_processed(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        self.semaphore.release()
+
+    async def wait_closed(self, timeout: float = GRACEFUL_SHUTDOWN_TIMEOUT) -> None:
+        """
+        stops accepting updates and waits until updates in progress are processed
+        :param timeout: seconds to wait, unfinished updates are cancelled after it
+        """
+        self.closing = True
+        if len(self.tasks) == 0:
+            return
+        # <editor-fold desc="log">
+        logger.info(f'WAITING FOR {len(self.tasks)} UPDATES IN PROGRESS')
+        # </editor-fold>
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if len(pending) != 0:
+            await asyncio.wait(pending)
+            logger.warning(f'CANCELLED {len(pending)} UPDATES ON SHUTDOWN')
+
+
+def create_webhook_app(handler: WebhookUpdateHandler,
+                       on_startup: Callable[[Dispatcher], Awaitable] | None = None,
+                       on_shutdown: Callable[[Dispatcher], Awaitable] | None = None,
+                       path: str = WEBHOOK_PATH, metrics: HandlerMetrics | None = None) -> web.Application:
+    """
+    :param handler: handler of webhook requests
+    :param on_startup: called with dispatcher before the first update
+    :param on_shutdown: called with dispatcher after updates in progress are processed
+    :param path: path of webhook
+    :param metrics: latency metrics of handlers, served in prometheus text format on METRICS_PATH
+    :return: aiohttp application that serves webhook of the bot
+    """
+    app = web.Application()
+    app.router.add_post(path, handler.handle)
+    if metrics is not None:
+        async def get_metrics(_: web.Request) -> web.Response:
+            return web.Response(text=metrics.render_prometheus(), content_type='text/plain')
+
+        app.router.add_get(METRICS_PATH, get_metrics)
+
+    async def startup(_: web.Application) -> None:
+        Dispatcher.set_current(handler.dp)
+        Bot.set_current(handler.dp.bot)
+        if on_startup is not None:
+            await on_startup(handler.dp)
+
+    async def shutdown(_: web.Application) -> None:
+        # aiohttp has already stopped listening, so no new updates come
+        await handler.wait_closed()
+        if on_shutdown is not None:
+            await on_shutdown(handler.dp)
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
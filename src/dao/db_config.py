@@ -1,8 +1,10 @@
 import os
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Generator
+from typing import Generator, AsyncIterator
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, Session
 
 load_dotenv()
@@ -18,21 +20,27 @@ class DBConfig:
     PASSWORD: str
     config_name: str
     PORT: str | None = None
+    ASYNC_DRIVER: str = 'psycopg'
 
 
 class DBConfigInstance:
 
     def __init__(self, in_db_config: DBConfig):
+        self.DB_URI = self.get_uri(in_db_config, in_db_config.DRIVER)
+        # uri for asyncio engine of the bot, psycopg 3 supports both sync and async connections
+        self.ASYNC_DB_URI = self.get_uri(in_db_config, in_db_config.ASYNC_DRIVER)
+
+    @staticmethod
+    def get_uri(in_db_config: DBConfig, driver: str) -> str:
         if in_db_config.PORT is None:
-            self.DB_URI = '{}+{}://{}:{}@{}/{}'.format(
-                in_db_config.DBMS, in_db_config.DRIVER, in_db_config.USERNAME,
+            return '{}+{}://{}:{}@{}/{}'.format(
+                in_db_config.DBMS, driver, in_db_config.USERNAME,
                 in_db_config.PASSWORD, in_db_config.HOSTNAME, in_db_config.DATABASE
             )
-        else:
-            self.DB_URI = '{}+{}://{}:{}@{}:{}/{}'.format(
-                in_db_config.DBMS, in_db_config.DRIVER, in_db_config.USERNAME,
-                in_db_config.PASSWORD, in_db_config.HOSTNAME, in_db_config.PORT, in_db_config.DATABASE
-            )
+        return '{}+{}://{}:{}@{}:{}/{}'.format(
+            in_db_config.DBMS, driver, in_db_config.USERNAME,
+            in_db_config.PASSWORD, in_db_config.HOSTNAME, in_db_config.PORT, in_db_config.DATABASE
+        )
 
 
 DB_CONFIG = DBConfigInstance(
@@ -43,12 +51,17 @@ DB_CONFIG = DBConfigInstance(
         DATABASE=os.getenv("DB_DATABASE"),
         USERNAME=os.getenv("DB_USERNAME"),
         PASSWORD=os.getenv("DB_PASSWORD"),
+        ASYNC_DRIVER=os.getenv("DB_ASYNC_DRIVER", 'psycopg'),
         config_name='debugging_config'
     ))
 
 engine = create_engine(DB_CONFIG.DB_URI)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(DB_CONFIG.ASYNC_DB_URI)
+# objects are read after commit and after the session is closed, so they must not expire
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 
 def get_db() -> Generator[Session, None, None]:
     db = SessionLocal()
@@ -57,3 +70,12 @@ def get_db() -> Generator[Session, None, None]:
         yield db
     finally:
         db.close()
+
+
+@asynccontextmanager
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    """
+    session per request for async code, session is closed on exit
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
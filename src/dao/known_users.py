@@ -0,0 +1,38 @@
+from array import array
+from bisect import bisect_left, insort
+from typing import Iterable
+from loguru import logger
+from src.dao.users_db import AsyncUserDatabase
+
+
+class KnownUsers:
+    """
+    In-process set of user_id of users that are already in table users.user, so /start of known user doesn't
+    touch db. Ids are kept in sorted array of 8 byte ints, that is much more compact than set of str
+    """
+
+    def __init__(self, user_ids: Iterable[int] = ()):
+        self.user_ids = array('q', sorted(set(user_ids)))
+
+    async def warm_up(self, database: AsyncUserDatabase) -> None:
+        """
+        loads user_id of all users from db
+        :param database: connection with db of users
+        """
+        user_ids = {int(user_id) for user_id in await database.get_user_ids() if user_id.lstrip('-').isdigit()}
+        user_ids.update(self.user_ids)
+        self.user_ids = array('q', sorted(user_ids))
+        # <editor-fold desc="log">
+        logger.info(f'LOADED {len(self.user_ids)} KNOWN USERS')
+        # </editor-fold>
+
+    def __contains__(self, user_id: int) -> bool:
+        i = bisect_left(self.user_ids, user_id)
+        return i < len(self.user_ids) and self.user_ids[i] == user_id
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def add(self, user_id: int) -> None:
+        if user_id not in self:
+            insort(self.user_ids, user_id)
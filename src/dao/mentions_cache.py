@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Callable, Hashable, AsyncIterator, AsyncContextManager, Awaitable, Any
+from config import MENTIONS_CACHE_SIZE, MENTIONS_CACHE_TTL, DATA_VERSION_CHECK_INTERVAL
+from src.dao.db_config import get_async_db
+from src.dao.mentions_db import AsyncMentionsDatabase
+
+
+@asynccontextmanager
+async def open_mentions_database() -> AsyncIterator[AsyncMentionsDatabase]:
+    """
+    AsyncMentionsDatabase on its own session, session is closed on exit
+    """
+    async with get_async_db() as session:
+        yield AsyncMentionsDatabase(session)
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    value: Any
+    created_at: float
+
+
+class MentionsCache:
+    """
+    Read-through LRU cache in front of AsyncMentionsDatabase lookups (pages of bot replies).
+    Entries expire after ttl seconds or when parsers upload new mentions (data version of db grows).
+    Every db access opens its own session, so cached objects are detached and concurrent lookups don't share a session
+    """
+
+    def __init__(self,
+                 database_factory: Callable[[], AsyncContextManager[AsyncMentionsDatabase]] = open_mentions_database,
+                 max_size: int = MENTIONS_CACHE_SIZE, ttl: float = MENTIONS_CACHE_TTL,
+                 version_check_interval: float = DATA_VERSION_CHECK_INTERVAL):
+        """
+        :param database_factory: opens connection with db for one lookup
+        :param max_size: max count of cached lookups, least recently used are evicted
+        :param ttl: seconds after which entry is reloaded
+        :param version_check_interval: db data version is requested not more often than once per this seconds
+        """
+        self.database_factory = database_factory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self.data_version: int | None = None
+        self.data_version_checked_at: float = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    async def get(self, key: Hashable, load: Callable[..., Awaitable[Any]], *args) -> Any:
+        """
+        returns cached value for key, calls load(database, *args) if value is missing or stale
+        :param key: key of cache entry
+        :param load: coroutine function to load value from db
+        :return: cached or loaded value
+        """
+        now = time.monotonic()
+        await self.check_data_version(now)
+        entry = self.entries.get(key)
+        if entry is not None and now - entry.created_at < self.ttl:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+        self.misses += 1
+        data_version = self.data_version
+        async with self.database_factory() as database:
+            value = await load(database, *args)
+        # entry loaded before a concurrent version change would outlive the clear, so it is not stored
+        if data_version != self.data_version:
+            return value
+        self.entries[key] = CacheEntry(value, now)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    async def check_data_version(self, now: float) -> None:
+        """
+        drops all entries if data version of db has changed, version is requested at most once per
+        version_check_interval
+        :param now: current time.monotonic() value
+        """
+        if self.data_version is None or now - self.data_version_checked_at >= self.version_check_interval:
+            # concurrent lookups don't request the version while this one waits for it
+            self.data_version_checked_at = now
+            async with self.database_factory() as database:
+                data_version = await database.get_data_version()
+            if data_version != self.data_version:
+                self.entries.clear()
+            self.data_version = data_version
+
+    def get_stats(self) -> dict[str, int]:
+        """
+        :return: counters for sizing the cache
+        """
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
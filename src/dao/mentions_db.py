@@ -1,11 +1,22 @@
+import csv
 import enum
+import io
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Iterable
 from loguru import logger
 from sqlalchemy import Column, DateTime, ForeignKey, Identity, Integer, String, text, MetaData, Enum, \
-    orm, Float, func, and_, select
-from sqlalchemy.exc import IntegrityError
+    orm, Float, func, select, update, delete, UniqueConstraint, Select, Index, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, relationship, Session
-from src.utils.wb_utils import get_brands_by_skus, BrandRec
+from src.utils.wb_utils import get_brands_by_skus
+
+CHAT_UPDATE_BATCH_SIZE = 500
+
+POST_COPY_COLUMNS = ('chat_id', 'message_id', 'views_count', 'replies_count', 'shared_count', 'comments_count',
+                     'reactions_count', 'er', 'err', 'date')
+MENTION_COPY_COLUMNS = ('chat_id', 'message_id', 'sku_code')
 
 metadata_obj = MetaData(schema='mentions')
 Base = declarative_base(metadata=metadata_obj)
@@ -30,6 +41,10 @@ class Brand(Base):
             (self.id, self.brand_id, self.name)
 
 
+# brands are searched by case-insensitive name
+Index('ix_brand_lower_name', func.lower(Brand.name))
+
+
 class ChatContentType(enum.Enum):
     ad_review = 'ad_review'
     wb_items_ads = 'wb_items_ads'
@@ -75,6 +90,23 @@ class Chat(Base):
     def init_on_load(self):
         self.update_required = False
 
+    def get_update_dict(self) -> dict:
+        """
+        dict with column values for bulk update by primary key
+        :return: dict with column name as key
+        """
+        return {
+            'id': self.id,
+            'tg_id': self.tg_id,
+            'link': self.link,
+            'title': self.title,
+            'chat_content': self.chat_content,
+            'followers': self.followers,
+            'recent_parsed_post_tg_id': self.recent_parsed_post_tg_id,
+            'session_id': self.session_id,
+            'updated_at': self.updated_at
+        }
+
     def __repr__(self):
         return "<Chat(id='%s'; tg_id='%s'; title='%s'; link='%s')>" % \
             (self.id, self.tg_id, self.title, self.link)
@@ -92,6 +124,7 @@ class Chat(Base):
 
 class Post(Base):
     __tablename__ = 'post'
+    __table_args__ = (UniqueConstraint('chat_id', 'message_id'),)
 
     id = Column(Integer, Identity(start=1, increment=1, minvalue=1, maxvalue=2147483647, cycle=False, cache=1),
                 primary_key=True)
@@ -110,6 +143,31 @@ class Post(Base):
     chat = relationship('Chat', back_populates='post')
     sku_per_post = relationship('SkuPerPost', back_populates='post')
 
+    def get_insert_dict(self) -> dict:
+        """
+        dict with column values for bulk insert
+        :return: dict with column name as key
+        """
+        return {
+            'chat_id': int(self.chat_id) if self.chat_id is not None else None,
+            'message_id': str(self.message_id),
+            'views_count': self.views_count,
+            'replies_count': self.replies_count,
+            'shared_count': self.shared_count,
+            'comments_count': self.comments_count,
+            'reactions_count': self.reactions_count,
+            'er': self.er,
+            'err': self.err,
+            'date': self.date
+        }
+
+    @property
+    def sku_codes(self) -> set[int]:
+        """
+        codes of skus mentioned in post
+        """
+        return {sku_per_post.sku_code for sku_per_post in self.sku_per_post}
+
     def __repr__(self):
         return "<Post(id='%s'; chat_id='%s'; msg_id='%s'; date='%s')>" % \
             (self.id, self.chat_id, self.message_id, self.date)
@@ -123,13 +181,49 @@ class Post(Base):
         return hash((self.chat_id, self.message_id))
 
 
+@dataclass(frozen=True, slots=True)
+class PostRecord:
+    """
+    Post parsed by telegram parser with codes of mentioned skus. Compact replacement of Post with its SkuPerPost
+    objects for parsers: it doesn't track relationships, records are converted to rows only at upload.
+    Records are equal if they are records of the same message, like Post
+    """
+    chat_id: int
+    message_id: str
+    sku_codes: frozenset[int] = field(compare=False)
+    views_count: int = field(default=0, compare=False)
+    replies_count: int = field(default=0, compare=False)
+    shared_count: int = field(default=0, compare=False)
+    comments_count: int = field(default=0, compare=False)
+    reactions_count: int = field(default=0, compare=False)
+    er: float | None = field(default=None, compare=False)
+    date: datetime | None = field(default=None, compare=False)
+
+    def get_insert_dict(self) -> dict:
+        """
+        dict with column values for bulk insert, same as Post.get_insert_dict
+        """
+        return {
+            'chat_id': self.chat_id,
+            'message_id': self.message_id,
+            'views_count': self.views_count,
+            'replies_count': self.replies_count,
+            'shared_count': self.shared_count,
+            'comments_count': self.comments_count,
+            'reactions_count': self.reactions_count,
+            'er': self.er,
+            'err': None,
+            'date': self.date
+        }
+
+
 class Sku(Base):
     __tablename__ = 'sku'
 
     id = Column(Integer, Identity(start=1, increment=1, minvalue=1, maxvalue=2147483647, cycle=False, cache=1),
                 primary_key=True)
     sku_code = Column(Integer, unique=True)
-    brand_id = Column(ForeignKey('brand.brand_id'))
+    brand_id = Column(ForeignKey('brand.brand_id'), index=True)
 
     brand = relationship('Brand', back_populates='sku')
     sku_per_post = relationship('SkuPerPost', back_populates='sku', cascade='merge')
@@ -152,11 +246,12 @@ class Sku(Base):
 
 class SkuPerPost(Base):
     __tablename__ = 'sku_per_post'
+    __table_args__ = (UniqueConstraint('post_id', 'sku_code'),)
 
     id = Column(Integer, Identity(start=1, increment=1, minvalue=1, maxvalue=2147483647, cycle=False, cache=1),
                 primary_key=True)
     post_id = Column(ForeignKey('post.id'))
-    sku_code = Column(ForeignKey('sku.sku_code'))
+    sku_code = Column(ForeignKey('sku.sku_code'), index=True)
 
     post = relationship('Post', back_populates='sku_per_post')
     sku = relationship('Sku', back_populates='sku_per_post', cascade='merge')
@@ -178,6 +273,121 @@ class SkuPerPost(Base):
         return hash((post_id, self.sku_code))
 
 
+def get_earliest_date(*dates: datetime | None) -> datetime | None:
+    """
+    :return: earliest of non-null dates, None if all dates are None
+    """
+    return min((date for date in dates if date is not None), default=None)
+
+
+def get_latest_date(*dates: datetime | None) -> datetime | None:
+    """
+    :return: latest of non-null dates, None if all dates are None
+    """
+    return max((date for date in dates if date is not None), default=None)
+
+
+def copy_rows(cursor, table: str, columns: tuple[str, ...], rows: Iterable[tuple]) -> None:
+    """
+    streams rows into table with COPY ... FROM STDIN, supports psycopg2 and psycopg 3 cursors
+    :param cursor: dbapi cursor
+    :param table: name of table to copy into
+    :param columns: names of columns in order of values in rows
+    :param rows: tuples of values, None is loaded as NULL
+    """
+    sql = f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)'
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    if hasattr(cursor, 'copy_expert'):  # psycopg2
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+    else:  # psycopg 3, write_row of its Copy writes text format, so csv is written as raw data
+        with cursor.copy(sql) as copy:
+            copy.write(buffer.getvalue())
+
+
+class MentionSummaryMixin:
+    """
+    Columns shared by precomputed mention summaries
+    """
+    mentions_count = Column(Integer, nullable=False)
+    first_mention_date = Column(DateTime)
+    last_mention_date = Column(DateTime)
+
+
+class SkuChatSummary(MentionSummaryMixin, Base):
+    __tablename__ = 'sku_chat_summary'
+
+    sku_code = Column(ForeignKey('sku.sku_code'), primary_key=True)
+    chat_id = Column(ForeignKey('chat.id'), primary_key=True)
+
+    def __repr__(self):
+        return "<SkuChatSummary(sku_code='%s'; chat_id='%s'; mentions_count='%s')>" % \
+            (self.sku_code, self.chat_id, self.mentions_count)
+
+
+class SkuSummary(MentionSummaryMixin, Base):
+    __tablename__ = 'sku_summary'
+
+    sku_code = Column(ForeignKey('sku.sku_code'), primary_key=True)
+    chats_count = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<SkuSummary(sku_code='%s'; mentions_count='%s'; chats_count='%s')>" % \
+            (self.sku_code, self.mentions_count, self.chats_count)
+
+
+class BrandChatSummary(MentionSummaryMixin, Base):
+    __tablename__ = 'brand_chat_summary'
+
+    brand_id = Column(ForeignKey('brand.brand_id'), primary_key=True)
+    chat_id = Column(ForeignKey('chat.id'), primary_key=True)
+
+    def __repr__(self):
+        return "<BrandChatSummary(brand_id='%s'; chat_id='%s'; mentions_count='%s')>" % \
+            (self.brand_id, self.chat_id, self.mentions_count)
+
+
+class BrandSummary(MentionSummaryMixin, Base):
+    __tablename__ = 'brand_summary'
+
+    brand_id = Column(ForeignKey('brand.brand_id'), primary_key=True)
+    chats_count = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<BrandSummary(brand_id='%s'; mentions_count='%s'; chats_count='%s')>" % \
+            (self.brand_id, self.mentions_count, self.chats_count)
+
+
+# (summary of mentions per chat, total summary, key column of both) for every summary level
+SUMMARY_LEVELS = (
+    (SkuChatSummary, SkuSummary, 'sku_code'),
+    (BrandChatSummary, BrandSummary, 'brand_id'),
+)
+
+
+# order of posts for keyset pagination of mentions, posts without date go first in chat
+post_keyset = (Post.chat_id, func.coalesce(Post.date, datetime.min), Post.id)
+
+
+def get_post_key(post: Post) -> tuple[int, datetime, int]:
+    """
+    :param post: post from db
+    :return: values of post_keyset for post
+    """
+    return post.chat_id, post.date or datetime.min, post.id
+
+
+class DataVersion(Base):
+    __tablename__ = 'data_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<DataVersion(id='%s'; version='%s')>" % (self.id, self.version)
+
+
 class Proxy(Base):
     __tablename__ = 'proxies'
 
@@ -225,8 +435,14 @@ class MentionsDatabase:
    Class to interact with parsers_bd.top_blogger_bot_schema
    """
 
-    def __init__(self, session: Session) -> None:
+    def __init__(self, session: Session, chat_update_batch_size: int = CHAT_UPDATE_BATCH_SIZE) -> None:
         self.session = session
+        self.chat_update_batch_size = chat_update_batch_size
+        self.tg_chats_to_update: dict[int, Chat] = dict()
+        # chats that are written, but not committed yet, with values they are written with
+        self.flushed_tg_chats: list[tuple[Chat, dict]] = []
+        # new mentions are uploaded since the last publish_data_version
+        self.data_changed = False
 
     def get_chats_by_content_type(self, chat_content_type: ChatContentType) -> list[Chat]:
         """
@@ -242,36 +458,59 @@ class MentionsDatabase:
         :param parser_result: object type of TgWbItemsAdChatParserResult
         """
         for tg_chat in parser_result.tg_chats_to_update:
-            self.update_tg_chat(tg_chat)
+            # scan checkpoints of chats (recent_parsed_post_tg_id) are committed together with posts
+            self.add_tg_chat_to_update(tg_chat, commit=False)
         self.upload_chats_to_db(parser_result.parsed_tg_chats)
-        self.upload_tg_posts_to_db(parser_result.parsed_posts, parser_result.parsed_skus)
-        self.session.commit()
+        self.upload_post_records(parser_result.parsed_posts)
+        self.flush_tg_chat_updates()
+        self.commit()
 
     def upload_chat_ad_parser_result(self, parser_result):
         """
         :param parser_result: object type of TgChatAdChatParserResult
         """
         for tg_chat in parser_result.tg_chats_to_update:
-            self.update_tg_chat(tg_chat)
+            self.add_tg_chat_to_update(tg_chat, commit=False)
         self.upload_chats_to_db(parser_result.parsed_tg_chats)
-        self.session.commit()
+        self.flush_tg_chat_updates()
+        self.commit()
 
     def upload_chats_to_db(self, tg_chats: set[Chat]) -> None:
         """
-        Uploads tg_chats to db if db doesn't has entry with same tg_id or link
+        Uploads tg_chats to db if db doesn't has entry with same tg_id or link,
+        existing entries are fetched with one query per key, new chats are inserted in one batch
         :param tg_chats: iterable with elements type of TgChatsToParse
         """
-        uploaded_chats_counter = 0
-        if len(tg_chats) != 0:
-            for tg_chat in tg_chats:
-                if tg_chat.tg_id is not None:
-                    filter_condition = Chat.tg_id == tg_chat.tg_id
-                else:
-                    filter_condition = Chat.link == tg_chat.link
-                if self.session.query(Chat).filter(filter_condition).one_or_none() is None:
-                    self.session.add(tg_chat)
-                    uploaded_chats_counter = uploaded_chats_counter + 1
-            logger.info(f'UPLOADED {uploaded_chats_counter} NEW CHATS')
+        if len(tg_chats) == 0:
+            return
+        tg_ids = {tg_chat.tg_id for tg_chat in tg_chats if tg_chat.tg_id is not None}
+        links = {tg_chat.link for tg_chat in tg_chats if tg_chat.tg_id is None}
+        known_tg_ids = set()
+        if len(tg_ids) != 0:
+            known_tg_ids = set(self.session.execute(
+                select(Chat.tg_id).where(Chat.tg_id.in_(tg_ids))
+            ).scalars().all())
+        known_links = set()
+        if len(links) != 0:
+            known_links = set(self.session.execute(
+                select(Chat.link).where(Chat.link.in_(links))
+            ).scalars().all())
+
+        new_chats = []
+        for tg_chat in tg_chats:
+            if tg_chat.tg_id is not None:
+                if tg_chat.tg_id in known_tg_ids:
+                    continue
+                known_tg_ids.add(tg_chat.tg_id)
+            else:
+                if tg_chat.link in known_links:
+                    continue
+                known_links.add(tg_chat.link)
+            new_chats.append(tg_chat)
+        # pending chats are flushed as one multi-row INSERT
+        self.session.add_all(new_chats)
+        self.session.flush()
+        logger.info(f'UPLOADED {len(new_chats)} NEW CHATS')
 
     def get_mentions_by_sku(self, sku_code: int) -> \
             dict[Chat, dict[Post, set[SkuPerPost]]]:
@@ -280,10 +519,8 @@ class MentionsDatabase:
         :param sku_code: sku to filter
         :return: dict with mentions per posts per chats
         """
-        mentions = self.session.execute(
-            select(SkuPerPost).where(SkuPerPost.sku_code == sku_code)
-        ).scalars().all()
-        return self.generate_mentions_dict(set(mentions))
+        mentions = self.session.execute(self.select_mentions_by_sku(sku_code)).all()
+        return self.generate_mentions_dict(mentions)
 
     def get_mentions_by_brand(self, brand_name: str) -> \
             dict[Chat, dict[Post, set[SkuPerPost]]]:
@@ -292,34 +529,58 @@ class MentionsDatabase:
         :param brand_name: string, case-insensitive
         :return: dict with mentions per posts per chats
         """
-        brand_id = self.session.query(Brand.brand_id).filter(func.lower(Brand.name) == brand_name).one_or_none()
-        if brand_id is None:
-            return {}
-        brand_skus = self.session.query(Sku.sku_code).filter(Sku.brand_id == brand_id[0]).all()
-        brand_skus_list = list(brand_sku[0] for brand_sku in brand_skus)
-        mentions = self.session.execute(
-            select(SkuPerPost).where(SkuPerPost.sku_code.in_(brand_skus_list))
-        ).scalars().all()
-        return self.generate_mentions_dict(set(mentions))
-
-    def generate_mentions_dict(self, mentions: set[SkuPerPost]) -> \
+        mentions = self.session.execute(self.select_mentions_by_brand(brand_name)).all()
+        return self.generate_mentions_dict(mentions)
+
+    @staticmethod
+    def select_mentions_by_sku(sku_code: int) -> Select:
+        return MentionsDatabase.select_mentions().where(SkuPerPost.sku_code == sku_code)
+
+    @staticmethod
+    def select_mentions_by_brand(brand_name: str) -> Select:
+        return MentionsDatabase.select_mentions() \
+            .join(Sku, SkuPerPost.sku_code == Sku.sku_code) \
+            .join(Brand, Sku.brand_id == Brand.brand_id) \
+            .where(func.lower(Brand.name) == brand_name)
+
+    @staticmethod
+    def select_mentions() -> Select:
+        """
+        select of mentions joined with their posts and chats, so no lazy loads are needed to group them
+        :return: select of (SkuPerPost, Post, Chat) rows
+        """
+        return select(SkuPerPost, Post, Chat) \
+            .select_from(SkuPerPost) \
+            .join(Post, SkuPerPost.post_id == Post.id) \
+            .join(Chat, Post.chat_id == Chat.id) \
+            .order_by(Chat.id, Post.date)
+
+    @staticmethod
+    def select_mentions_page(mentions: Select, after: tuple | None, posts_limit: int) -> Select:
+        """
+        keyset pagination of mentions by posts in order of post_keyset
+        :param mentions: select of mentions (select_mentions with filters)
+        :param after: post key (chat_id, date, post_id) of last post of previous page, None for first page
+        :param posts_limit: max count of posts in page
+        :return: select of (SkuPerPost, Post, Chat) rows for posts of page
+        """
+        page_posts = mentions.with_only_columns(Post.id).group_by(Post.id) \
+            .order_by(None).order_by(*post_keyset).limit(posts_limit).correlate(None)
+        if after is not None:
+            page_posts = page_posts.where(tuple_(*post_keyset) > tuple_(*after))
+        return mentions.where(Post.id.in_(page_posts.scalar_subquery())).order_by(None).order_by(*post_keyset)
+
+    @staticmethod
+    def generate_mentions_dict(mentions: Iterable[tuple[SkuPerPost, Post, Chat]]) -> \
             dict[Chat, dict[Post, set[SkuPerPost]]]:
         """
-        creates dict from orm objects
-        :param mentions: list of orm of SkuPerPost class
+        groups joined rows by chats and posts
+        :param mentions: rows of (SkuPerPost, Post, Chat)
         :return: dict with mentions per posts per chats
         """
         resulting_dict = {}
-        for mention in mentions:
-            chat: Chat = mention.post.chat
-            post: Post = mention.post
-            if chat in resulting_dict.keys():
-                if post in resulting_dict[chat].keys():
-                    resulting_dict[chat][post].add(mention)
-                else:
-                    resulting_dict[chat][post] = {mention}
-            else:
-                resulting_dict[chat] = {post: {mention}}
+        for mention, post, chat in mentions:
+            resulting_dict.setdefault(chat, {}).setdefault(post, set()).add(mention)
         return resulting_dict
 
     def update_tg_chat(self, tg_chat: Chat) -> None:
@@ -331,61 +592,514 @@ class MentionsDatabase:
         self.update_tg_chat_without_update_time(tg_chat)
 
     def update_tg_chat_without_update_time(self, tg_chat: Chat) -> None:
-        if not tg_chat.update_required:
+        self.add_tg_chat_to_update(tg_chat, set_update_time=False)
+        self.flush_tg_chat_updates()
+        self.commit()
+
+    def add_tg_chat_to_update(self, tg_chat: Chat, set_update_time: bool = True, commit: bool = True) -> None:
+        """
+        Adds chat to the buffer of chats to update, buffer is written by flush_tg_chat_updates,
+        the buffer is flushed and committed when it reaches chat_update_batch_size
+        :param tg_chat: chat to update, skipped if update is not required
+        :param set_update_time: if True, updated_at of chat is set to datetime.now()
+        :param commit: if False, full buffer is flushed without commit, so updates are committed by the caller
+        together with the rest of its transaction
+        """
+        if not tg_chat.update_required or tg_chat.id is None:
+            return
+        if set_update_time:
+            tg_chat.updated_at = datetime.now()
+        self.tg_chats_to_update[tg_chat.id] = tg_chat
+        if len(self.tg_chats_to_update) >= self.chat_update_batch_size:
+            self.flush_tg_chat_updates()
+            if commit:
+                self.commit()
+
+    def flush_tg_chat_updates(self) -> None:
+        """
+        Writes buffered chats with one executemany UPDATE by primary key, commit is up to the caller,
+        chats stay update_required until the transaction is committed with .commit()
+        """
+        if len(self.tg_chats_to_update) == 0:
             return
-        tg_chat_dict = vars(tg_chat).copy()
-        for var in vars(tg_chat):
-            if var.startswith('_') or var == 'update_required':
-                tg_chat_dict.pop(var)
-        tg_chat.update_required = False
-        self.session.query(Chat). \
-            filter(Chat.id == tg_chat.id). \
-            update(tg_chat_dict, synchronize_session=False)
+        tg_chats = list(self.tg_chats_to_update.values())
+        self.tg_chats_to_update.clear()
+        update_dicts = [tg_chat.get_update_dict() for tg_chat in tg_chats]
+        self.session.execute(update(Chat), update_dicts)
+        self.flushed_tg_chats.extend(zip(tg_chats, update_dicts))
+
+    def commit(self) -> None:
+        """
+        Commits session, chats written by flush_tg_chat_updates are not update_required after it,
+        unless they were changed after flush
+        """
         self.session.commit()
+        for tg_chat, update_dict in self.flushed_tg_chats:
+            if tg_chat.get_update_dict() == update_dict:
+                tg_chat.update_required = False
+        self.flushed_tg_chats.clear()
+
+    def rollback(self) -> None:
+        """
+        Rolls session back, chats written by flush_tg_chat_updates stay update_required, so they are updated again
+        """
+        self.session.rollback()
+        self.flushed_tg_chats.clear()
 
-    def upload_tg_posts_to_db(self, parsed_posts: set[Chat], parsed_skus: dict[int, Sku]) -> (int, int):
-        brand_dict = get_brands_by_skus(list(parsed_skus.keys()))
-
-        new_skus_counter = 0
-        for sku in parsed_skus.values():
-            sku_from_db = self.session.query(Sku).filter(Sku.sku_code == sku.sku_code).one_or_none()
-            if sku_from_db is None:
-                brand = brand_dict.get(sku.sku_code)
-                is_loaded = self.load_sku(sku, brand)  # int 0 or 1
-                new_skus_counter += is_loaded
-        new_post_counter = 0
-        total_mentions_count = 0
+    def upload_tg_posts_to_db(self, parsed_posts: set[Post], parsed_skus: dict[int, Sku]) -> (int, int):
+        """
+        Uploads posts with mentions, posts and mentions that are already present in db are skipped
+        by unique constraints, so the whole batch is loaded with a couple of statements
+        :param parsed_posts: posts with sku_per_post relationships
+        :param parsed_skus: parsed skus per sku_code
+        :return: count of new posts, count of new mentions
+        """
+        # mentions of skus without valid wb brand are removed from posts
+        self.load_skus(parsed_skus)
+        return self.insert_posts_with_mentions(parsed_posts)
+
+    def upload_post_records(self, post_records: Iterable[PostRecord]) -> (int, int):
+        """
+        Uploads posts parsed by telegram parsers like upload_tg_posts_to_db,
+        mentions of skus without valid wb brand are skipped
+        :param post_records: parsed posts with sku codes
+        :return: count of new posts, count of new mentions
+        """
+        post_records = list(post_records)
+        valid_sku_codes = self.load_sku_codes({sku_code for post in post_records for sku_code in post.sku_codes})
+        return self.insert_posts_with_mentions(post_records, valid_sku_codes)
+
+    def insert_posts_with_mentions(self, posts: Iterable[Post | PostRecord],
+                                   valid_sku_codes: set[int] | None = None) -> (int, int):
+        """
+        Inserts posts that mention skus and their mentions, updates summaries of new mentions
+        :param posts: posts with sku_codes
+        :param valid_sku_codes: codes of skus that are present in db, None if all sku_codes of posts are valid
+        :return: count of new posts, count of new mentions
+        """
+        posts_to_insert: dict[tuple, tuple[Post | PostRecord, set[int]]] = dict()
+        for post in posts:
+            sku_codes = post.sku_codes if valid_sku_codes is None else valid_sku_codes.intersection(post.sku_codes)
+            if len(sku_codes) != 0:
+                post_dict = post.get_insert_dict()
+                posts_to_insert[(post_dict['chat_id'], post_dict['message_id'])] = post, sku_codes
+        if len(posts_to_insert) == 0:
+            return 0, 0
+
+        new_post_ids = self.insert_posts([post for post, _ in posts_to_insert.values()])
+        mentions_to_insert = set()
+        for post_key, post_id in new_post_ids.items():
+            for sku_code in posts_to_insert[post_key][1]:
+                mentions_to_insert.add((post_id, sku_code))
+        new_mention_ids = self.insert_mentions(mentions_to_insert)
+        self.update_mention_summaries(new_mention_ids)
+        if len(new_mention_ids) != 0:
+            self.data_changed = True
+        return len(new_post_ids), len(new_mention_ids)
+
+    def copy_posts_to_db(self, parsed_posts: Iterable[Post | PostRecord]) -> (int, int):
+        """
+        Bulk load mode of upload_tg_posts_to_db for large backfills: posts and mentions are streamed into temporary
+        staging tables with COPY and merged into mentions schema with one statement
+        :param parsed_posts: posts with sku_per_post relationships or post records
+        :return: count of new posts, count of new mentions
+        """
+        post_rows: dict[tuple, tuple] = dict()
+        mention_rows: set[tuple] = set()
         for post in parsed_posts:
-            post_from_db = self.session.query(Post). \
-                filter(and_(Post.chat_id == post.chat_id,
-                            Post.message_id == post.message_id)).one_or_none()
-            skus_in_post = len(post.sku_per_post)
-
-            if post_from_db is None and skus_in_post != 0:
-                total_mentions_count = total_mentions_count + skus_in_post
-                new_post_counter = new_post_counter + 1
-                self.session.add(post)
-        return new_post_counter, total_mentions_count
-
-    def load_sku(self, sku: Sku, brand: BrandRec) -> int:
-        if brand is not None and brand.brand_id != 0:
-            brand_from_db = self.session.query(Brand).filter(Brand.brand_id == brand.brand_id).one_or_none()
-            if brand_from_db is None:
-                try:
-                    with self.session.begin_nested():
-                        brand_from_db = Brand(brand_id=brand.brand_id, name=brand.name)
-                        self.session.add(brand_from_db)
-                except IntegrityError:  # pragma: no cover
-                    pass
+            post_dict = post.get_insert_dict()
+            post_key = (post_dict['chat_id'], post_dict['message_id'])
+            post_rows[post_key] = tuple(post_dict[column] for column in POST_COPY_COLUMNS)
+            for sku_code in post.sku_codes:
+                mention_rows.add((*post_key, sku_code))
+
+        valid_sku_codes = self.load_sku_codes({sku_code for _, _, sku_code in mention_rows})
+        mention_rows = {mention for mention in mention_rows if mention[2] in valid_sku_codes}
+        mentioned_post_keys = {(chat_id, message_id) for chat_id, message_id, _ in mention_rows}
+        post_rows = {post_key: row for post_key, row in post_rows.items() if post_key in mentioned_post_keys}
+        if len(post_rows) == 0:
+            return 0, 0
+
+        self.session.execute(text(
+            'CREATE TEMPORARY TABLE post_staging (chat_id integer, message_id varchar, views_count integer, '
+            'replies_count integer, shared_count integer, comments_count integer, reactions_count integer, '
+            'er double precision, err double precision, date timestamp) ON COMMIT DROP'
+        ))
+        self.session.execute(text(
+            'CREATE TEMPORARY TABLE sku_per_post_staging (chat_id integer, message_id varchar, sku_code integer) '
+            'ON COMMIT DROP'
+        ))
+        cursor = self.session.connection().connection.cursor()
+        try:
+            copy_rows(cursor, 'post_staging', POST_COPY_COLUMNS, post_rows.values())
+            copy_rows(cursor, 'sku_per_post_staging', MENTION_COPY_COLUMNS, mention_rows)
+        finally:
+            cursor.close()
+
+        post_columns = ', '.join(POST_COPY_COLUMNS)
+        new_posts_count, new_mention_ids = self.session.execute(text(f"""
+            WITH new_posts AS (
+                INSERT INTO {Post.__table__.fullname} ({post_columns})
+                SELECT DISTINCT ON (chat_id, message_id) {post_columns} FROM post_staging
+                ON CONFLICT (chat_id, message_id) DO NOTHING
+                RETURNING id, chat_id, message_id
+            ), new_mentions AS (
+                INSERT INTO {SkuPerPost.__table__.fullname} (post_id, sku_code)
+                SELECT DISTINCT new_posts.id, staging.sku_code
+                FROM new_posts JOIN sku_per_post_staging staging
+                    ON staging.chat_id IS NOT DISTINCT FROM new_posts.chat_id
+                    AND staging.message_id = new_posts.message_id
+                ON CONFLICT (post_id, sku_code) DO NOTHING
+                RETURNING id
+            )
+            SELECT (SELECT count(*) FROM new_posts), (SELECT coalesce(array_agg(id), '{{}}') FROM new_mentions)
+        """)).one()
+        self.session.execute(text('DROP TABLE post_staging, sku_per_post_staging'))
+
+        self.update_mention_summaries(new_mention_ids)
+        if len(new_mention_ids) != 0:
+            self.data_changed = True
+        return new_posts_count, len(new_mention_ids)
+
+    def insert_posts(self, posts: list[Post]) -> dict[tuple[int, str], int]:
+        """
+        Inserts posts in one statement, skips posts with (chat_id, message_id) that are already present in db
+        :param posts: posts to insert
+        :return: ids of inserted posts per (chat_id, message_id)
+        """
+        stmt = insert(Post).on_conflict_do_nothing(index_elements=['chat_id', 'message_id']) \
+            .returning(Post.id, Post.chat_id, Post.message_id)
+        result = self.session.execute(stmt, [post.get_insert_dict() for post in posts])
+        return {(row.chat_id, row.message_id): row.id for row in result}
+
+    def insert_mentions(self, mentions: set[tuple[int, int]]) -> list[int]:
+        """
+        Inserts sku_per_post rows in one statement, skips rows that are already present in db
+        :param mentions: set of (post_id, sku_code) pairs
+        :return: ids of inserted rows
+        """
+        if len(mentions) == 0:
+            return []
+        stmt = insert(SkuPerPost).on_conflict_do_nothing(index_elements=['post_id', 'sku_code']) \
+            .returning(SkuPerPost.id)
+        result = self.session.execute(stmt, [{'post_id': post_id, 'sku_code': sku_code}
+                                             for post_id, sku_code in mentions])
+        return list(result.scalars().all())
+
+    def bump_data_version(self) -> None:
+        """
+        Increments version of mentions data, readers use it to invalidate cached mentions
+        """
+        stmt = insert(DataVersion).values(id=1, version=1)
+        stmt = stmt.on_conflict_do_update(index_elements=['id'], set_={'version': DataVersion.version + 1})
+        self.session.execute(stmt)
+
+    def publish_data_version(self) -> None:
+        """
+        Bumps data version once for all mentions uploaded since the previous call and commits it,
+        uploaders call it at the end of a run, so cached replies of the bot are dropped once per run, not per batch
+        """
+        if not self.data_changed:
+            return
+        self.bump_data_version()
+        self.session.commit()
+        self.data_changed = False
+
+    def get_data_version(self) -> int:
+        """
+        :return: current version of mentions data, 0 if data was never uploaded
+        """
+        version = self.session.execute(self.select_data_version()).scalar_one_or_none()
+        return version or 0
+
+    @staticmethod
+    def select_data_version() -> Select:
+        return select(DataVersion.version).where(DataVersion.id == 1)
+
+    def get_sku_summary(self, sku_code: int) -> SkuSummary | None:
+        """
+        :param sku_code: sku to look for
+        :return: precomputed summary of sku mentions, None if sku was never mentioned
+        """
+        return self.session.get(SkuSummary, sku_code)
+
+    def get_brand_summaries(self, brand_name: str) -> list[BrandSummary]:
+        """
+        :param brand_name: lowercase brand name
+        :return: precomputed summaries of mentions for brands with this name
+        """
+        return list(self.session.execute(self.select_brand_summaries(brand_name)).scalars().all())
+
+    @staticmethod
+    def select_brand_summaries(brand_name: str) -> Select:
+        return select(BrandSummary) \
+            .join(Brand, BrandSummary.brand_id == Brand.brand_id) \
+            .where(func.lower(Brand.name) == brand_name)
+
+    @staticmethod
+    def select_chat_summaries(key: str) -> Select:
+        """
+        aggregates raw mentions per chat for summary level
+        :param key: key column of summary level, 'sku_code' or 'brand_id'
+        :return: select of (key, chat_id, mentions_count, first_mention_date, last_mention_date) rows
+        """
+        key_column = getattr(Sku, key)
+        return select(key_column, Post.chat_id, func.count(SkuPerPost.id), func.min(Post.date), func.max(Post.date)) \
+            .select_from(SkuPerPost) \
+            .join(Post, SkuPerPost.post_id == Post.id) \
+            .join(Sku, SkuPerPost.sku_code == Sku.sku_code) \
+            .where(key_column.isnot(None), Post.chat_id.isnot(None)) \
+            .group_by(key_column, Post.chat_id)
+
+    def update_mention_summaries(self, mention_ids: list[int]) -> None:
+        """
+        Adds freshly inserted mentions to precomputed summaries of every summary level
+        :param mention_ids: ids of inserted sku_per_post rows
+        """
+        if len(mention_ids) == 0:
+            return
+        for chat_summary_model, summary_model, key in SUMMARY_LEVELS:
+            chat_summaries = self.session.execute(
+                self.select_chat_summaries(key).where(SkuPerPost.id.in_(mention_ids))
+            ).all()
+            if len(chat_summaries) == 0:
+                continue
+            deltas = {(row[0], row[1]): dict(zip((key, 'chat_id', 'mentions_count', 'first_mention_date',
+                                                   'last_mention_date'), row))
+                      for row in chat_summaries}
+
+            stmt = insert(chat_summary_model)
+            stmt = stmt.on_conflict_do_update(index_elements=[key, 'chat_id'], set_={
+                'mentions_count': chat_summary_model.mentions_count + stmt.excluded.mentions_count,
+                'first_mention_date': func.least(chat_summary_model.first_mention_date,
+                                                 stmt.excluded.first_mention_date),
+                'last_mention_date': func.greatest(chat_summary_model.last_mention_date,
+                                                   stmt.excluded.last_mention_date)
+            }).returning(getattr(chat_summary_model, key), chat_summary_model.chat_id,
+                         chat_summary_model.mentions_count)
+            # rows are upserted in order of conflict key, so concurrent uploads lock summaries in the same order
+            # and don't deadlock. counts only grow, so chat summary is new if its total is equal to its delta
+            chat_summary_rows = [deltas[chat_summary_key] for chat_summary_key in sorted(deltas)]
+            new_chat_summaries = {(row[0], row[1]) for row in self.session.execute(stmt, chat_summary_rows)
+                                  if row[2] == deltas[(row[0], row[1])]['mentions_count']}
+
+            summary_deltas: dict[int, dict] = dict()
+            for delta in deltas.values():
+                summary_delta = summary_deltas.setdefault(delta[key], {
+                    key: delta[key], 'mentions_count': 0, 'chats_count': 0,
+                    'first_mention_date': delta['first_mention_date'], 'last_mention_date': delta['last_mention_date']
+                })
+                summary_delta['mentions_count'] += delta['mentions_count']
+                summary_delta['chats_count'] += (delta[key], delta['chat_id']) in new_chat_summaries
+                summary_delta['first_mention_date'] = get_earliest_date(summary_delta['first_mention_date'],
+                                                                        delta['first_mention_date'])
+                summary_delta['last_mention_date'] = get_latest_date(summary_delta['last_mention_date'],
+                                                                     delta['last_mention_date'])
+
+            stmt = insert(summary_model)
+            stmt = stmt.on_conflict_do_update(index_elements=[key], set_={
+                'mentions_count': summary_model.mentions_count + stmt.excluded.mentions_count,
+                'chats_count': summary_model.chats_count + stmt.excluded.chats_count,
+                'first_mention_date': func.least(summary_model.first_mention_date, stmt.excluded.first_mention_date),
+                'last_mention_date': func.greatest(summary_model.last_mention_date, stmt.excluded.last_mention_date)
+            })
+            self.session.execute(stmt, [summary_deltas[key_value] for key_value in sorted(summary_deltas)])
+
+    def rebuild_mention_summaries(self) -> None:
+        """
+        Recomputes all mention summaries from raw sku_per_post rows, used for backfills
+        """
+        for chat_summary_model, summary_model, key in SUMMARY_LEVELS:
+            self.session.execute(delete(summary_model))
+            self.session.execute(delete(chat_summary_model))
+            self.session.execute(insert(chat_summary_model).from_select(
+                [key, 'chat_id', 'mentions_count', 'first_mention_date', 'last_mention_date'],
+                self.select_chat_summaries(key)
+            ))
+            key_column = getattr(chat_summary_model, key)
+            self.session.execute(insert(summary_model).from_select(
+                [key, 'mentions_count', 'chats_count', 'first_mention_date', 'last_mention_date'],
+                select(key_column, func.sum(chat_summary_model.mentions_count), func.count(),
+                       func.min(chat_summary_model.first_mention_date),
+                       func.max(chat_summary_model.last_mention_date))
+                .group_by(key_column)
+            ))
+        self.session.commit()
+
+    def check_mention_summaries(self) -> list[str]:
+        """
+        Compares mention summaries with raw sku_per_post rows
+        :return: descriptions of inconsistent summaries, empty if summaries are consistent
+        """
+        inconsistencies = []
+        for chat_summary_model, summary_model, key in SUMMARY_LEVELS:
+            expected_chat_summaries = dict()
+            expected = dict()
+            for row in self.session.execute(self.select_chat_summaries(key)):
+                expected_chat_summaries[(row[0], row[1])] = [row[2], row[3], row[4]]
+                summary = expected.setdefault(row[0], [0, 0, row[3], row[4]])
+                summary[0] += row[2]
+                summary[1] += 1
+                summary[2] = get_earliest_date(summary[2], row[3])
+                summary[3] = get_latest_date(summary[3], row[4])
+            actual_chat_summaries = {
+                (getattr(summary, key), summary.chat_id): [summary.mentions_count, summary.first_mention_date,
+                                                           summary.last_mention_date]
+                for summary in self.session.execute(select(chat_summary_model)).scalars()
+            }
+            for key_value, chat_id in expected_chat_summaries.keys() | actual_chat_summaries.keys():
+                expected_summary = expected_chat_summaries.get((key_value, chat_id))
+                actual_summary = actual_chat_summaries.get((key_value, chat_id))
+                if expected_summary != actual_summary:
+                    inconsistencies.append(f'{chat_summary_model.__tablename__} {key}={key_value} chat_id={chat_id}: '
+                                           f'expected {expected_summary}, actual {actual_summary}')
+            actual = {
+                getattr(summary, key): [summary.mentions_count, summary.chats_count,
+                                        summary.first_mention_date, summary.last_mention_date]
+                for summary in self.session.execute(select(summary_model)).scalars()
+            }
+            for key_value in expected.keys() | actual.keys():
+                if expected.get(key_value) != actual.get(key_value):
+                    inconsistencies.append(f'{summary_model.__tablename__} {key}={key_value}: '
+                                           f'expected {expected.get(key_value)}, actual {actual.get(key_value)}')
+        return inconsistencies
+
+    def load_sku_codes(self, sku_codes: set[int]) -> set[int]:
+        """
+        Loads skus with their brands like load_skus, for callers that have only sku codes
+        :param sku_codes: parsed sku codes
+        :return: sku codes that are present in db, i.e. codes of skus with valid wb brand
+        """
+        if len(sku_codes) == 0:
+            return set()
+        self.load_skus({sku_code: Sku(sku_code=sku_code) for sku_code in sku_codes})
+        return set(self.session.execute(select(Sku.sku_code).where(Sku.sku_code.in_(sku_codes))).scalars().all())
+
+    def load_skus(self, parsed_skus: dict[int, Sku]) -> int:
+        """
+        Loads skus that are not present in db with their brands, skus with no valid wb brand are dropped from posts
+        by Sku.clean_sku_post, so their mentions are not loaded
+        :param parsed_skus: parsed skus per sku_code
+        :return: count of new skus
+        """
+        if len(parsed_skus) == 0:
+            return 0
+        known_sku_codes = set(self.session.execute(
+            select(Sku.sku_code).where(Sku.sku_code.in_(parsed_skus.keys()))
+        ).scalars().all())
+        new_skus = [sku for sku_code, sku in parsed_skus.items() if sku_code not in known_sku_codes]
+        if len(new_skus) == 0:
+            return 0
+
+        brand_dict = get_brands_by_skus([sku.sku_code for sku in new_skus])
+        brands_to_insert: dict[int, dict] = dict()
+        skus_to_insert: list[dict] = []
+        for sku in new_skus:
+            brand = brand_dict.get(sku.sku_code)
+            # if brand is not present in dict from wb api
+            if brand is None or not brand.brand_id:
+                sku.clean_sku_post()
+                continue
             sku.brand_id = brand.brand_id
-            try:
-                with self.session.begin_nested():
-                    self.session.add(sku)
-                    self.session.flush()
-            except IntegrityError:  # pragma: no cover
-                return 0
-            return 1
-        # if brand is not present in dict from wb api
-        else:
-            sku.clean_sku_post()
+            brands_to_insert[brand.brand_id] = {'brand_id': brand.brand_id, 'name': brand.name}
+            skus_to_insert.append({'sku_code': sku.sku_code, 'brand_id': brand.brand_id})
+        if len(skus_to_insert) == 0:
             return 0
+
+        known_brand_ids = set(self.session.execute(
+            select(Brand.brand_id).where(Brand.brand_id.in_(brands_to_insert.keys()))
+        ).scalars().all())
+        brands_to_insert = [brand for brand_id, brand in brands_to_insert.items() if brand_id not in known_brand_ids]
+        if len(brands_to_insert) != 0:
+            self.session.execute(insert(Brand).on_conflict_do_nothing(index_elements=['brand_id']), brands_to_insert)
+        result = self.session.execute(
+            insert(Sku).on_conflict_do_nothing(index_elements=['sku_code']).returning(Sku.sku_code), skus_to_insert)
+        return len(result.all())
+
+
+class AsyncMentionsDatabase:
+    """
+    Read-only lookups of MentionsDatabase for asyncio code (the bot), queries are shared with MentionsDatabase
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def get_data_version(self) -> int:
+        """
+        :return: current version of mentions data, 0 if data was never uploaded
+        """
+        version = await self.session.scalar(MentionsDatabase.select_data_version())
+        return version or 0
+
+    async def get_sku_summary(self, sku_code: int) -> SkuSummary | None:
+        """
+        :param sku_code: sku to look for
+        :return: precomputed summary of sku mentions, None if sku was never mentioned
+        """
+        return await self.session.get(SkuSummary, sku_code)
+
+    async def get_mentions_page_by_sku(self, sku_code: int, after: tuple | None, posts_limit: int) -> \
+            dict[Chat, dict[Post, set[SkuPerPost]]]:
+        """
+        :param sku_code: sku to filter
+        :param after: post key of last post of previous page, None for first page
+        :param posts_limit: max count of posts in page
+        :return: dict with mentions per posts per chats for page, ordered by post key
+        """
+        mentions = await self.session.execute(
+            MentionsDatabase.select_mentions_page(MentionsDatabase.select_mentions_by_sku(sku_code), after, posts_limit)
+        )
+        return MentionsDatabase.generate_mentions_dict(mentions.all())
+
+    async def get_mentions_page_by_brand(self, brand_name: str, after: tuple | None, posts_limit: int) -> \
+            dict[Chat, dict[Post, set[SkuPerPost]]]:
+        """
+        :param brand_name: lowercase brand name
+        :param after: post key of last post of previous page, None for first page
+        :param posts_limit: max count of posts in page
+        :return: dict with mentions per posts per chats for page, ordered by post key
+        """
+        mentions = await self.session.execute(MentionsDatabase.select_mentions_page(
+            MentionsDatabase.select_mentions_by_brand(brand_name), after, posts_limit
+        ))
+        return MentionsDatabase.generate_mentions_dict(mentions.all())
+
+    async def get_sku_chat_mentions_counts(self, sku_code: int, chat_ids: Iterable[int]) -> dict[int, int]:
+        """
+        :param sku_code: sku to look for
+        :param chat_ids: chats to look in
+        :return: count of sku mentions per chat id
+        """
+        rows = await self.session.execute(
+            select(SkuChatSummary.chat_id, SkuChatSummary.mentions_count)
+            .where(SkuChatSummary.sku_code == sku_code, SkuChatSummary.chat_id.in_(chat_ids))
+        )
+        return dict(rows.tuples().all())
+
+    async def get_brand_chat_mentions_counts(self, brand_name: str, chat_ids: Iterable[int]) -> dict[int, int]:
+        """
+        :param brand_name: lowercase brand name
+        :param chat_ids: chats to look in
+        :return: count of mentions of brand skus per chat id
+        """
+        rows = await self.session.execute(
+            select(BrandChatSummary.chat_id, func.sum(BrandChatSummary.mentions_count))
+            .join(Brand, BrandChatSummary.brand_id == Brand.brand_id)
+            .where(func.lower(Brand.name) == brand_name, BrandChatSummary.chat_id.in_(chat_ids))
+            .group_by(BrandChatSummary.chat_id)
+        )
+        return dict(rows.tuples().all())
+
+    async def get_brand_totals(self, brand_name: str) -> tuple[int, int] | None:
+        """
+        :param brand_name: lowercase brand name
+        :return: count of mentions of brand skus and count of chats with them, None if brand was never mentioned
+        """
+        rows = await self.session.execute(
+            select(func.sum(BrandChatSummary.mentions_count), func.count(BrandChatSummary.chat_id.distinct()))
+            .join(Brand, BrandChatSummary.brand_id == Brand.brand_id)
+            .where(func.lower(Brand.name) == brand_name)
+        )
+        mentions_count, chats_count = rows.one()
+        return None if mentions_count is None else (mentions_count, chats_count)
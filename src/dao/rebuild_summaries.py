@@ -0,0 +1,26 @@
+import sys
+from loguru import logger
+from src.dao.db_config import get_db
+from src.dao.mentions_db import MentionsDatabase
+
+
+def rebuild_summaries(database: MentionsDatabase, check_only: bool = False) -> list[str]:
+    """
+    recomputes mention summaries from raw tables and checks them against raw tables
+    :param database: connection with db
+    :param check_only: if True, summaries are only checked
+    :return: descriptions of inconsistent summaries
+    """
+    if not check_only:
+        logger.info('REBUILDING MENTION SUMMARIES')
+        database.rebuild_mention_summaries()
+    inconsistencies = database.check_mention_summaries()
+    for inconsistency in inconsistencies:
+        logger.warning(f'INCONSISTENT SUMMARY {inconsistency}')
+    logger.info(f'FOUND {len(inconsistencies)} INCONSISTENT SUMMARIES')
+    return inconsistencies
+
+
+if __name__ == '__main__':  # pragma: no cover
+    inconsistencies_ = rebuild_summaries(MentionsDatabase(next(get_db())), check_only='--check' in sys.argv[1:])
+    sys.exit(1 if inconsistencies_ else 0)
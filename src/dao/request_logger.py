@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+from typing import Callable, AsyncContextManager
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import REQUEST_LOG_FLUSH_INTERVAL, REQUEST_LOG_BATCH_SIZE, REQUEST_LOG_MAX_BACKLOG
+from src.dao.db_config import get_async_db
+from src.dao.users_db import Request, AsyncUserDatabase
+
+
+class RequestLogger:
+    """
+    Write-behind log of user requests. Requests and last_interaction_date bumps are queued in memory and written
+    in batches (AsyncUserDatabase.add_user_requests) every flush_interval seconds or when batch_size requests
+    are queued, so handlers of the bot don't wait for db. Queue is flushed on close, while db is unavailable
+    at most max_backlog requests are kept
+    """
+
+    def __init__(self, session_factory: Callable[[], AsyncContextManager[AsyncSession]] = get_async_db,
+                 flush_interval: float = REQUEST_LOG_FLUSH_INTERVAL, batch_size: int = REQUEST_LOG_BATCH_SIZE,
+                 max_backlog: int = REQUEST_LOG_MAX_BACKLOG):
+        """
+        :param session_factory: opens async session for one flush
+        :param flush_interval: seconds between flushes
+        :param batch_size: count of queued requests that triggers flush
+        :param max_backlog: max count of queued requests after failed flush, the oldest ones are dropped
+        """
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_backlog = max_backlog
+        self.requests: list[Request] = []
+        self.last_interactions: dict[str, datetime] = dict()
+        self.flush_lock = asyncio.Lock()
+        self.timer_task: asyncio.Task | None = None
+        self.flush_task: asyncio.Task | None = None  # flush triggered by batch_size
+
+    def log_request(self, request: Request) -> None:
+        """
+        queues request and bump of last_interaction_date of its user, doesn't touch db
+        :param request: request of user
+        """
+        self.requests.append(request)
+        self.bump_last_interaction(request.user_id, request.created_at)
+        # one pending flush takes everything queued, so requests logged while it waits don't spawn more flushes
+        if len(self.requests) >= self.batch_size and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self.flush())
+
+    def bump_last_interaction(self, user_id: str, interaction_date: datetime) -> None:
+        last_interaction = self.last_interactions.get(user_id)
+        if last_interaction is None or last_interaction < interaction_date:
+            self.last_interactions[user_id] = interaction_date
+
+    def start(self) -> None:
+        """
+        starts periodic flushes in running event loop
+        """
+        self.timer_task = asyncio.create_task(self.run_timer())
+
+    async def run_timer(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        writes queued requests with one insert and one update per user, on error they are queued again
+        """
+        async with self.flush_lock:
+            if len(self.requests) == 0 and len(self.last_interactions) == 0:
+                return
+            requests, self.requests = self.requests, []
+            last_interactions, self.last_interactions = self.last_interactions, dict()
+            try:
+                async with self.session_factory() as session:
+                    await AsyncUserDatabase(session).add_user_requests(requests, last_interactions)
+                # <editor-fold desc="log">
+                logger.debug(f'LOGGED {len(requests)} REQUESTS OF {len(last_interactions)} USERS')
+                # </editor-fold>
+            except Exception as e:
+                logger.error(f'ERROR OCCURRED WHILE LOGGING {len(requests)} REQUESTS {e}')
+                self.requests[:0] = requests
+                dropped_count = len(self.requests) - self.max_backlog
+                if dropped_count > 0:
+                    del self.requests[:dropped_count]
+                    logger.error(f'DROPPED {dropped_count} OLDEST REQUESTS, BACKLOG IS LIMITED BY {self.max_backlog}')
+                for user_id, interaction_date in last_interactions.items():
+                    self.bump_last_interaction(user_id, interaction_date)
+
+    async def close(self) -> None:
+        """
+        stops periodic flushes and writes everything that is queued
+        """
+        if self.timer_task is not None:
+            self.timer_task.cancel()
+            await asyncio.gather(self.timer_task, return_exceptions=True)
+        if self.flush_task is not None:
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
@@ -1,6 +1,9 @@
 import enum
 from datetime import datetime
-from sqlalchemy import Enum, MetaData, Column, Integer, String, DateTime, update
+from sqlalchemy import Enum, MetaData, Column, Integer, String, DateTime, update, select, Text, bindparam, Index, \
+    Insert, Boolean
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, Session
 
 metadata_obj = MetaData(schema='users')
@@ -41,7 +44,45 @@ class User(Base):
     first_name = Column(String)
     last_name = Column(String)
     created_at = Column(DateTime)
-    last_interaction_date = Column(DateTime)
+    last_interaction_date = Column(DateTime, index=True)  # broadcasts are sent to recently active users
+
+    def get_insert_dict(self) -> dict:
+        return {column.key: getattr(self, column.key) for column in User.__table__.columns
+                if column.key != 'id' and getattr(self, column.key) is not None}
+
+
+# users are added with upsert on user_id
+Index('ix_user_user_id', User.user_id, unique=True)
+
+
+class FsmState(Base):
+    """
+    State of conversation with user for aiogram fsm storage (src/bot/fsm_storage.py)
+    """
+
+    __tablename__ = 'fsm_state'
+
+    chat = Column(String, primary_key=True)
+    user = Column(String, primary_key=True)
+    state = Column(String)
+    data = Column(Text, nullable=False, default='{}')  # compact json
+    bucket = Column(Text, nullable=False, default='{}')
+    updated_at = Column(DateTime, nullable=False, index=True)
+
+
+class BroadcastDelivery(Base):
+    """
+    Progress of broadcast (src/bot/broadcast_message.py), one row per user the message was sent to or failed to be
+    sent to, so interrupted broadcast is resumed from remaining users
+    """
+
+    __tablename__ = 'broadcast_delivery'
+
+    broadcast = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    delivered = Column(Boolean, nullable=False)
+    error = Column(String)
+    created_at = Column(DateTime, nullable=False)
 
 
 class UserDatabase:
@@ -49,11 +90,18 @@ class UserDatabase:
     def __init__(self, session: Session):
         self.session = session
 
+    @staticmethod
+    def insert_user(user: User) -> Insert:
+        """
+        :return: insert of user that does nothing if user with such user_id exists
+        """
+        user_dict = user.get_insert_dict()
+        user_dict['user_id'] = str(user.user_id)
+        return insert(User).values(user_dict).on_conflict_do_nothing(index_elements=[User.user_id])
+
     def check_user(self, user):
-        user_from_db = self.session.query(User).filter(User.user_id == str(user.user_id)).one_or_none()
-        if user_from_db is None:
-            self.session.add(user)
-            self.session.commit()
+        self.session.execute(self.insert_user(user))
+        self.session.commit()
 
     def add_new_user_request(self, request):
         self.session.add(request)
@@ -68,3 +116,61 @@ class UserDatabase:
         )
         self.session.execute(stmt)
         self.session.commit()
+
+
+class AsyncUserDatabase:
+    """
+    UserDatabase for asyncio code (the bot)
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def check_user(self, user):
+        await self.session.execute(UserDatabase.insert_user(user))
+        await self.session.commit()
+
+    async def get_user_ids(self, active_since: datetime | None = None) -> list[str]:
+        """
+        :param active_since: only users with last_interaction_date after it, None for all users
+        :return: user_id of users
+        """
+        stmt = select(User.user_id)
+        if active_since is not None:
+            stmt = stmt.where(User.last_interaction_date >= active_since)
+        return list(await self.session.scalars(stmt))
+
+    async def get_broadcast_user_ids(self, broadcast: str) -> set[str]:
+        """
+        :return: user_id of users that broadcast was already sent to (or failed to be sent to)
+        """
+        return set(await self.session.scalars(select(BroadcastDelivery.user_id).
+                                              where(BroadcastDelivery.broadcast == broadcast)))
+
+    async def add_broadcast_deliveries(self, deliveries: list[dict]) -> None:
+        """
+        saves progress of broadcast, deliveries that are already saved are skipped
+        :param deliveries: dicts with BroadcastDelivery columns
+        """
+        if len(deliveries) == 0:
+            return
+        await self.session.execute(insert(BroadcastDelivery).values(deliveries).on_conflict_do_nothing())
+        await self.session.commit()
+
+    async def add_user_requests(self, requests: list[Request], last_interactions: dict[str, datetime]) -> None:
+        """
+        inserts batch of requests and updates last_interaction_date of their users in one transaction
+        :param requests: requests of users
+        :param last_interactions: time of the last interaction per user_id, one update per user
+        """
+        self.session.add_all(requests)
+        if len(last_interactions) != 0:
+            users = User.__table__
+            stmt = (
+                update(users).
+                where(users.c.user_id == bindparam('b_user_id')).
+                values(last_interaction_date=bindparam('b_last_interaction_date'))
+            )
+            await self.session.execute(stmt, [{'b_user_id': user_id, 'b_last_interaction_date': interaction_date}
+                                              for user_id, interaction_date in last_interactions.items()])
+        await self.session.commit()
@@ -1,6 +1,4 @@
 import asyncio
-import threading
-import time
 from abc import abstractmethod, ABC
 from dataclasses import dataclass
 from datetime import datetime
@@ -10,10 +8,10 @@ from opentele.tl import TelegramClient
 from telethon.errors import FloodWaitError
 from telethon.tl.types import Chat, ChatEmpty, Channel
 from telethon.tl.patched import Message
-from config import ROOT_DIR, THREAD_LOGGER_FORMAT, LOGGER_LEVEL
+from config import TG_SCAN_CONCURRENCY
 from src.dao.mentions_db import Chat
 from src.utils import format_message_to_print
-from src.parsers.telegram.utils import get_list_of_chat_ids, send_join_requests
+from src.parsers.telegram.utils import get_list_of_chat_ids, send_join_requests, FloodWaitScheduler
 
 
 class AbstractTgChatParser(ABC):
@@ -23,139 +21,215 @@ class AbstractTgChatParser(ABC):
 
     chats_type = None
 
-    def __init__(self, session_id: int, tg_chats_to_parse: list[Chat], start_date: datetime):
+    def __init__(self, session_id: int, tg_chats_to_parse: list[Chat], start_date: datetime,
+                 results_queue: asyncio.Queue | None = None):
         """
         :param session_id: id of telegram account, relevant api_id, api_hash must be passed to launch method
+        :param results_queue: results of every scanned chat are put into it and cleared from parser,
+        None to keep results of all chats in parser
         """
         self.client: TelegramClient | None = None  # client is created at parse() method
-        self.time_to_sleep: int = 0
+        self.flood_scheduler = FloodWaitScheduler()
         self.session_id = session_id
         self.chat_ids: set[int] = set()
         self.tg_chats_to_parse: list[Chat] = tg_chats_to_parse
         self.joined_chats_id: set[int] = set()
         self.chats: list[Chat] = list()
+        self.chat_numbers: dict[int, int] = dict()  # number of chat in self.chats per chat id, for logs
+        self.tg_chats_by_tg_id: dict[int, Chat] = dict()  # joined chats from tg_chats_to_parse, see fill_chats
         self.parsed_items: set = set()
         self.chats_count: int = 0
         self.total_message_counter: int = 0
         self.start_date: datetime = start_date
         self.processed_chats_id: set[int] = set()
-
-    def add_logger(self) -> None:
-        """
-        adds logger output to file
-        """
-        thread_id = threading.get_native_id()
-        output_log_file = f'{ROOT_DIR}/logs/{self.__class__.__name__}/Thread-{self.session_id}/' \
-                          f'{datetime.now().strftime("%d.%m.%Y_%H.%M")}/log.txt'
-        logger.debug(f'ADDING LOGGER TO {output_log_file}')
-        logger.add(output_log_file, format=THREAD_LOGGER_FORMAT, level=LOGGER_LEVEL,
-                   filter=lambda record: record['thread'].id == thread_id)
+        self.scanned_chats_id: set[int] = set()  # chats that are scanned or being scanned
+        self.scan_concurrency: int = TG_SCAN_CONCURRENCY
+        self.results_queue: asyncio.Queue | None = results_queue
 
     async def parse(self, anon_path: str, api_id: int, api_hash: str, proxy_config: dict[str, str]) -> set:
         """
         Resolves chat entities, joins them, scans and parses items from messages from chats.
-        The method will be called recursively after flood timeout if a FloodWaitError occurs when sending join requests.
+        Joins run in background task, on FloodWaitError only joins are parked (self.flood_scheduler) and resumed
+        when the wait expires, chats that are already joined are scanned meanwhile.
+        Parsers of all sessions run as tasks in one event loop, records of the log are bound to session_id.
         """
-        api = API.TelegramDesktop.Generate(unique_id=str(api_id))
-        self.client = TelegramClient(session=anon_path, api_id=api_id, api_hash=api_hash, proxy=proxy_config, api=api)
-        logger.debug('CONNECTING TO CLIENT')
-        async with self.client:
+        with logger.contextualize(session_id=self.session_id):
+            api = API.TelegramDesktop.Generate(unique_id=str(api_id))
+            self.client = TelegramClient(session=anon_path, api_id=api_id, api_hash=api_hash, proxy=proxy_config,
+                                         api=api)
+            logger.debug('CONNECTING TO CLIENT')
+            async with self.client:
+                # <editor-fold desc="log">
+                logger.info('STARTED')
+                # </editor-fold>
+                chats_to_scan = asyncio.Queue()
+                tg_chats_to_join = await self.fill_chats(chats_to_scan)
+                joining = asyncio.create_task(self.join_chats(tg_chats_to_join, chats_to_scan))
+                try:
+                    await self.process_chats(chats_to_scan)
+                    await joining
+                finally:
+                    joining.cancel()
+                    await asyncio.gather(joining, return_exceptions=True)
             # <editor-fold desc="log">
-            logger.info('STARTED')
+            logger.info('JOB DONE!')
             # </editor-fold>
-            await self.fill_chats()
-            await self.process_chats()
-
-            # if time_to_sleep != 0 means that we have caught FloodWaitError and
-            # there still chats to parse that we haven't joined (due to Flood)
-            if self.time_to_sleep != 0:  # pragma: no cover
-                time.sleep(self.time_to_sleep)
-                self.time_to_sleep = 0
-                # we don't care about return value because return value is field of self
-                _ = await self.parse(anon_path, api_id, api_hash, proxy_config)
-        # <editor-fold desc="log">
-        logger.info('JOB DONE!')
-        # </editor-fold>
         return self.parsed_items
 
-    async def fill_chats(self) -> None:
+    async def fill_chats(self, chats_to_scan: asyncio.Queue) -> list[Chat]:
         """
-        Method to get chat entities by tg_id or send join request using link.
-        Results stored in self.chats.
+        Gets chat entities of already joined chats by tg_id and puts them into chats_to_scan.
+        Joined chats are indexed by tg_id, chats that are joined later are added to the index by join_chats.
+        :return: chats to send join request to using link
         """
         tg_chat_ids = []
         tg_chats_to_join = []
         for tg_chat in self.tg_chats_to_parse:
             # tg_chat.tg_id is not None means we have received chat entity earlier, so we are already joined this chat
-            if tg_chat.tg_id is not None and tg_chat.tg_id not in self.processed_chats_id:
+            if tg_chat.tg_id is not None:
                 tg_chat_ids.append(int(tg_chat.tg_id))
+                self.index_tg_chat(tg_chat)
             else:  # pragma: no cover
                 tg_chats_to_join.append(tg_chat)
 
-        # we will not send extra requests on the next recursive calls because chats that were successfully parsed have
-        # tg_chat.tg_id and this ids will be in the self.processed_chats_id
-        try:
-            self.chats.extend(await send_join_requests(self.client, tg_chats_to_join, self.session_id))
-        except FloodWaitError as e:  # pragma: no cover
-            self.time_to_sleep = e.seconds
-
-        self.chats.extend(await self.client.get_entity(tg_chat_ids))
+        for chat in await self.client.get_entity(tg_chat_ids):
+            chats_to_scan.put_nowait(chat)
 
-        self.chats_count = len(self.chats)
+        self.chats_count = len(tg_chat_ids) + len(tg_chats_to_join)
         await self.get_chats_info()
         self.joined_chats_id = await get_list_of_chat_ids(self.client)
+        return tg_chats_to_join
 
-    async def process_chats(self):
+    async def join_chats(self, tg_chats_to_join: list[Chat], chats_to_scan: asyncio.Queue) -> None:
         """
-        Iterates over self.chats, calls scans_messages for chats that were not processed yet.
+        Sends join requests using links, joined chats are put into chats_to_scan as soon as they are joined,
+        None is put when all chats are processed
         """
-        for index, chat in enumerate(self.chats):
-            # <editor-fold desc="log">
-            logger.info(f'LOOKING FOR MESSAGES IN "{chat.title}" DATED FROM {self.start_date}')
-            # </editor-fold>
-            # if multiple links from db leads to same chat, or we already processed this chat earlier
-            if chat.id not in self.processed_chats_id:
-                await self.scan_messages(chat, self.start_date)
-                self.processed_chats_id.add(chat.id)
-            # <editor-fold desc="log">
-            logger.info(
-                f'TOTALLY PARSED {len(self.parsed_items)} UNIQUE ITEMS FROM {self.total_message_counter} MESSAGES '
-                f'FROM {index + 1} CHATS')
-            # </editor-fold>
+        try:
+            async for tg_chat, chat in send_join_requests(self.client, tg_chats_to_join, self.session_id,
+                                                          self.flood_scheduler):
+                self.index_tg_chat(tg_chat)
+                chats_to_scan.put_nowait(chat)
+        finally:
+            chats_to_scan.put_nowait(None)
+
+    async def process_chats(self, chats_to_scan: asyncio.Queue) -> None:
+        """
+        Takes chats from chats_to_scan until None, scans chats that were not scanned yet, at most scan_concurrency
+        chats are scanned at once. Chats are not taken from the queue while all scan slots are busy.
+        Scans overlap only while they await (telegram requests, http requests of parse_message in threads),
+        so parse_message must not block the loop.
+        """
+        slots = asyncio.Semaphore(self.scan_concurrency)
+        scans: set[asyncio.Task] = set()
+
+        def on_scan_done(scan: asyncio.Task) -> None:
+            scans.discard(scan)
+            slots.release()
+
+        try:
+            while (chat := await chats_to_scan.get()) is not None:
+                self.chats.append(chat)
+                self.chat_numbers.setdefault(chat.id, len(self.chats) - 1)
+                # if multiple links from db leads to same chat
+                if chat.id in self.scanned_chats_id:
+                    continue
+                self.scanned_chats_id.add(chat.id)
+                await slots.acquire()
+                scan = asyncio.create_task(self.scan_chat(chat))
+                scans.add(scan)
+                scan.add_done_callback(on_scan_done)
+            await asyncio.gather(*scans)
+        finally:
+            for scan in scans:
+                scan.cancel()
+            await asyncio.gather(*scans, return_exceptions=True)
+
+    async def scan_chat(self, chat) -> None:
+        """
+        Scans messages of chat, error of one chat doesn't stop scans of other chats, chat is not marked as processed
+        """
+        # <editor-fold desc="log">
+        logger.info(f'LOOKING FOR MESSAGES IN "{chat.title}" DATED FROM {self.start_date}')
+        # </editor-fold>
+        try:
+            await self.scan_messages(chat, self.start_date)
+        except Exception as e:
+            logger.error(f'ERROR OCCURRED WHILE SCANNING "{chat.title}": {e}')
+            logger.exception('')
+            return
+        self.processed_chats_id.add(chat.id)
+        # <editor-fold desc="log">
+        logger.info(f'TOTALLY PARSED {self.total_message_counter} MESSAGES FROM {len(self.processed_chats_id)} CHATS')
+        # </editor-fold>
+        await self.put_parser_results()
 
     async def scan_messages(self, chat, start_date):
         """
-        Iterates over messages in chat from older to newer starting from start_date.
+        Iterates over messages in chat from older to newer starting after checkpoint of the chat
+        (recent_parsed_post_tg_id), chats without checkpoint are scanned from start_date. When scan is finished
+        the checkpoint is moved to the last message, it is uploaded to db together with parsed items.
+        On FloodWaitError scans of the session are parked and the scan is resumed after the last scanned message.
         :param chat: chat for retrieving
-        :param start_date: messages after this date will be retrieved. exclusive.
+        :param start_date: messages after this date will be retrieved if chat has no checkpoint. exclusive.
         """
         message_counter = 0
-        chat_index = self.chats.index(chat)
-        parsed_usernames_counter_before = len(self.parsed_items)
-        async for message in self.client.iter_messages(chat, reverse=True, offset_date=start_date):
-            if message.message is None or message.message == '':
-                continue
-            message_counter = message_counter + 1
-            # <editor-fold desc="log">
-            logger.debug(
-                f'CHAT TITLE: {chat.title}({chat_index}/{self.chats_count}); ' +
-                message.date.strftime('DATE: %d.%m.%Y %H:%M UTC+0; MSG: ') +
-                format_message_to_print(message.message)
-            )
-            # </editor-fold>
-            parsed_items_from_message = self.parse_message(message)
-            self.parsed_items = self.parsed_items.union(parsed_items_from_message)
+        parsed_items_counter = 0
+        chat_index = self.chat_numbers.get(chat.id)
+        tg_chat = self.get_tg_chat_by_tg_id(chat.id)
+        checkpoint = tg_chat.recent_parsed_post_tg_id if tg_chat is not None else None
+        last_message_id = checkpoint
+        while True:
+            await self.flood_scheduler.wait('scan')
+            # reverse iteration returns messages with id greater than offset_id
+            offset = {'offset_date': start_date} if last_message_id is None else {'offset_id': last_message_id}
+            try:
+                async for message in self.client.iter_messages(chat, reverse=True, **offset):
+                    last_message_id = message.id
+                    if message.message is None or message.message == '':
+                        continue
+                    message_counter = message_counter + 1
+                    # <editor-fold desc="log">
+                    logger.debug(
+                        f'CHAT TITLE: {chat.title}({chat_index}/{self.chats_count}); ' +
+                        message.date.strftime('DATE: %d.%m.%Y %H:%M UTC+0; MSG: ') +
+                        format_message_to_print(message.message)
+                    )
+                    # </editor-fold>
+                    parsed_items_from_message = await self.parse_message(message)
+                    parsed_items_count_before = len(self.parsed_items)
+                    self.parsed_items.update(parsed_items_from_message)
+                    parsed_items_counter += len(self.parsed_items) - parsed_items_count_before
+                break
+            except FloodWaitError as e:
+                logger.warning(f'FLOOD WAIT OF {e.seconds} SECONDS WHILE SCANNING "{chat.title}"')
+                self.flood_scheduler.park('scan', e.seconds)
+        if tg_chat is not None and last_message_id != checkpoint:
+            tg_chat.recent_parsed_post_tg_id = last_message_id
+            tg_chat.update_required = True
         # <editor-fold desc="log">
         if message_counter == 0:
-            logger.warning(f'CHAT "{chat.title}" HAS NO TEXT MESSAGES SINCE {start_date}')
+            logger.warning(f'CHAT "{chat.title}" HAS NO NEW TEXT MESSAGES')
         # </editor-fold>
-        parsed_usernames_counter_after = len(self.parsed_items)
         # <editor-fold desc="log">
-        logger.info(f'PARSED {parsed_usernames_counter_after - parsed_usernames_counter_before} UNIQUE ITEMS '
+        logger.info(f'PARSED {parsed_items_counter} UNIQUE ITEMS '
                     f'FROM {message_counter} MESSAGES FROM "{chat.title}" CHAT')
         # </editor-fold>
         self.total_message_counter = self.total_message_counter + message_counter
 
+    def index_tg_chat(self, tg_chat: Chat) -> None:
+        """
+        Adds joined chat to self.tg_chats_by_tg_id, if multiple chats have the same tg_id, the first one is kept
+        """
+        if tg_chat.tg_id is not None:
+            self.tg_chats_by_tg_id.setdefault(int(tg_chat.tg_id), tg_chat)
+
+    def get_tg_chat_by_tg_id(self, tg_id: int) -> Chat | None:
+        """
+        :return: chat from self.tg_chats_to_parse with tg_id, None if there is no such chat or it is not indexed yet
+        """
+        return self.tg_chats_by_tg_id.get(tg_id)
+
     async def get_chats_info(self):
         """
         Iterates over user chats and adds id of each chat to self.chat_ids
@@ -167,10 +241,12 @@ class AbstractTgChatParser(ABC):
                 self.chat_ids.add(dialog.entity.id)
 
     @abstractmethod
-    def parse_message(self, message: Message):
+    async def parse_message(self, message: Message):
         """
         Resolves item(s) from message.
         Override is necessary.
+        Sessions share one event loop, so blocking calls (http requests) must be awaited with asyncio.to_thread,
+        state of parser is changed only in the loop.
         Returned value will be added to self.parsed_items set.
         So returned value must be hashable.
         :param message:
@@ -180,18 +256,13 @@ class AbstractTgChatParser(ABC):
 
     def launch(self, anon_path: str, api_id: int, api_hash: str, proxy_config: dict[str, str] | None) -> None:
         """
-        Launch async parse() function in new_event_loop()
+        Runs async parse() function of a single session, sessions are launched together by ParserLauncher
         :param anon_path: path to .session file
         :param api_id: api_id for account with same session_id that was passed to __init__
         :param api_hash: api_hash for account with same session_id that was passed to __init__
         :param proxy_config:
         """
-        if LOGGER_LEVEL != 'OFF':
-            self.add_logger()
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.parse(anon_path, api_id, api_hash, proxy_config))
-        loop.close()
+        asyncio.run(self.parse(anon_path, api_id, api_hash, proxy_config))
 
     def get_tg_chats_to_update(self) -> list[Chat]:
         """
@@ -215,6 +286,36 @@ class AbstractTgChatParser(ABC):
         def merge_with(self, another_parser_result) -> None:
             self.tg_chats_to_update.extend(another_parser_result.tg_chats_to_update)
 
+        @abstractmethod
+        def get_parsed_item_keys(self) -> set:
+            """
+            :return: keys of parsed items, amount of items parsed by a run is amount of unique keys of its results
+            """
+            pass
+
     @abstractmethod
     def get_parser_results(self) -> AbstractResult:
         pass
+
+    def take_parser_results(self) -> AbstractResult:
+        """
+        :return: results parsed since the previous call, they are cleared from parser
+        """
+        parser_results = self.get_parser_results()
+        self.clear_parsed_items()
+        return parser_results
+
+    async def put_parser_results(self) -> None:
+        """
+        Puts results parsed since the previous call into self.results_queue, waits while the queue is full,
+        so scans don't outrun upload. Does nothing if parser has no results_queue.
+        """
+        if self.results_queue is None:
+            return
+        await self.results_queue.put(self.take_parser_results())
+
+    def clear_parsed_items(self) -> None:
+        """
+        Clears everything get_parser_results is made of, except chats to update: they are kept until update
+        """
+        self.parsed_items = set()
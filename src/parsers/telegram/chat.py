@@ -1,3 +1,4 @@
+import asyncio
 import re
 from dataclasses import dataclass
 from datetime import datetime
@@ -19,11 +20,12 @@ class TgChatAdChatParser(AbstractTgChatParser):
 
     chats_type = ChatContentType.chat_ads
 
-    def __init__(self, session_id: int, tg_chats_to_parse: list[Chat], start_date: datetime):
-        super().__init__(session_id, tg_chats_to_parse, start_date)
+    def __init__(self, session_id: int, tg_chats_to_parse: list[Chat], start_date: datetime,
+                 results_queue: asyncio.Queue | None = None):
+        super().__init__(session_id, tg_chats_to_parse, start_date, results_queue)
         self.parsed_links: set[str] = set()
 
-    def parse_message(self, message: Message) -> list[Chat]:
+    async def parse_message(self, message: Message) -> list[Chat]:
         logger.debug(f'PARSING CHAT LINKS')
         links = set()
         for url_entity, inner_text in message.get_entities_text(MessageEntityTextUrl):
@@ -39,10 +41,12 @@ class TgChatAdChatParser(AbstractTgChatParser):
         logger.debug(f'PARSED {len(links)} FROM {message.id} MSG.ID: {links}')
         # </editor-fold>
 
+        links = list(links)
+        self.parsed_links.update(links)
+        # links are resolved concurrently in threads, other scans go on meanwhile
+        chat_infos = await asyncio.gather(*(asyncio.to_thread(get_chat_info_by_link, link) for link in links))
         resolved_tg_chats = []
-        for link in links:
-            self.parsed_links.add(link)
-            title, members_count = get_chat_info_by_link(link)
+        for link, (title, members_count) in zip(links, chat_infos):
             if title is not None and 'отзыв' not in title.lower():
                 resolved_tg_chats.append(Chat(link=link, chat_content=ChatContentType.wb_items_ads,
                                               title=title, followers=members_count, update_required=True))
@@ -72,10 +76,13 @@ class TgChatAdChatParser(AbstractTgChatParser):
 
         def merge_with(self, another_parser_result):
             super().merge_with(another_parser_result)
-            self.parsed_tg_chats = self.parsed_tg_chats.union(another_parser_result.parsed_tg_chats)
+            self.parsed_tg_chats.update(another_parser_result.parsed_tg_chats)
 
         def get_parsed_items_count(self):
             return len(self.parsed_tg_chats)
 
+        def get_parsed_item_keys(self) -> set:
+            return {tg_chat.link for tg_chat in self.parsed_tg_chats}
+
     def get_parser_results(self) -> Result:
         return TgChatAdChatParser.Result(self.get_tg_chats_to_update(), self.parsed_items)
@@ -1,11 +1,11 @@
 import asyncio
 import sys
-import threading
 from datetime import datetime, timedelta
 from typing import Type
 from loguru import logger
 from sqlalchemy import select
-from config import SESSIONS_FILE_PATH, SESSION_COUNT, API_IDS, API_HASHES, ROOT_DIR, THREAD_LOGGER_FORMAT, LOGGER_LEVEL
+from config import SESSIONS_FILE_PATH, SESSION_COUNT, API_IDS, API_HASHES, ROOT_DIR, SESSION_LOGGER_FORMAT, \
+    LOGGER_LEVEL, TG_UPLOAD_QUEUE_SIZE
 from src.dao.db_config import get_db
 from src.dao.mentions_db import MentionsDatabase
 from src.dao.mentions_db import Proxy
@@ -14,26 +14,28 @@ from src.parsers.telegram.sku import TgWbItemsAdChatParser
 from src.utils import divide_into_chunks
 from src.utils import split_joined_non_joined_chats
 
+# records that are not made by parser of some session
+logger.configure(extra={'session_id': '-'})
+
 
 class ParserLauncher:
 
     def __init__(self):
-        thread_id = threading.get_native_id()
         if LOGGER_LEVEL != 'OFF':  # pragma: no cover
             output_log_file = f'{ROOT_DIR}/logs/{self.__class__.__name__}/' \
                               f'{datetime.now().strftime("%d.%m.%Y_%H.%M")}/log.txt'
             logger.debug(f'ADDING LOGGER TO {output_log_file}')
-            logger.add(output_log_file, format=THREAD_LOGGER_FORMAT, level=LOGGER_LEVEL,
-                       filter=lambda record: record['thread'].id == thread_id)
+            logger.add(output_log_file, format=SESSION_LOGGER_FORMAT, level=LOGGER_LEVEL)
         self.session = next(get_db())
         self.database = MentionsDatabase(self.session)
 
     async def launch_all_parsers(self):
-        self.launch_tg_parsers(TgWbItemsAdChatParser, self.database.upload_wb_items_ad_parser_results)
+        await self.launch_tg_parsers(TgWbItemsAdChatParser, self.database.upload_wb_items_ad_parser_results)
 
-    def launch_tg_parsers(self, tg_parser_class: Type[AbstractTgChatParser], upload_parser_result_function):
+    async def launch_tg_parsers(self, tg_parser_class: Type[AbstractTgChatParser], upload_parser_result_function):
         """
-        Launches min(SESSION_COUNT, len(proxies)) threads with parsers, collects result and loads to database
+        Launches parsers of min(SESSION_COUNT, len(proxies)) sessions as tasks in running event loop,
+        results of every scanned chat are loaded to database by one writer task as soon as the chat is scanned
         :param tg_parser_class: class of parser to launch
         :param upload_parser_result_function: database function to load object type of SomeParser.Result
         """
@@ -43,11 +45,16 @@ class ParserLauncher:
         non_joined_tg_chats, session_id_chats = split_joined_non_joined_chats(tg_chats, SESSION_COUNT)
 
         parsers = []
-        threads = []
+        tasks = []
         proxies = self.database.session.execute(select(Proxy)).scalars().all()
-        threads_count = min(SESSION_COUNT, len(proxies))
-        logger.info(f'STARTING {threads_count} THREADS')
-        chunks = list(divide_into_chunks(non_joined_tg_chats, threads_count))
+        # chats are updated by primary key, detached chats are not expired by commits of every uploaded chat
+        self.database.session.expunge_all()
+        sessions_count = min(SESSION_COUNT, len(proxies))
+        logger.info(f'STARTING {sessions_count} SESSIONS')
+        chunks = list(divide_into_chunks(non_joined_tg_chats, sessions_count))
+        results_queue = asyncio.Queue(maxsize=TG_UPLOAD_QUEUE_SIZE)
+        writer = asyncio.create_task(self.upload_results(results_queue, upload_parser_result_function))
+        # chats with checkpoint (recent_parsed_post_tg_id) are scanned from it, start_date is for new chats
         start_date = datetime.now() - timedelta(days=1)
         for i, chunk in enumerate(chunks):
             session_id = i + 1
@@ -55,42 +62,92 @@ class ParserLauncher:
             session_file_path = rf'{ROOT_DIR}/{SESSIONS_FILE_PATH}/{session_id}/anon'
             if len(session_id_chats[session_id]) == 0:
                 continue
-            parser = tg_parser_class(session_id, session_id_chats[session_id], start_date)
+            parser = tg_parser_class(session_id, session_id_chats[session_id], start_date, results_queue)
             parsers.append(parser)
-            t = threading.Thread(name=f'Thread-{session_id}', target=parser.launch,
-                                 args=[session_file_path, API_IDS[session_id], API_HASHES[session_id],
-                                       proxies[i].get_http_config_dict()])
-            threads.append(t)
-            t.start()
+            tasks.append(asyncio.create_task(
+                self.run_parser(parser, session_file_path, API_IDS[session_id], API_HASHES[session_id],
+                                proxies[i].get_http_config_dict()),
+                name=f'Session-{session_id}'))
 
-        logger.debug('WAITING FOR THREADS')
-        for t in threads:
-            logger.debug(f'WAITING FOR {t.name}')
-            t.join()
+        logger.debug('WAITING FOR PARSERS')
+        try:
+            await asyncio.gather(*tasks)
+            await results_queue.put(None)
+            parsed_items_count = await writer
+        finally:
+            # parsers don't outlive the launcher if it is cancelled
+            for task in [*tasks, writer]:
+                task.cancel()
+            await asyncio.gather(*tasks, writer, return_exceptions=True)
 
-        logger.debug('ALL THREADS ARE HERE')
+        logger.debug('ALL PARSERS ARE DONE')
+        await asyncio.to_thread(self.database.publish_data_version)
 
-        parser_results = None
         total_scanned_messages = 0
         total_processed_chats = 0
         for parser in parsers:
             total_processed_chats = total_processed_chats + len(parser.processed_chats_id)
             total_scanned_messages = total_scanned_messages + parser.total_message_counter
-            if parser_results is None:
-                parser_results = parser.get_parser_results()
-            else:
-                parser_results.merge_with(parser.get_parser_results())
 
-        logger.info(f'TOTALLY PARSED {parser_results.get_parsed_items_count()} '
+        logger.info(f'TOTALLY PARSED {parsed_items_count} '
                     f'FROM {total_scanned_messages} MESSAGES '
                     f'FROM {total_processed_chats} CHATS')
 
-        logger.info('UPLOADING RESULTS TO DB')
-        upload_parser_result_function(parser_results)
+    async def upload_results(self, results_queue: asyncio.Queue, upload_parser_result_function) -> int:
+        """
+        Writer of parser results: uploads results from results_queue one by one until None.
+        Uploads run in a thread, so sync db calls don't block telegram sessions, only the writer uses self.database.
+        Result that failed to upload is rolled back and merged into the next one, so checkpoints of chats
+        are never committed without their items.
+        :return: amount of unique items in all results
+        """
+        parsed_item_keys = set()
+        failed_results = None
+        while (parser_results := await results_queue.get()) is not None:
+            if failed_results is not None:
+                failed_results.merge_with(parser_results)
+                parser_results = failed_results
+            parsed_item_keys.update(parser_results.get_parsed_item_keys())
+            failed_results = await asyncio.to_thread(self.upload_parser_results, parser_results,
+                                                     upload_parser_result_function)
+        if failed_results is not None and await asyncio.to_thread(self.upload_parser_results, failed_results,
+                                                                  upload_parser_result_function) is not None:
+            logger.error(f'{len(failed_results.get_parsed_item_keys())} PARSED ITEMS ARE NOT UPLOADED')
+        return len(parsed_item_keys)
+
+    def upload_parser_results(self, parser_results, upload_parser_result_function):
+        """
+        :return: None if results are uploaded, parser_results otherwise
+        """
+        # <editor-fold desc="log">
+        logger.debug(f'UPLOADING {parser_results.get_parsed_items_count()} ITEMS TO DB')
+        # </editor-fold>
+        try:
+            upload_parser_result_function(parser_results)
+        except Exception as e:
+            logger.error(f'ERROR OCCURRED WHILE UPLOADING RESULTS: {e}')
+            logger.exception('')
+            self.database.rollback()
+            return parser_results
+        return None
+
+    @staticmethod
+    async def run_parser(parser: AbstractTgChatParser, anon_path: str, api_id: int, api_hash: str,
+                         proxy_config: dict[str, str] | None) -> None:
+        """
+        runs parser of one session, error of the session doesn't stop other sessions,
+        items parsed before the error and updates of chats that were not scanned are uploaded
+        """
+        try:
+            await parser.parse(anon_path, api_id, api_hash, proxy_config)
+        except Exception as e:
+            logger.error(f'SESSION {parser.session_id} FAILED: {e}')
+            logger.exception('')
+        await parser.put_parser_results()
 
 
 if __name__ == '__main__':  # pragma: no cover
     logger.remove()
-    logger.add(sys.stdout, format=THREAD_LOGGER_FORMAT)
+    logger.add(sys.stdout, format=SESSION_LOGGER_FORMAT)
     p_l = ParserLauncher()
     asyncio.run(p_l.launch_all_parsers())
@@ -1,3 +1,6 @@
+import asyncio
+import time
+from typing import AsyncIterator, Callable, Awaitable
 from loguru import logger
 from opentele.tl import TelegramClient
 from telethon.errors import FloodWaitError, UserAlreadyParticipantError
@@ -26,8 +29,49 @@ async def get_list_of_chat_ids(client: TelegramClient) -> set[int]:
     return chat_ids
 
 
-async def send_join_requests(client, tg_chats, session_id):  # pragma: no cover
-    joined_chats = []
+class FloodWaitScheduler:
+    """
+    Parks kinds of telegram requests (e.g. joins) that hit flood limit. Request of parked kind waits in its own task
+    until flood wait expires and is retried on the same connection, requests of other kinds are not affected
+    """
+
+    def __init__(self):
+        self.parked_until: dict[str, float] = dict()
+
+    async def request(self, kind: str, make_request: Callable[[], Awaitable]):
+        """
+        :param kind: kind of request, flood wait parks all requests of this kind
+        :param make_request: makes request, is called again after flood wait
+        :return: result of request
+        """
+        while True:
+            await self.wait(kind)
+            try:
+                return await make_request()
+            except FloodWaitError as e:
+                logger.warning(f'FLOOD WAIT OF {e.seconds} SECONDS ON {kind.upper()} REQUEST')
+                self.park(kind, e.seconds)
+
+    async def wait(self, kind: str) -> None:
+        """
+        waits until flood wait of kind of requests expires, returns at once if kind is not parked
+        """
+        while (delay := self.parked_until.get(kind, 0) - time.monotonic()) > 0:
+            # <editor-fold desc="log">
+            logger.info(f'{kind.upper()} REQUESTS ARE PARKED FOR {delay:.0f} SECONDS')
+            # </editor-fold>
+            await asyncio.sleep(delay)
+
+    def park(self, kind: str, seconds: float) -> None:
+        self.parked_until[kind] = max(self.parked_until.get(kind, 0), time.monotonic() + seconds)
+
+
+async def send_join_requests(client, tg_chats, session_id,
+                             scheduler: FloodWaitScheduler) -> AsyncIterator:  # pragma: no cover
+    """
+    joins chats one by one, flood waits are handled by scheduler, so joins are resumed after them
+    :return: pairs of chat from tg_chats (tg_id is set) and its joined chat entity, as soon as the chat is joined
+    """
     for tg_chat in tg_chats:
         link = tg_chat.link
         # <editor-fold desc="log">
@@ -38,15 +82,17 @@ async def send_join_requests(client, tg_chats, session_id):  # pragma: no cover
             request = ImportChatInviteRequest(hash_to_join)
         else:
             request = JoinChannelRequest(link)
-        chat = await send_join_request(client, request, link)
+        chat = await send_join_request(client, request, link, scheduler)
         if chat is not None:
             chat_full_info = None
             if tg_chat.followers is None and tg_chat.chat_content == ChatContentType.wb_items_ads:
                 if isinstance(chat, Channel):
-                    chat_full_info = await client(GetFullChannelRequest(chat.id))
+                    chat_full_info = await scheduler.request(
+                        'full_info', lambda: make_request(client, GetFullChannelRequest(chat.id)))
                     tg_chat.followers = chat_full_info.full_chat.participants_count
                 elif isinstance(chat, Chat):
-                    chat_full_info = await client(GetFullChatRequest(chat.id))
+                    chat_full_info = await scheduler.request(
+                        'full_info', lambda: make_request(client, GetFullChatRequest(chat.id)))
                     tg_chat.followers = len(chat_full_info.users)
                 if chat_full_info is None:
                     logger.warning(f'COULD NOT RESOLVE FULL INFO FOR {chat.title} WITH LINK {link}')
@@ -56,17 +102,16 @@ async def send_join_requests(client, tg_chats, session_id):  # pragma: no cover
 
             tg_chat.session_id = session_id
             tg_chat.update_required = True
-            joined_chats.append(chat)
-    return joined_chats
+            yield tg_chat, chat
 
 
-async def send_join_request(client, request, invite_link):  # pragma: no cover
+async def send_join_request(client, request, invite_link, scheduler: FloodWaitScheduler):  # pragma: no cover
     joined_chat = None
     try:
         # <editor-fold desc="log">
         logger.debug(f'SENDING JOIN REQUEST USING {invite_link}')  # pragma: no cover
         # </editor-fold>
-        result = await make_request(client, request)
+        result = await scheduler.request('join', lambda: make_request(client, request))
         # <editor-fold desc="log">
         logger.debug('GOT RESULT')  # pragma: no cover
         # </editor-fold>
@@ -80,8 +125,6 @@ async def send_join_request(client, request, invite_link):  # pragma: no cover
         # <editor-fold desc="log">
         logger.debug(f'CHAT {joined_chat.title} WAS ALREADY JOINED BEFORE')  # pragma: no cover
         # </editor-fold>
-    except FloodWaitError:
-        raise
     except Exception as e:
         # <editor-fold desc="log">
         logger.warning(f'SOME ERROR OCCURRED WHILE PROCESSING LINK {invite_link}: {e}')  # pragma: no cover
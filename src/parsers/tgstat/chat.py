@@ -9,7 +9,7 @@ from loguru import logger
 from requests import JSONDecodeError
 from requests.exceptions import ProxyError
 from sqlalchemy import exc as sa_exc
-from config import PROCESS_LOGGER_FORMAT, LOGGER_LEVEL
+from config import PROCESS_LOGGER_FORMAT, LOGGER_LEVEL, BULK_LOAD_BATCH_SIZE
 from src.dao.db_config import get_db
 from src.dao.mentions_db import SkuPerPost, Sku, Post, MentionsDatabase, Proxy, ChatContentType, Chat
 from src.parsers.tgstat.utils import get_tgstat_url, get_value_from_icon_element, \
@@ -20,11 +20,14 @@ from src.utils.wb_utils import wb_sku_pattern, wb_size_pattern, wb_link_pattern
 
 class ChannelParser:
 
-    def __init__(self, start_date: datetime, database: MentionsDatabase, proxy: dict[str, str]):
+    def __init__(self, start_date: datetime, database: MentionsDatabase, proxy: dict[str, str],
+                 bulk_load: bool = False):
         """
         :param start_date: will parse posts later this date
         :param database: connection with db
         :param proxy: proxy for requests library
+        :param bulk_load: if True, posts are accumulated and loaded with COPY in batches of BULK_LOAD_BATCH_SIZE,
+        meant for full history backfills
         """
 
         logger.remove()
@@ -43,6 +46,8 @@ class ChannelParser:
         self.chat = None
         self.chats = None
         self.parsed_sku_db_instances = dict()
+        self.bulk_load = bulk_load
+        self.posts_to_load: set[Post] = set()
 
         self.earliest_post_date = datetime.now()
         self.recent_parsed_post_tg_id = None
@@ -98,31 +103,41 @@ class ChannelParser:
         self.chats = chats
         self.total_processed_chat_count = 0
 
-        for chat in chats:
+        try:
+            for chat in chats:
+                try:
+                    self.total_processed_chat_count = self.total_processed_chat_count + 1
+                    # <editor-fold desc="log info">
+                    logger.info(f'PARSING #{self.total_processed_chat_count}/{len(chats)} '
+                                f'CHANNEL {chat.title} WITH URL: {chat.link}')  # pragma: no cover
+                    # </editor-fold>
+                    self.process_chat(chat)
+                    if self.bulk_load:
+                        self.load_posts()
+                    # <editor-fold desc="log stat"> # pragma: no cover
+                    logger.info(f'DONE PARSING CHANNEL {chat.title} WITH URL: {chat.link}')   # pragma: no cover
+                    logger.info(f'PARSED AND LOADED TO DB {self.parsed_posts_count_from_channel} POSTS'
+                                f' WITH {self.parsed_mentions_count_from_chat} '
+                                f'MENTIONS IN CURRENT CHANNEL')  # pragma: no cover
+                    logger.info(f'PROCESSED {self.processed_posts_count_from_channel} '
+                                f'POSTS IN CURRENT CHANNEL')  # pragma: no cover
+                    # </editor-fold>
+                except Exception as e:
+                    logger.error(f'ERROR OCCURRED {e}')
+                    # uncommitted posts of the failed chat are dropped
+                    self.database.rollback()
+                    raise
+            logger.info('ALL CHANNELS WERE PARSED')
+            logger.info(f'TOTAL PARSED AND LOADED TO DB {self.total_parsed_posts_count} POSTS '
+                        f'WITH {self.total_parsed_mentions_count} MENTIONS')
+            logger.info(f'TOTAL {self.total_processed_posts_count} POSTS PROCESSED')
+            logger.info(f'ELAPSED TIME: {datetime.now() - self.parser_start_time}')
+        finally:
+            # mentions committed before an error are published too
             try:
-                self.total_processed_chat_count = self.total_processed_chat_count + 1
-                # <editor-fold desc="log info">
-                logger.info(f'PARSING #{self.total_processed_chat_count}/{len(chats)} '
-                            f'CHANNEL {chat.title} WITH URL: {chat.link}')  # pragma: no cover
-                # </editor-fold>
-                self.process_chat(chat)
-                # <editor-fold desc="log stat"> # pragma: no cover
-                logger.info(f'DONE PARSING CHANNEL {chat.title} WITH URL: {chat.link}')   # pragma: no cover
-                logger.info(f'PARSED AND LOADED TO DB {self.parsed_posts_count_from_channel} POSTS'
-                            f' WITH {self.parsed_mentions_count_from_chat} '
-                            f'MENTIONS IN CURRENT CHANNEL')  # pragma: no cover
-                logger.info(f'PROCESSED {self.processed_posts_count_from_channel} '
-                            f'POSTS IN CURRENT CHANNEL')  # pragma: no cover
-                # </editor-fold>
-            except Exception as e:
-                logger.error(f'ERROR OCCURRED {e}')
-                raise
-        logger.info('ALL CHANNELS WERE PARSED')
-        logger.info(f'TOTAL PARSED AND LOADED TO DB {self.total_parsed_posts_count} POSTS '
-                    f'WITH {self.total_parsed_mentions_count} MENTIONS')
-        logger.info(f'TOTAL {self.total_processed_posts_count} POSTS PROCESSED')
-        logger.info(f'ELAPSED TIME: {datetime.now() - self.parser_start_time}')
-        self.session.close()
+                self.database.publish_data_version()
+            finally:
+                self.session.close()
 
     def process_chat(self, chat: Chat) -> None:
         """
@@ -187,11 +202,6 @@ class ChannelParser:
         posts = soup.find_all('div', {'class': 'post-container'})
         self.process_posts(posts)
 
-        if self.chat.update_required:
-            logger.debug(f'UPDATING TGCHAT {self.chat.link}; RPPID: {self.chat.recent_parsed_post_tg_id}')
-            self.database.update_tg_chat(self.chat)
-            logger.debug(f'CHAT WAS UPDATED')
-
         more_button = soup.find('div', {'class': 'lm-button-container'})
         if more_button is not None:
             page_for_request = more_button.find_next('input', {'class': 'lm-page'})['value']
@@ -247,13 +257,6 @@ class ChannelParser:
         next_page = json_response['nextPage']
         next_offset = json_response['nextOffset']
 
-        if self.chat.update_required:
-            # <editor-fold desc="log">
-            logger.debug(f'UPDATING TGCHAT {self.chat}; '
-                         f'RPPID: {self.chat.recent_parsed_post_tg_id}')   # pragma: no cover
-            # </editor-fold>
-            self.database.update_tg_chat(self.chat)
-
         if has_next and self.earliest_post_date > self.start_date \
                 and (self.recent_parsed_post_tg_id is None
                      or self.recent_parsed_post_tg_id > self.previous_recent_parsed_post_tg_id):
@@ -278,11 +281,49 @@ class ChannelParser:
 
         self.total_parsed_posts_count = self.total_parsed_posts_count + len(parsed_posts)
 
+        if self.bulk_load:
+            self.posts_to_load.update(parsed_posts)
+            if len(self.posts_to_load) >= BULK_LOAD_BATCH_SIZE:
+                self.load_posts()
+            return
+
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', category=sa_exc.SAWarning)
             new_posts_count, new_mentions_count = \
                 self.database.upload_tg_posts_to_db(parsed_posts, self.parsed_sku_db_instances)
-            self.database.session.commit()
+            if self.chat.update_required:
+                # <editor-fold desc="log">
+                logger.debug(f'UPDATING TGCHAT {self.chat.link}; '
+                             f'RPPID: {self.chat.recent_parsed_post_tg_id}')  # pragma: no cover
+                # </editor-fold>
+                self.database.add_tg_chat_to_update(self.chat)
+            # posts and chat checkpoint are committed together, once per page
+            self.database.flush_tg_chat_updates()
+            self.database.commit()
+
+        self.parsed_posts_count_from_channel += new_posts_count
+        self.parsed_mentions_count_from_chat += new_mentions_count
+        self.total_parsed_mentions_count += new_mentions_count
+
+    def load_posts(self) -> None:
+        """
+        loads accumulated posts with COPY in bulk load mode, commits them with chat checkpoint
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=sa_exc.SAWarning)
+            new_posts_count, new_mentions_count = self.database.copy_posts_to_db(self.posts_to_load)
+            if self.chat.update_required:
+                # <editor-fold desc="log">
+                logger.debug(f'UPDATING TGCHAT {self.chat.link}; '
+                             f'RPPID: {self.chat.recent_parsed_post_tg_id}')  # pragma: no cover
+                # </editor-fold>
+                self.database.add_tg_chat_to_update(self.chat)
+            self.database.flush_tg_chat_updates()
+            self.database.commit()
+        # <editor-fold desc="log">
+        logger.debug(f'BULK LOADED {new_posts_count} POSTS WITH {new_mentions_count} MENTIONS')  # pragma: no cover
+        # </editor-fold>
+        self.posts_to_load = set()
 
         self.parsed_posts_count_from_channel += new_posts_count
         self.parsed_mentions_count_from_chat += new_mentions_count
@@ -3,7 +3,7 @@ from datetime import datetime
 from multiprocessing import Process
 from loguru import logger
 from sqlalchemy import select
-from config import LOGGER_LEVEL, PROCESS_LOGGER_FORMAT
+from config import LOGGER_LEVEL, PROCESS_LOGGER_FORMAT, BULK_LOAD
 from src.dao.db_config import get_db
 from src.dao.mentions_db import MentionsDatabase, ChatContentType, Chat
 from src.dao.mentions_db import Proxy
@@ -22,7 +22,8 @@ def launch_parser(chats: list[Chat], proxy: dict[str, str] | None) -> None:
 
     database = MentionsDatabase(next(get_db()))
     start_date = datetime.min
-    cp = ChannelParser(start_date=start_date, database=database, proxy=proxy)
+    # parsing from datetime.min backfills whole history of chats, BULK_LOAD turns on COPY uploads for it
+    cp = ChannelParser(start_date=start_date, database=database, proxy=proxy, bulk_load=BULK_LOAD)
 
     cp.process_chats(chats)
 
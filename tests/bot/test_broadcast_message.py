@@ -0,0 +1,131 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from aiogram.utils.exceptions import RetryAfter, BotBlocked, NetworkError
+from src.bot.broadcast_message import Broadcaster, TokenBucket
+
+
+class FakeUserDatabase:
+    """
+    AsyncUserDatabase replacement that keeps broadcast deliveries in memory
+    """
+
+    def __init__(self):
+        self.deliveries: dict[tuple[str, str], dict] = dict()
+
+    async def get_broadcast_user_ids(self, broadcast: str) -> set[str]:
+        return {user_id for delivery_broadcast, user_id in self.deliveries if delivery_broadcast == broadcast}
+
+    async def add_broadcast_deliveries(self, deliveries: list[dict]) -> None:
+        for delivery in deliveries:
+            self.deliveries.setdefault((delivery['broadcast'], delivery['user_id']), delivery)
+
+
+def get_database_factory(database: FakeUserDatabase):
+    @asynccontextmanager
+    async def open_database():
+        yield database
+    return open_database
+
+
+class TestTokenBucket:
+
+    def test_rate(self):
+        async def acquire_tokens():
+            bucket = TokenBucket(rate=100, capacity=10)
+            start = time.monotonic()
+            for _ in range(30):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        # 10 tokens of burst, 20 tokens are refilled in 0.2 seconds
+        assert 0.15 < asyncio.run(acquire_tokens()) < 0.5
+
+    def test_pause(self):
+        async def acquire_after_pause():
+            bucket = TokenBucket(rate=100, capacity=10)
+            bucket.pause(0.2)
+            start = time.monotonic()
+            await bucket.acquire()
+            return time.monotonic() - start
+
+        assert asyncio.run(acquire_after_pause()) >= 0.2
+
+
+class TestBroadcaster:
+
+    def test_retry_after_is_rescheduled(self):
+        database = FakeUserDatabase()
+        sent = []
+        flooded = set()
+
+        async def send(user_id: int) -> None:
+            if user_id % 3 == 0 and user_id not in flooded:
+                flooded.add(user_id)
+                raise RetryAfter(0.01)
+            if user_id == 7:
+                raise BotBlocked('Forbidden: bot was blocked by the user')
+            sent.append(user_id)
+
+        broadcaster = Broadcaster('test', send, get_database_factory(database), rate=1000, concurrency=5,
+                                  progress_batch_size=4)
+        asyncio.run(broadcaster.run([str(user_id) for user_id in range(1, 21)]))
+
+        assert sorted(sent) == [user_id for user_id in range(1, 21) if user_id != 7]
+        assert broadcaster.rescheduled_count == 6
+        assert len(database.deliveries) == 20
+        assert database.deliveries[('test', '7')]['delivered'] is False
+        assert all(delivery['delivered'] for key, delivery in database.deliveries.items() if key != ('test', '7'))
+
+    def test_interrupted_broadcast_is_resumed(self):
+        database = FakeUserDatabase()
+        sent = []
+
+        async def send(user_id: int) -> None:
+            if user_id == 5:
+                raise KeyboardInterrupt
+            sent.append(user_id)
+
+        broadcaster = Broadcaster('test', send, get_database_factory(database), rate=1000, concurrency=1,
+                                  progress_batch_size=100)
+        try:
+            asyncio.run(broadcaster.run([str(user_id) for user_id in range(1, 11)]))
+        except KeyboardInterrupt:
+            pass
+        # progress is saved on interruption
+        assert sorted(user_id for _, user_id in database.deliveries) == ['1', '2', '3', '4']
+
+        async def send_rest(user_id: int) -> None:
+            sent.append(user_id)
+
+        asyncio.run(Broadcaster('test', send_rest, get_database_factory(database), rate=1000).
+                    run([str(user_id) for user_id in range(1, 11)]))
+
+        assert sent == list(range(1, 11))
+        assert len(database.deliveries) == 10
+
+    def test_transient_errors_are_retried_on_resume(self):
+        database = FakeUserDatabase()
+        sent = []
+
+        async def send(user_id: int) -> None:
+            if user_id == 2:
+                raise NetworkError('Aiohttp client throws an error: ServerDisconnectedError')
+            if user_id == 3:
+                raise BotBlocked('Forbidden: bot was blocked by the user')
+            sent.append(user_id)
+
+        broadcaster = Broadcaster('test', send, get_database_factory(database), rate=1000)
+        asyncio.run(broadcaster.run(['1', '2', '3']))
+
+        assert (broadcaster.failed_count, broadcaster.transient_failed_count) == (1, 1)
+        # only permanent failure is saved
+        assert sorted(user_id for _, user_id in database.deliveries) == ['1', '3']
+
+        async def send_rest(user_id: int) -> None:
+            sent.append(user_id)
+
+        asyncio.run(Broadcaster('test', send_rest, get_database_factory(database), rate=1000).run(['1', '2', '3']))
+
+        assert sent == [1, 2]
+        assert database.deliveries[('test', '2')]['delivered'] is True
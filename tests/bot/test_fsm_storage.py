@@ -0,0 +1,81 @@
+import asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from src.bot.fsm_storage import DatabaseStorage
+from src.dao.users_db import FsmState
+from tests.conftest import *
+
+
+class TestDatabaseStorage:
+
+    def test_state_and_data(self, async_db_engine, db_session):
+        storage = DatabaseStorage(async_db_engine)
+
+        async def fill_storage():
+            await storage.set_state(chat=1, user=1, state='UserStates:EnterSKU')
+            await storage.set_data(chat=1, user=1, data={'query': 'Бренд', 'page_cursors': [None, [1, None, 2, 0]]})
+            await storage.update_data(chat=1, user=1, data={'current_page': 2})
+            return await storage.get_state(chat=1, user=1), await storage.get_data(chat=1, user=1)
+
+        state, data = asyncio.run(fill_storage())
+
+        assert state == 'UserStates:EnterSKU'
+        assert data == {'query': 'Бренд', 'page_cursors': [None, [1, None, 2, 0]], 'current_page': 2}
+
+        # another storage (bot worker) sees the same state
+        assert asyncio.run(DatabaseStorage(async_db_engine).get_data(chat=1, user=1)) == data
+
+        # finished state is deleted
+        asyncio.run(storage.finish(chat=1, user=1))
+        assert db_session().execute(select(FsmState)).scalars().all() == []
+
+    def test_concurrent_updates_of_missing_state(self, async_db_engine):
+        storages = [DatabaseStorage(async_db_engine) for _ in range(2)]
+
+        async def update_concurrently():
+            await asyncio.gather(*(storages[i % 2].update_data(chat=1, user=1, data={f'key_{i}': i})
+                                   for i in range(10)))
+            return await storages[0].get_data(chat=1, user=1)
+
+        # updates of the state that doesn't exist yet are not lost
+        assert asyncio.run(update_concurrently()) == {f'key_{i}': i for i in range(10)}
+
+    def test_ttl(self, async_db_engine, db_session):
+        storage = DatabaseStorage(async_db_engine, ttl=0)
+
+        async def set_and_cleanup():
+            await storage.set_data(chat=1, user=1, data={'current_page': 1})
+            return await storage.get_data(chat=1, user=1), await storage.cleanup()
+
+        data, deleted_count = asyncio.run(set_and_cleanup())
+
+        assert data == {}
+        assert deleted_count == 1
+        assert db_session().execute(select(FsmState)).scalars().all() == []
+
+    def test_sqlite(self, tmp_path):
+        engine = create_async_engine(f'sqlite+aiosqlite:///{tmp_path / "fsm.db"}')
+        storage = DatabaseStorage(engine)
+
+        async def fill_storage():
+            await storage.create_table()
+            await storage.set_state(chat=1, user=1, state='UserStates:EnterBrand')
+            await storage.set_data(chat=1, user=1, data={'query': 'Бренд'})
+            await storage.update_data(chat=1, user=1, data={'current_page': 2})
+            await storage.update_bucket(chat=1, user=1, bucket={'requests': 1})
+            result = (await storage.get_state(chat=1, user=1), await storage.get_data(chat=1, user=1),
+                      await storage.get_bucket(chat=1, user=1))
+            await storage.reset_state(chat=1, user=1)
+            await storage.set_bucket(chat=1, user=1, bucket={})
+            async with storage.session_factory() as session:
+                states_count = len((await session.scalars(select(FsmState))).all())
+            await engine.dispose()
+            return *result, states_count
+
+        state, data, bucket, states_count = asyncio.run(fill_storage())
+
+        assert state == 'UserStates:EnterBrand'
+        assert data == {'query': 'Бренд', 'current_page': 2}
+        assert bucket == {'requests': 1}
+        # empty state is deleted
+        assert states_count == 0
@@ -0,0 +1,80 @@
+import asyncio
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp.test_utils import TestServer
+from src.bot.metrics import Histogram, HandlerMetrics, HandlerTimings, LatencyMiddleware, TimedBot, measure, \
+    current_timings
+from tests.bot.test_webhook import FakeBotApi, TEST_TOKEN, get_update
+
+
+class TestHistogram:
+
+    def test_observe(self):
+        histogram = Histogram((0.1, 1))
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value)
+
+        assert histogram.bucket_counts == [2, 1, 1]
+        assert histogram.count == 4 and histogram.sum == 2.65
+        assert histogram.get_quantile_bound(0.5) == 0.1
+        assert histogram.get_quantile_bound(0.75) == 1
+        assert histogram.get_quantile_bound(1) == float('inf')
+
+
+class TestMeasure:
+
+    def test_nested_phases(self):
+        async def measure_phases():
+            timings = HandlerTimings()
+            current_timings.set(timings)
+            with measure('render'):
+                await asyncio.sleep(0.02)
+                with measure('db'):
+                    await asyncio.sleep(0.05)
+            return timings
+
+        timings = asyncio.run(measure_phases())
+
+        # time of nested db phase is not counted in render phase
+        assert 0.04 < timings.phases['db'] < 0.1
+        assert 0.01 < timings.phases['render'] < 0.04
+
+    def test_outside_handler(self):
+        with measure('db'):
+            pass
+        assert current_timings.get() is None
+
+
+class TestLatencyMiddleware:
+
+    def test_handler_phases(self):
+        metrics = HandlerMetrics()
+
+        async def handle_text(message: types.Message) -> None:
+            with measure('render'):
+                await asyncio.sleep(0.02)
+            await message.bot.send_message(message.chat.id, message.text)
+
+        async def process_updates():
+            fake_api = FakeBotApi()
+            async with TestServer(fake_api.app) as api_server:
+                bot = TimedBot(TEST_TOKEN, server=TelegramAPIServer.from_base(str(api_server.make_url(''))))
+                dp = Dispatcher(bot)
+                dp.middleware.setup(LatencyMiddleware(metrics))
+                dp.register_message_handler(handle_text)
+                Bot.set_current(bot)
+                for i in range(3):
+                    await dp.process_update(types.Update.to_object(get_update(i, 'text')))
+                await (await bot.get_session()).close()
+
+        asyncio.run(process_updates())
+
+        assert metrics.histograms[('handle_text', 'total')].count == 3
+        assert metrics.histograms[('handle_text', 'render')].sum >= 0.06
+        assert metrics.histograms[('handle_text', 'send')].sum > 0
+        assert metrics.histograms[('handle_text', 'db')].sum == 0
+        assert metrics.queries['handle_text'] == 0
+        prometheus_text = metrics.render_prometheus()
+        assert 'bot_handler_seconds_count{handler="handle_text",phase="total"} 3' in prometheus_text
+        assert 'bot_handler_queries_total{handler="handle_text"} 0' in prometheus_text
+        assert metrics.get_summary()[0].startswith('handle_text: 3 calls')
@@ -0,0 +1,189 @@
+import asyncio
+import datetime
+import json
+from src.bot.pagination import SkuMentionsQuery, BrandMentionsQuery, MentionsQuery, PageCursors, \
+    get_page_by_number, PAGE_CURSORS_LIMIT
+from src.dao.mentions_db import Chat, Post, SkuPerPost, SkuSummary, get_post_key
+
+
+class FakeMentionsDatabase:
+    """
+    AsyncMentionsDatabase replacement with keyset pagination over mentions dict
+    """
+
+    def __init__(self, mentions: dict[Chat, dict[Post, set[SkuPerPost]]]):
+        self.mentions = mentions
+        self.posts = [(chat, post, post_mentions) for chat, posts in mentions.items()
+                      for post, post_mentions in posts.items()]
+        self.queries = 0
+
+    def get_chat_mentions_counts(self, chat_ids: set[int], count_post) -> dict[int, int]:
+        return {chat.id: sum(count_post(post_mentions) for post_mentions in posts.values())
+                for chat, posts in self.mentions.items() if chat.id in chat_ids}
+
+    def get_mentions_page(self, after: tuple | None, posts_limit: int) -> dict:
+        self.queries += 1
+        page = [(chat, post, post_mentions) for chat, post, post_mentions in self.posts
+                if after is None or get_post_key(post) > after][:posts_limit]
+        mentions_dict = {}
+        for chat, post, post_mentions in page:
+            mentions_dict.setdefault(chat, {})[post] = post_mentions
+        return mentions_dict
+
+    async def get_sku_summary(self, sku_code: int) -> SkuSummary | None:
+        if len(self.posts) == 0:
+            return None
+        return SkuSummary(sku_code=sku_code, mentions_count=len(self.posts), chats_count=len(self.mentions))
+
+    async def get_mentions_page_by_sku(self, sku_code: int, after: tuple | None, posts_limit: int) -> dict:
+        return self.get_mentions_page(after, posts_limit)
+
+    async def get_sku_chat_mentions_counts(self, sku_code: int, chat_ids: set[int]) -> dict[int, int]:
+        return self.get_chat_mentions_counts(chat_ids, lambda post_mentions: 1)
+
+    async def get_brand_totals(self, brand_name: str) -> tuple[int, int] | None:
+        return sum(len(post_mentions) for _, _, post_mentions in self.posts), len(self.mentions)
+
+    async def get_mentions_page_by_brand(self, brand_name: str, after: tuple | None, posts_limit: int) -> dict:
+        return self.get_mentions_page(after, posts_limit)
+
+    async def get_brand_chat_mentions_counts(self, brand_name: str, chat_ids: set[int]) -> dict[int, int]:
+        return self.get_chat_mentions_counts(chat_ids, len)
+
+
+def get_test_mentions(chats_count: int, posts_count: int, skus_count: int) -> dict:
+    """
+    :return: mentions dict with chats_count chats, posts_count posts in every chat, skus_count skus in every post
+    """
+    mentions = {}
+    for chat_id in range(1, chats_count + 1):
+        chat = Chat(obj_id=chat_id, tg_id=str(chat_id), link=f't.me/chat_{chat_id}', title=f'chat {chat_id}')
+        posts = mentions.setdefault(chat, {})
+        for i in range(posts_count):
+            post_id = chat_id * 10000 + i
+            post = Post(id=post_id, chat_id=chat_id, message_id=str(i),
+                        date=datetime.datetime(2020, 1, 1) + datetime.timedelta(days=i))
+            posts[post] = {SkuPerPost(sku_code=sku_code, post_id=post_id) for sku_code in range(skus_count)}
+    return mentions
+
+
+def render_full_reply(query: MentionsQuery, mentions: dict) -> str:
+    """
+    renders whole reply at once from mentions dict, pages are expected to be cuts of it
+    """
+    mentions_count = sum(len(post_mentions) if isinstance(query, BrandMentionsQuery) else 1
+                         for posts in mentions.values() for post_mentions in posts.values())
+    parts = [query.render_header(mentions_count, len(mentions))]
+    for chat, posts in mentions.items():
+        chat_mentions_count = sum(len(post_mentions) if isinstance(query, BrandMentionsQuery) else 1
+                                  for post_mentions in posts.values())
+        parts.append(query.render_chat_header(chat, chat_mentions_count))
+        last_post_index = len(posts) - 1
+        for i, (post, post_mentions) in enumerate(posts.items()):
+            parts.append(query.render_post(chat, post, post_mentions, i == last_post_index))
+    return ''.join(parts)
+
+
+def render_all_pages(query: MentionsQuery, database: FakeMentionsDatabase) -> list[str]:
+    """
+    renders pages one by one following cursors, as the bot does
+    """
+    async def render():
+        pages = []
+        cursor = None
+        while True:
+            page = await query.render_page(database, cursor)
+            pages.append(page.text)
+            if page.next_cursor is None:
+                return pages
+            cursor = page.next_cursor
+    return asyncio.run(render())
+
+
+def show_pages(query: MentionsQuery, database: FakeMentionsDatabase, page_numbers: list[int]) -> \
+        tuple[list[str], list[list]]:
+    """
+    shows pages in given order keeping cursors in dumped state between pages, as the bot does
+    :return: texts of pages and states after every page
+    """
+    async def show():
+        texts, states = [], []
+        state, pages_count = [], None
+        for page_number in page_numbers:
+            page_cursors = PageCursors(json.loads(json.dumps(state)))
+            page_number, page = await get_page_by_number(
+                page_cursors, page_number, lambda cursor: query.render_page(database, cursor))
+            if page.next_cursor is None:
+                pages_count = page_number
+            page_cursors.trim(page_number, pages_count)
+            state = page_cursors.dump()
+            texts.append(page.text)
+            states.append(state)
+        return texts, states
+    return asyncio.run(show())
+
+
+class TestPagination:
+
+    def test_sku_pages_match_full_reply(self):
+        mentions = get_test_mentions(chats_count=5, posts_count=70, skus_count=1)
+        database = FakeMentionsDatabase(mentions)
+
+        pages = render_all_pages(SkuMentionsQuery('10'), database)
+
+        assert ''.join(pages) == render_full_reply(SkuMentionsQuery('10'), mentions)
+        assert all(len(page) <= 4096 for page in pages)
+
+    def test_brand_pages_match_full_reply(self):
+        mentions = get_test_mentions(chats_count=3, posts_count=60, skus_count=3)
+        database = FakeMentionsDatabase(mentions)
+
+        pages = render_all_pages(BrandMentionsQuery('Brand'), database)
+
+        assert ''.join(pages) == render_full_reply(BrandMentionsQuery('Brand'), mentions)
+        assert all(len(page) <= 4096 for page in pages)
+
+    def test_post_longer_than_page(self):
+        mentions = get_test_mentions(chats_count=1, posts_count=2, skus_count=200)
+        database = FakeMentionsDatabase(mentions)
+
+        pages = render_all_pages(BrandMentionsQuery('Brand'), database)
+
+        assert len(pages) > 2
+        assert ''.join(pages) == render_full_reply(BrandMentionsQuery('Brand'), mentions)
+        for page in pages:
+            assert page.count('<a ') == page.count('</a>')
+
+    def test_not_mentioned_sku(self):
+        pages = render_all_pages(SkuMentionsQuery('10'), FakeMentionsDatabase({}))
+        assert pages == ['Артикул <i>10</i> не упоминался ни в одном канале.']
+
+    def test_first_page_doesnt_load_all_posts(self):
+        database = FakeMentionsDatabase(get_test_mentions(chats_count=10, posts_count=1000, skus_count=1))
+
+        asyncio.run(SkuMentionsQuery('10').render_page(database, None))
+
+        # first page fits about 70 posts, so only two of 200 batches of posts are requested
+        assert database.queries == 2
+
+    def test_state_size_doesnt_grow_with_pages(self):
+        database = FakeMentionsDatabase(get_test_mentions(chats_count=10, posts_count=200, skus_count=1))
+        pages = render_all_pages(SkuMentionsQuery('10'), database)
+        forward = list(range(1, len(pages)))
+
+        texts, states = show_pages(SkuMentionsQuery('10'), database, forward)
+
+        assert len(pages) > 2 * PAGE_CURSORS_LIMIT
+        assert texts == pages[:-1]
+        assert {len(state) for state in states[PAGE_CURSORS_LIMIT:]} == {PAGE_CURSORS_LIMIT}
+
+    def test_pages_out_of_state_are_found_again(self):
+        database = FakeMentionsDatabase(get_test_mentions(chats_count=10, posts_count=200, skus_count=1))
+        pages = render_all_pages(SkuMentionsQuery('10'), database)
+        # forward to the last page, wrap to the first one, back to the last one and further back
+        page_numbers = list(range(1, len(pages) + 1)) + [1, len(pages)] + list(range(len(pages) - 1, 0, -1))
+
+        texts, states = show_pages(SkuMentionsQuery('10'), database, page_numbers)
+
+        assert texts == [pages[page_number - 1] for page_number in page_numbers]
+        assert max(len(state) for state in states) <= PAGE_CURSORS_LIMIT + 1
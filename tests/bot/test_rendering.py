@@ -0,0 +1,38 @@
+import datetime
+from src.bot.rendering import render_sku_header, render_sku_chat_header, render_sku_post, render_brand_post, \
+    split_fragment, get_html_element_spans
+from src.dao.mentions_db import Chat, Post, SkuPerPost
+
+
+class TestRendering:
+
+    def test_render_sku_fragments(self):
+        chat = Chat(tg_id='1', link='t.me/chat', title='chat')
+        post = Post(chat_id=1, message_id='0', date=datetime.datetime(2020, 1, 1))
+
+        assert render_sku_header('10', 2, 1) == '<b>Артикул <a href="wb.ru/catalog/10/detail.aspx">10</a> ' \
+                                                'упоминался <i>2</i> раза в <i>1</i> канале:</b>'
+        assert render_sku_chat_header(chat, 2) == '\n\n<i>2</i> упоминания в канале <a href="t.me/chat">"chat"</a>:'
+        assert render_sku_post(chat, post, False) == f'\n<a href="t.me/c/1/0">Пост</a> от {post.date};'
+        assert render_sku_post(chat, post, True) == f'\n<a href="t.me/c/1/0">Пост</a> от {post.date}.'
+
+    def test_render_brand_post(self):
+        chat = Chat(tg_id='1', link='t.me/chat', title='chat')
+        post = Post(chat_id=1, message_id='0', date=datetime.datetime(2020, 1, 1))
+        post_mentions = {SkuPerPost(sku_code=11, post_id=0), SkuPerPost(sku_code=10, post_id=0)}
+
+        assert render_brand_post(chat, post, post_mentions) == \
+            f'\n<a href="t.me/c/1/0">Пост</a> от {post.date}:\nАртикулы: ' \
+            '<a href="wb.ru/catalog/10/detail.aspx">10</a>; <a href="wb.ru/catalog/11/detail.aspx">11</a>.'
+
+    def test_split_fragment(self):
+        fragment = 'text ' * 10 + '<a href="link">' + 'x' * 20 + '</a>' + '\nend'
+        pieces = list(split_fragment(fragment, limit=60))
+
+        assert ''.join(pieces) == fragment
+        assert pieces[0] == 'text ' * 10
+        assert all(len(piece) <= 60 for piece in pieces)
+
+    def test_get_html_element_spans(self):
+        text = '<b>a <a href="x">b</a></b> c </i><i>d</i>'
+        assert get_html_element_spans(text) == [(0, 26), (33, 41)]
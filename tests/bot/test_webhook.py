@@ -0,0 +1,134 @@
+import asyncio
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from src.bot.webhook import WebhookUpdateHandler, create_webhook_app, SECRET_TOKEN_HEADER
+
+TEST_TOKEN = '123456:test'
+
+
+class FakeBotApi:
+    """
+    local telegram bot api, records called methods and replies to sendMessage
+    """
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls.append((method, params))
+        result = {'message_id': len(self.calls), 'date': 0, 'chat': {'id': int(params['chat_id']), 'type': 'private'},
+                  'text': params.get('text')}
+        return web.json_response({'ok': True, 'result': result})
+
+    def get_sent_texts(self) -> list[str]:
+        return [params['text'] for method, params in self.calls if method == 'sendMessage']
+
+
+def get_update(update_id: int, text: str) -> dict:
+    user = {'id': 1, 'is_bot': False, 'first_name': 'user'}
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'from': user, 'chat': {'id': 1, 'type': 'private'},
+                        'text': text}}
+
+
+def run_webhook(handle_message, updates: list[dict], max_concurrent_updates: int = 10,
+                secret_token: str | None = None, headers: dict | None = None, events: list[str] | None = None):
+    """
+    posts updates to webhook app concurrently and shuts the app down
+    :param handle_message: message handler of the bot
+    :param events: list to record events of app lifecycle into, handler can add its own events
+    :return: statuses of webhook responses, fake bot api, events of app lifecycle
+    """
+    events = [] if events is None else events
+
+    async def on_startup(_: Dispatcher) -> None:
+        events.append('startup')
+
+    async def on_shutdown(_: Dispatcher) -> None:
+        events.append('shutdown')
+
+    async def run():
+        fake_api = FakeBotApi()
+        async with TestServer(fake_api.app) as api_server:
+            bot = Bot(TEST_TOKEN, server=TelegramAPIServer.from_base(str(api_server.make_url(''))))
+            dp = Dispatcher(bot, storage=MemoryStorage())
+            dp.register_message_handler(handle_message)
+            handler = WebhookUpdateHandler(dp, max_concurrent_updates=max_concurrent_updates,
+                                           secret_token=secret_token)
+            app = create_webhook_app(handler, on_startup=on_startup, on_shutdown=on_shutdown)
+            async with TestClient(TestServer(app)) as client:
+                responses = await asyncio.gather(*[client.post('/webhook', json=update, headers=headers)
+                                                   for update in updates])
+                statuses = [response.status for response in responses]
+                events.append('responded')
+            await (await bot.get_session()).close()
+        return statuses, fake_api
+
+    statuses_, fake_api_ = asyncio.run(run())
+    return statuses_, fake_api_, events
+
+
+class TestWebhook:
+
+    def test_updates_are_processed(self):
+        async def echo(message: types.Message) -> None:
+            await message.bot.send_message(message.chat.id, message.text)
+
+        statuses, fake_api, events = run_webhook(echo, [get_update(i, f'text {i}') for i in range(5)])
+
+        assert statuses == [200] * 5
+        assert sorted(fake_api.get_sent_texts()) == [f'text {i}' for i in range(5)]
+        assert events == ['startup', 'responded', 'shutdown']
+
+    def test_updates_are_acknowledged_before_processing(self):
+        events = []
+
+        async def slow_echo(message: types.Message) -> None:
+            await asyncio.sleep(0.2)
+            await message.bot.send_message(message.chat.id, message.text)
+            events.append('processed')
+
+        statuses, fake_api, _ = run_webhook(slow_echo, [get_update(1, 'text')], events=events)
+
+        assert statuses == [200]
+        # update in progress is processed on shutdown before on_shutdown is called
+        assert fake_api.get_sent_texts() == ['text']
+        assert events == ['startup', 'responded', 'processed', 'shutdown']
+
+    def test_concurrent_updates_are_bounded(self):
+        in_progress = 0
+        max_in_progress = 0
+
+        async def slow_handler(message: types.Message) -> None:
+            nonlocal in_progress, max_in_progress
+            in_progress += 1
+            max_in_progress = max(max_in_progress, in_progress)
+            await asyncio.sleep(0.05)
+            in_progress -= 1
+
+        statuses, _, _ = run_webhook(slow_handler, [get_update(i, 'text') for i in range(10)],
+                                     max_concurrent_updates=3)
+
+        assert statuses == [200] * 10
+        assert max_in_progress == 3
+
+    def test_secret_token(self):
+        async def echo(message: types.Message) -> None:
+            await message.bot.send_message(message.chat.id, message.text)
+
+        statuses, fake_api, _ = run_webhook(echo, [get_update(1, 'text')], secret_token='secret',
+                                            headers={SECRET_TOKEN_HEADER: 'wrong'})
+        assert statuses == [401]
+        assert fake_api.get_sent_texts() == []
+
+        statuses, fake_api, _ = run_webhook(echo, [get_update(1, 'text')], secret_token='secret',
+                                            headers={SECRET_TOKEN_HEADER: 'secret'})
+        assert statuses == [200]
+        assert fake_api.get_sent_texts() == ['text']
@@ -5,7 +5,8 @@ import sqlalchemy
 from loguru import logger
 from pytest_postgresql import factories
 from pytest_postgresql.janitor import DatabaseJanitor
-from sqlalchemy import create_engine, Connection
+from sqlalchemy import create_engine, Connection, NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 import src
 from config import TEST_LOGGER_LEVEL
@@ -53,6 +54,25 @@ def db_session(monkeypatch, test_db):
             yield sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
 
 
+@pytest.fixture(scope='function')
+def async_db_engine(db_session):
+    """
+    async engine of test_db, schema is created by db_session
+    :param db_session: fixture with sync connection to test_db
+    """
+    # connections are not pooled, as every test runs its coroutines in new event loop
+    yield create_async_engine(src.dao.db_config.DB_CONFIG.ASYNC_DB_URI, poolclass=NullPool)
+
+
+@pytest.fixture(scope='function')
+def async_db_session(async_db_engine):
+    """
+    establishes async connection to test_db
+    :param async_db_engine: fixture with async engine of test_db
+    """
+    yield async_sessionmaker(async_db_engine, autoflush=False, expire_on_commit=False)
+
+
 @pytest.fixture(scope='function', autouse=True)
 def logger_level_for_tests(monkeypatch) -> str:
     """
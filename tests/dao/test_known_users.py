@@ -0,0 +1,32 @@
+import asyncio
+from src.dao.known_users import KnownUsers
+
+
+class FakeUserDatabase:
+
+    def __init__(self, user_ids: list[str]):
+        self.user_ids = user_ids
+
+    async def get_user_ids(self) -> list[str]:
+        return self.user_ids
+
+
+class TestKnownUsers:
+
+    def test_warm_up(self):
+        known_users = KnownUsers([5])
+        asyncio.run(known_users.warm_up(FakeUserDatabase(['3', '1', '-100', '3', 'not_an_id'])))
+
+        assert list(known_users.user_ids) == [-100, 1, 3, 5]
+        assert 3 in known_users and 5 in known_users and -100 in known_users
+        assert 2 not in known_users and 6 not in known_users
+
+    def test_add(self):
+        known_users = KnownUsers()
+        assert 1 not in known_users
+
+        for user_id in [3, 1, 2, 1]:
+            known_users.add(user_id)
+
+        assert list(known_users.user_ids) == [1, 2, 3]
+        assert len(known_users) == 3
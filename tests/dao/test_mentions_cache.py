@@ -0,0 +1,75 @@
+import asyncio
+from contextlib import asynccontextmanager
+from src.dao.mentions_cache import MentionsCache
+
+
+class FakeMentionsDatabase:
+    """
+    AsyncMentionsDatabase replacement that counts lookups
+    """
+
+    def __init__(self):
+        self.data_version = 0
+        self.lookups = 0
+
+    @asynccontextmanager
+    async def open(self):
+        yield self
+
+    async def get_data_version(self) -> int:
+        return self.data_version
+
+
+async def load_page(database: FakeMentionsDatabase, request: str) -> list[str]:
+    database.lookups += 1
+    return [request, str(database.lookups)]
+
+
+def get_all(cache: MentionsCache, *requests: str) -> list:
+    """
+    looks up requests one by one
+    """
+    async def lookup():
+        return [await cache.get(('page', request), load_page, request) for request in requests]
+    return asyncio.run(lookup())
+
+
+class TestMentionsCache:
+
+    def test_hit_and_miss(self):
+        database = FakeMentionsDatabase()
+        cache = MentionsCache(database.open, max_size=10, ttl=60, version_check_interval=0)
+
+        first, second, _ = get_all(cache, '1', '1', '2')
+        assert second is first
+
+        assert database.lookups == 2
+        assert cache.get_stats() == {'size': 2, 'hits': 1, 'misses': 2, 'evictions': 0}
+
+    def test_lru_eviction(self):
+        database = FakeMentionsDatabase()
+        cache = MentionsCache(database.open, max_size=2, ttl=60, version_check_interval=0)
+
+        get_all(cache, '1', '2', '1', '3')  # '3' evicts '2' as least recently used
+
+        assert list(cache.entries.keys()) == [('page', '1'), ('page', '3')]
+        assert cache.evictions == 1
+
+    def test_ttl(self):
+        database = FakeMentionsDatabase()
+        cache = MentionsCache(database.open, max_size=10, ttl=0, version_check_interval=0)
+
+        get_all(cache, '1', '1')
+
+        assert database.lookups == 2
+
+    def test_data_version_invalidates_entries(self):
+        database = FakeMentionsDatabase()
+        cache = MentionsCache(database.open, max_size=10, ttl=60, version_check_interval=0)
+
+        get_all(cache, '1')
+        database.data_version += 1
+        get_all(cache, '1')
+
+        assert database.lookups == 2
+        assert cache.get_stats()['size'] == 1
@@ -1,7 +1,12 @@
+import asyncio
 import datetime
+import re
+from contextlib import contextmanager
 import time
-from sqlalchemy import select
-from src.dao.mentions_db import Post, Chat, ChatContentType, Sku, Brand, MentionsDatabase, SkuPerPost, Proxy
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session
+from src.dao.mentions_db import Post, Chat, ChatContentType, Sku, Brand, MentionsDatabase, SkuPerPost, Proxy, \
+    SkuChatSummary, AsyncMentionsDatabase, get_post_key, PostRecord
 from src.parsers.telegram.chat import TgChatAdChatParser
 from src.parsers.telegram.sku import TgWbItemsAdChatParser
 from tests.conftest import *
@@ -82,6 +87,37 @@ def mentions_test_objs(chat_test_objs, db_session) -> list[SkuPerPost]:
     return mentions
 
 
+@contextmanager
+def count_queries(session) -> list[str]:
+    """
+    collects statements executed by session engine inside the context
+    :param session: session to watch
+    :return: list of executed statements
+    """
+    statements = []
+
+    def collect_statement(_conn, _cursor, statement, *_):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, 'before_cursor_execute', collect_statement)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', collect_statement)
+
+
+def touch_mentions_dict(mentions_dict: dict) -> None:
+    """
+    reads every attribute the bot uses while rendering mentions dict
+    :param mentions_dict: dict with mentions per posts per chats
+    """
+    for chat, posts in mentions_dict.items():
+        for post, mentions in posts.items():
+            _ = chat.link, chat.title, chat.tg_id, post.message_id, post.date
+            _ = [mention.sku_code for mention in mentions]
+
+
 class TestBrand:
 
     def test_repr(self):
@@ -131,6 +167,22 @@ class TestPost:
         assert post_2 != not_post
 
 
+class TestPostRecord:
+
+    def test_eq(self):
+        post = PostRecord(chat_id=1, message_id='1', sku_codes=frozenset({10}), views_count=5)
+        assert post == PostRecord(chat_id=1, message_id='1', sku_codes=frozenset({11}))
+        assert post != PostRecord(chat_id=1, message_id='2', sku_codes=frozenset({10}))
+        assert len({post, PostRecord(chat_id=1, message_id='1', sku_codes=frozenset())}) == 1
+
+    def test_get_insert_dict(self):
+        post = PostRecord(chat_id=1, message_id='3', sku_codes=frozenset({10}), views_count=5, er=1.5)
+        assert post.get_insert_dict() == Post(chat_id='1', message_id=3, views_count=5, replies_count=0,
+                                              shared_count=0, comments_count=0, reactions_count=0,
+                                              er=1.5).get_insert_dict()
+        assert not hasattr(post, '__dict__')
+
+
 class TestSku:
 
     def test_repr(self):
@@ -218,25 +270,19 @@ class TestMentionsDatabase:
         chat = Chat(tg_id='1', link='t.me/+link1', chat_content=ChatContentType.wb_items_ads)
 
         mdb.session.add(chat)
+        mdb.session.flush()
 
-        post = Post(chat_id=chat.id, message_id='1')
-        post_duplicate = Post(chat_id=chat.id, message_id='1')
+        # sku 72136920 will be loaded to db as it is present wb sku, sku 1 will not be loaded
+        post = PostRecord(chat_id=chat.id, message_id='1', sku_codes=frozenset({72136920, 1}))
+        post_duplicate = PostRecord(chat_id=chat.id, message_id='1', sku_codes=frozenset({72136920, 1}))
         posts_set = {post, post_duplicate}
 
-        sku = Sku(sku_code=72136920)  # this sku will be loaded to db as it is present wb sku
-        sku.sku_per_post.append(SkuPerPost(sku_code=sku.sku_code, post=post))
-
-        sku_2 = Sku(sku_code=1)  # this sku will not be loaded to db as it is not present wb sku
-        sku_2.sku_per_post.append(SkuPerPost(sku_code=sku_2.sku_code, post=post))
-
-        skus_dict = {sku.sku_code: sku, sku_2.sku_code: sku_2}
-
         chat.recent_parsed_post_tg_id = post.message_id
         chat.update_required = True
 
         parser_result = TgWbItemsAdChatParser.Result(
             parsed_posts=posts_set,
-            parsed_skus=skus_dict,
+            parsed_sku_codes={72136920, 1},
             parsed_tg_chats=set(),
             tg_chats_to_update=[chat]
         )
@@ -252,7 +298,7 @@ class TestMentionsDatabase:
         # test if correct skus were loaded
         actual_mentions = mdb.session.execute(select(SkuPerPost)).scalars().all()
         assert len(actual_mentions) == 1
-        assert actual_mentions[0].sku_code == sku.sku_code
+        assert actual_mentions[0].sku_code == 72136920
 
         # test that chat was updated
         updated_chat_from_db = mdb.session.execute(select(Chat).where(Chat.tg_id == chat.tg_id)).one_or_none()[0]
@@ -263,6 +309,65 @@ class TestMentionsDatabase:
         assert len(mdb.session.execute(select(Post)).scalars().all()) == 1
         pass
 
+    def test_checkpoints_are_not_committed_without_posts(self, chat_test_objs, db_session, monkeypatch):
+        mdb = MentionsDatabase(db_session(), chat_update_batch_size=1)
+        chat = mdb.session.execute(select(Chat).where(Chat.tg_id == '1')).scalars().one()
+        chat.recent_parsed_post_tg_id = 100
+        chat.update_required = True
+        parser_result = TgWbItemsAdChatParser.Result(tg_chats_to_update=[chat], parsed_tg_chats=set(),
+                                                     parsed_posts=set(), parsed_sku_codes=set())
+
+        def fail_upload(*_):
+            raise ConnectionError('db is down')
+
+        monkeypatch.setattr(mdb, 'upload_tg_posts_to_db', fail_upload)
+        with pytest.raises(ConnectionError):
+            mdb.upload_wb_items_ad_parser_results(parser_result)
+        mdb.session.rollback()
+
+        # checkpoint is not moved past posts that were not uploaded
+        session = db_session()
+        assert session.execute(select(Chat.recent_parsed_post_tg_id).where(Chat.tg_id == '1')).scalar_one() is None
+
+    def test_checkpoints_are_retried_after_failed_commit(self, chat_test_objs, db_session, monkeypatch):
+        mdb = MentionsDatabase(db_session())
+        chat = chat_test_objs[0]
+        chat.recent_parsed_post_tg_id = 100
+        chat.update_required = True
+        parser_result = TgWbItemsAdChatParser.Result(tg_chats_to_update=[chat], parsed_tg_chats=set(),
+                                                     parsed_posts=set(), parsed_sku_codes=set())
+        commit = mdb.session.commit
+        commits = []
+
+        def fail_first_commit():
+            commits.append(1)
+            if len(commits) == 1:
+                raise ConnectionError('connection is lost')
+            commit()
+
+        monkeypatch.setattr(mdb.session, 'commit', fail_first_commit)
+        with pytest.raises(ConnectionError):
+            mdb.upload_wb_items_ad_parser_results(parser_result)
+        mdb.rollback()
+
+        # chat was flushed, but not committed, so it is updated by the retry
+        assert chat.update_required
+        mdb.upload_wb_items_ad_parser_results(parser_result)
+        assert not chat.update_required
+        session = db_session()
+        assert session.execute(select(Chat.recent_parsed_post_tg_id).where(Chat.id == chat.id)).scalar_one() == 100
+
+    def test_chat_changed_after_flush_stays_update_required(self, chat_test_objs, mdb):
+        chat = chat_test_objs[0]
+        chat.recent_parsed_post_tg_id = 100
+        chat.update_required = True
+        mdb.add_tg_chat_to_update(chat)
+        mdb.flush_tg_chat_updates()
+        # e.g. scan of the chat is finished while its previous checkpoint is uploaded
+        chat.recent_parsed_post_tg_id = 200
+        mdb.commit()
+        assert chat.update_required
+
     def test_upload_chat_ad_parser_result(self, chat_test_objs, db_session):
         parsed_tg_chats = {
             Chat(tg_id='4', link='t.me/+link4', chat_content=ChatContentType.chat_ads),  # this chat is duplicate
@@ -311,6 +416,95 @@ class TestMentionsDatabase:
             len(chat_test_objs) + len(extra_chats_to_load) - len(extra_chats_to_load.intersection(chat_test_objs))
         assert actual_chats_in_db_len == expected_chats_in_db_len
 
+    def test_upload_chats_to_db_skips_duplicates_in_batch(self, chat_test_objs, mdb):
+        extra_chats_to_load = {
+            Chat(tg_id='5', link='t.me/+link5', chat_content=ChatContentType.chat_ads),
+            Chat(tg_id='5', link='t.me/link5', chat_content=ChatContentType.chat_ads),  # same chat by tg_id
+            Chat(link='t.me/+link1', chat_content=ChatContentType.wb_items_ads),  # already present in db
+        }
+
+        mdb.upload_chats_to_db(extra_chats_to_load)
+        mdb.session.commit()
+
+        actual_chats_in_db_len = len(mdb.session.execute(select(Chat)).scalars().all())
+        assert actual_chats_in_db_len == len(chat_test_objs) + 1
+
+    def test_upload_tg_posts_to_db(self, mentions_test_objs, chat_test_objs, mdb, requests_mock):
+        requests_mock.get(re.compile(r'https://card\.wb\.ru/cards/detail'), json={'data': {'products': []}})
+
+        chat_id = chat_test_objs[0].id
+        post_duplicate = Post(chat_id=chat_id, message_id='1')  # post with message_id 1 is already in db
+        post = Post(chat_id=str(chat_id), message_id='3')
+        skus = {10: Sku(sku_code=10), 11: Sku(sku_code=11)}
+        for sku in skus.values():
+            sku.sku_per_post.append(SkuPerPost(sku_code=sku.sku_code, post=post))
+        skus[10].sku_per_post.append(SkuPerPost(sku_code=10, post=post_duplicate))
+
+        assert mdb.upload_tg_posts_to_db({post, post_duplicate}, skus) == (1, 2)
+        mdb.session.commit()
+
+        # second upload of the same posts doesn't add anything
+        assert mdb.upload_tg_posts_to_db({post, post_duplicate}, skus) == (0, 0)
+
+        loaded_post = mdb.session.execute(
+            select(Post).where(Post.chat_id == chat_id, Post.message_id == '3')).scalars().one()
+        assert {mention.sku_code for mention in loaded_post.sku_per_post} == {10, 11}
+        assert len(mdb.session.execute(select(SkuPerPost)).scalars().all()) == len(mentions_test_objs) + 2
+
+    # COPY is written by psycopg2 and psycopg 3 cursors differently
+    @pytest.mark.parametrize('db_uri', ['DB_URI', 'ASYNC_DB_URI'])
+    def test_copy_posts_to_db(self, mentions_test_objs, chat_test_objs, db_session, requests_mock, db_uri):
+        engine = create_engine(getattr(src.dao.db_config.DB_CONFIG, db_uri), poolclass=NullPool)
+        assert engine.dialect.driver == ('psycopg2' if db_uri == 'DB_URI' else 'psycopg')
+        mdb = MentionsDatabase(Session(engine, autoflush=False, expire_on_commit=False))
+        requests_mock.get(re.compile(r'https://card\.wb\.ru/cards/detail'), json={'data': {'products': []}})
+        mdb.rebuild_mention_summaries()
+
+        chat_id = chat_test_objs[0].id
+        post_duplicate = Post(chat_id=chat_id, message_id='1')  # post with message_id 1 is already in db
+        post = Post(chat_id=str(chat_id), message_id='3', views_count=5, er=1.5, date=datetime.datetime(2012, 1, 1))
+        post_with_unknown_sku = Post(chat_id=chat_id, message_id='4')  # sku 60 has no valid wb brand
+        for sku_code in (10, 11):
+            post.sku_per_post.append(SkuPerPost(sku_code=sku_code))
+        post_duplicate.sku_per_post.append(SkuPerPost(sku_code=10))
+        post_with_unknown_sku.sku_per_post.append(SkuPerPost(sku_code=60))
+
+        parsed_posts = [post, post_duplicate, post_with_unknown_sku]
+        assert mdb.copy_posts_to_db(parsed_posts) == (1, 2)
+        mdb.session.commit()
+
+        # second load of the same posts doesn't add anything
+        assert mdb.copy_posts_to_db(parsed_posts) == (0, 0)
+        mdb.session.commit()
+
+        loaded_post = mdb.session.execute(
+            select(Post).where(Post.chat_id == chat_id, Post.message_id == '3')).scalars().one()
+        assert (loaded_post.views_count, loaded_post.er, loaded_post.date) == (5, 1.5, datetime.datetime(2012, 1, 1))
+        assert {mention.sku_code for mention in loaded_post.sku_per_post} == {10, 11}
+        assert mdb.session.execute(select(Post).where(Post.message_id == '4')).scalars().first() is None
+        assert mdb.get_sku_summary(11).mentions_count == 3
+        assert mdb.check_mention_summaries() == []
+
+    def test_load_skus(self, mentions_test_objs, mdb, requests_mock):
+        requests_mock.get(re.compile(r'https://card\.wb\.ru/cards/detail'), json={'data': {'products': [
+            {'id': 30, 'brand': 'brand_1', 'brandId': 1},  # brand is already present in db
+            {'id': 40, 'brand': 'brand_3', 'brandId': 3},
+            {'id': 50, 'brand': '', 'brandId': 0}
+        ]}})
+
+        post = Post(chat_id=1, message_id='3')
+        skus = {sku_code: Sku(sku_code=sku_code) for sku_code in (10, 30, 40, 50, 60)}
+        for sku in skus.values():
+            sku.sku_per_post.append(SkuPerPost(sku_code=sku.sku_code, post=post))
+
+        assert mdb.load_skus(skus) == 2
+        mdb.session.commit()
+
+        # mentions of skus without valid wb brand are removed from post
+        assert {mention.sku_code for mention in post.sku_per_post} == {10, 30, 40}
+        assert set(mdb.session.execute(select(Sku.sku_code)).scalars().all()) == {10, 11, 20, 30, 40}
+        assert set(mdb.session.execute(select(Brand.brand_id)).scalars().all()) == {1, 2, 3}
+
     def test_get_mentions_by_sku(self, mentions_test_objs, db_session):
 
         mdb = MentionsDatabase(db_session())
@@ -331,6 +525,15 @@ class TestMentionsDatabase:
 
         assert actual_mentions == expected_mentions
 
+    def test_get_mentions_by_sku_query_count(self, mentions_test_objs, db_session):
+        mdb = MentionsDatabase(db_session())
+        with count_queries(mdb.session) as statements:
+            mentions_dict = mdb.get_mentions_by_sku(10)
+            touch_mentions_dict(mentions_dict)
+
+        assert len(statements) == 1
+        assert sum(len(posts) for posts in mentions_dict.values()) == 3
+
     def test_get_mentions_by_brand(self, mentions_test_objs, db_session):
 
         mdb = MentionsDatabase(db_session())
@@ -355,6 +558,57 @@ class TestMentionsDatabase:
         actual_mentions = mdb.get_mentions_by_brand(brand)
         assert actual_mentions == {}
 
+    def test_async_mentions_database(self, mentions_test_objs, async_db_session, db_session):
+        mdb = MentionsDatabase(db_session())
+        mdb.rebuild_mention_summaries()
+
+        async def lookup():
+            async with async_db_session() as session:
+                amdb = AsyncMentionsDatabase(session)
+                return await amdb.get_sku_summary(10), await amdb.get_data_version()
+
+        sku_summary, data_version = asyncio.run(lookup())
+
+        assert sku_summary.mentions_count == mdb.get_sku_summary(10).mentions_count
+        assert data_version == mdb.get_data_version()
+
+    def test_async_mentions_pages(self, mentions_test_objs, async_db_session, db_session):
+        mdb = MentionsDatabase(db_session())
+        mdb.rebuild_mention_summaries()
+
+        async def get_pages():
+            async with async_db_session() as session:
+                amdb = AsyncMentionsDatabase(session)
+                first_page = await amdb.get_mentions_page_by_brand('brand_1', None, 2)
+                last_post = list(list(first_page.values())[-1].keys())[-1]
+                second_page = await amdb.get_mentions_page_by_brand('brand_1', get_post_key(last_post), 2)
+                return (first_page, second_page, await amdb.get_brand_totals('brand_1'),
+                        await amdb.get_brand_chat_mentions_counts('brand_1', {chat.id for chat in first_page}),
+                        await amdb.get_sku_chat_mentions_counts(10, {chat.id for chat in first_page}))
+
+        first_page, second_page, brand_totals, brand_chat_counts, sku_chat_counts = asyncio.run(get_pages())
+
+        def post_ids(mentions_dict):
+            return [post.id for posts in mentions_dict.values() for post in posts]
+
+        all_post_ids = post_ids(mdb.get_mentions_by_brand('brand_1'))
+        assert len(post_ids(first_page)) == 2
+        assert post_ids(first_page) + post_ids(second_page) == all_post_ids
+        # mentions of page posts are loaded completely
+        assert sum(len(mentions) for posts in first_page.values() for mentions in posts.values()) == 3
+        assert brand_totals == (5, 2)
+        assert sum(brand_chat_counts.values()) == 3
+        assert sum(sku_chat_counts.values()) == 2
+
+    def test_get_mentions_by_brand_query_count(self, mentions_test_objs, db_session):
+        mdb = MentionsDatabase(db_session())
+        with count_queries(mdb.session) as statements:
+            mentions_dict = mdb.get_mentions_by_brand('brand_1')
+            touch_mentions_dict(mentions_dict)
+
+        assert len(statements) == 1
+        assert sum(len(mentions) for posts in mentions_dict.values() for mentions in posts.values()) == 5
+
     def test_update_tg_chat(self, mdb, chat_test_objs):
 
         new_title = 'new_title'
@@ -396,3 +650,126 @@ class TestMentionsDatabase:
         updated_chat = mdb.session.execute(select(Chat).where(Chat.id == chat_to_update.id)).scalars().one_or_none()
         assert updated_chat.title != new_title
         assert updated_chat.title == last_name
+
+    def test_add_tg_chat_to_update(self, db_session, chat_test_objs):
+        mdb = MentionsDatabase(db_session(), chat_update_batch_size=2)
+
+        for i, chat_to_update in enumerate(chat_test_objs[:3]):
+            chat_to_update.recent_parsed_post_tg_id = i + 100
+            chat_to_update.update_required = True
+            mdb.add_tg_chat_to_update(chat_to_update)
+
+        # first two chats are flushed as soon as the buffer is full
+        assert list(mdb.tg_chats_to_update.values()) == [chat_test_objs[2]]
+        assert not chat_test_objs[0].update_required
+
+        mdb.flush_tg_chat_updates()
+        mdb.session.commit()
+        assert len(mdb.tg_chats_to_update) == 0
+
+        session = db_session()
+        for i, chat_to_update in enumerate(chat_test_objs[:3]):
+            updated_chat = session.execute(select(Chat).where(Chat.id == chat_to_update.id)).scalars().one()
+            assert updated_chat.recent_parsed_post_tg_id == i + 100
+            assert updated_chat.updated_at is not None
+
+    def test_rebuild_mention_summaries(self, mentions_test_objs, mdb):
+        assert len(mdb.check_mention_summaries()) != 0
+
+        mdb.rebuild_mention_summaries()
+
+        assert mdb.check_mention_summaries() == []
+        sku_summary = mdb.get_sku_summary(10)
+        assert (sku_summary.mentions_count, sku_summary.chats_count) == (3, 2)
+        assert sku_summary.first_mention_date == datetime.datetime(year=2010, month=5, day=19)
+        assert sku_summary.last_mention_date == datetime.datetime(year=2011, month=4, day=23)
+        brand_summaries = mdb.get_brand_summaries('brand_1')
+        assert [(summary.mentions_count, summary.chats_count) for summary in brand_summaries] == [(5, 2)]
+        assert mdb.get_sku_summary(1) is None
+
+    def test_check_chat_mention_summaries(self, mentions_test_objs, chat_test_objs, mdb):
+        mdb.rebuild_mention_summaries()
+        # counts are swapped between chats, so totals of sku stay consistent
+        mdb.session.get(SkuChatSummary, (10, chat_test_objs[0].id)).mentions_count = 1
+        mdb.session.get(SkuChatSummary, (10, chat_test_objs[1].id)).mentions_count = 2
+        mdb.session.flush()
+
+        inconsistencies = mdb.check_mention_summaries()
+
+        assert len(inconsistencies) == 2
+        assert all(inconsistency.startswith('sku_chat_summary sku_code=10') for inconsistency in inconsistencies)
+
+    def test_update_mention_summaries(self, mentions_test_objs, chat_test_objs, mdb, requests_mock):
+        requests_mock.get(re.compile(r'https://card\.wb\.ru/cards/detail'), json={'data': {'products': []}})
+        mdb.rebuild_mention_summaries()
+
+        date = datetime.datetime(year=2012, month=1, day=1)
+        posts = [Post(chat_id=chat_test_objs[0].id, message_id='3', date=date),
+                 Post(chat_id=chat_test_objs[2].id, message_id='1', date=date)]
+        skus = {20: Sku(sku_code=20)}
+        for post in posts:
+            skus[20].sku_per_post.append(SkuPerPost(sku_code=20, post=post))
+
+        mdb.upload_tg_posts_to_db(set(posts), skus)
+        mdb.session.commit()
+
+        assert mdb.check_mention_summaries() == []
+        sku_summary = mdb.get_sku_summary(20)
+        assert (sku_summary.mentions_count, sku_summary.chats_count) == (3, 3)
+        assert sku_summary.last_mention_date == date
+        chat_summary = mdb.session.get(SkuChatSummary, (20, chat_test_objs[0].id))
+        assert chat_summary.mentions_count == 1
+
+    def test_update_mention_summaries_sorts_upserts(self, mentions_test_objs, chat_test_objs, mdb, requests_mock,
+                                                    monkeypatch):
+        requests_mock.get(re.compile(r'https://card\.wb\.ru/cards/detail'), json={'data': {'products': []}})
+        mdb.rebuild_mention_summaries()
+        execute = mdb.session.execute
+        upserted_keys = []
+
+        def record_execute(statement, params=None, *args, **kwargs):
+            if isinstance(params, list) and getattr(statement, 'table', None) is not None:
+                key = 'sku_code' if 'sku_code' in params[0] else 'brand_id'
+                upserted_keys.append((statement.table.name, [(row[key], row.get('chat_id')) for row in params]))
+            return execute(statement, params, *args, **kwargs)
+
+        date = datetime.datetime(year=2012, month=1, day=1)
+        posts = [Post(chat_id=chat.id, message_id='5', date=date) for chat in reversed(chat_test_objs)]
+        skus = {20: Sku(sku_code=20), 11: Sku(sku_code=11)}
+        for post in posts:
+            for sku in skus.values():
+                sku.sku_per_post.append(SkuPerPost(sku_code=sku.sku_code, post=post))
+
+        monkeypatch.setattr(mdb.session, 'execute', record_execute)
+        mdb.upload_tg_posts_to_db(set(posts), skus)
+
+        summary_tables = {'sku_chat_summary', 'sku_summary', 'brand_chat_summary', 'brand_summary'}
+        upserts = [(table, keys) for table, keys in upserted_keys if table in summary_tables]
+        assert {table for table, _ in upserts} == summary_tables
+        for table, keys in upserts:
+            assert keys == sorted(keys, key=lambda row_key: (row_key[0], row_key[1] or 0)), table
+
+    def test_bump_data_version(self, mdb):
+        assert mdb.get_data_version() == 0
+        mdb.bump_data_version()
+        mdb.bump_data_version()
+        mdb.session.commit()
+        assert mdb.get_data_version() == 2
+
+    def test_publish_data_version(self, mentions_test_objs, chat_test_objs, mdb, requests_mock):
+        requests_mock.get(re.compile(r'https://card\.wb\.ru/cards/detail'), json={'data': {'products': []}})
+        mdb.publish_data_version()
+        assert mdb.get_data_version() == 0
+
+        for message_id in ('3', '4'):
+            post = Post(chat_id=chat_test_objs[0].id, message_id=message_id, date=datetime.datetime(2012, 1, 1))
+            sku = Sku(sku_code=20)
+            sku.sku_per_post.append(SkuPerPost(sku_code=20, post=post))
+            mdb.upload_tg_posts_to_db({post}, {20: sku})
+            mdb.commit()
+        # uploads don't touch data version, so cache of the bot isn't dropped per batch
+        assert mdb.get_data_version() == 0
+
+        mdb.publish_data_version()
+        mdb.publish_data_version()
+        assert mdb.get_data_version() == 1
@@ -0,0 +1,90 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from src.dao.request_logger import RequestLogger
+from src.dao.users_db import User, Request, RequestTypesEnum, RequestPlatformsEnum
+from tests.conftest import *
+
+
+def get_request(user_id: str, created_at: datetime) -> Request:
+    return Request(user_id=user_id, request_type=RequestTypesEnum.sku, request_platform=RequestPlatformsEnum.telegram,
+                   request='123456', created_at=created_at)
+
+
+class TestRequestLogger:
+
+    def test_flush(self, async_db_session, db_session):
+        add_test_objs_to_db(db_session, [User(user_id='1'), User(user_id='2'), User(user_id='3')])
+        now = datetime.now()
+        request_logger = RequestLogger(async_db_session, batch_size=100)
+
+        async def log_requests():
+            request_logger.log_request(get_request('1', now))
+            request_logger.log_request(get_request('1', now + timedelta(seconds=1)))
+            request_logger.log_request(get_request('2', now))
+            # nothing is written until flush
+            async with async_db_session() as session:
+                assert (await session.execute(select(Request))).scalars().all() == []
+            await request_logger.close()
+
+        asyncio.run(log_requests())
+
+        session = db_session()
+        assert len(session.execute(select(Request)).scalars().all()) == 3
+        last_interactions = dict(session.execute(select(User.user_id, User.last_interaction_date)).all())
+        assert last_interactions == {'1': now + timedelta(seconds=1), '2': now, '3': None}
+        assert request_logger.requests == [] and request_logger.last_interactions == {}
+
+    def test_batch_size_triggers_flush(self, async_db_session, db_session):
+        add_test_objs_to_db(db_session, [User(user_id='1')])
+        request_logger = RequestLogger(async_db_session, flush_interval=3600, batch_size=2)
+
+        async def log_requests():
+            request_logger.start()
+            request_logger.log_request(get_request('1', datetime.now()))
+            request_logger.log_request(get_request('1', datetime.now()))
+            flush_task = request_logger.flush_task
+            # requests logged while flush is pending don't spawn another one
+            request_logger.log_request(get_request('1', datetime.now()))
+            assert request_logger.flush_task is flush_task
+            await flush_task
+            async with async_db_session() as session:
+                requests_count = len((await session.execute(select(Request))).scalars().all())
+            await request_logger.close()
+            return requests_count
+
+        assert asyncio.run(log_requests()) == 3
+
+    def test_failed_flush_is_retried(self):
+        @asynccontextmanager
+        async def broken_session_factory():
+            raise ConnectionError('db is down')
+            yield
+
+        now = datetime.now()
+        request_logger = RequestLogger(broken_session_factory)
+        request_logger.log_request(get_request('1', now))
+
+        asyncio.run(request_logger.flush())
+        request_logger.log_request(get_request('1', now - timedelta(seconds=1)))
+
+        assert len(request_logger.requests) == 2
+        assert request_logger.last_interactions == {'1': now}
+
+    def test_failed_flush_backlog_is_limited(self):
+        @asynccontextmanager
+        async def broken_session_factory():
+            raise ConnectionError('db is down')
+            yield
+
+        now = datetime.now()
+        request_logger = RequestLogger(broken_session_factory, max_backlog=3)
+        requests = [get_request('1', now + timedelta(seconds=i)) for i in range(5)]
+        for request in requests:
+            request_logger.log_request(request)
+
+        asyncio.run(request_logger.flush())
+
+        # the oldest requests are dropped
+        assert request_logger.requests == requests[2:]
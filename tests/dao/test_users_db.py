@@ -1,7 +1,8 @@
+import asyncio
 import time
 from datetime import datetime
 from sqlalchemy import select
-from src.dao.users_db import User, UserDatabase, Request, RequestTypesEnum, RequestPlatformsEnum
+from src.dao.users_db import User, UserDatabase, Request, RequestTypesEnum, RequestPlatformsEnum, AsyncUserDatabase
 from tests.conftest import *
 
 
@@ -70,3 +71,39 @@ class TestUserDatabase:
         time_after_update = datetime.now()
 
         assert time_before_update < updated_last_interaction < time_after_update
+
+
+class TestAsyncUserDatabase:
+
+    def test_check_user(self, async_db_session, db_session):
+        async def check_user_twice():
+            async with async_db_session() as session:
+                udb = AsyncUserDatabase(session)
+                await udb.check_user(User(user_id='123456', username='some_username'))
+                await udb.check_user(User(user_id='123456', username='some_username'))
+
+        asyncio.run(check_user_twice())
+
+        users_from_db = db_session().execute(select(User)).scalars().all()
+        assert len(users_from_db) == 1
+        assert users_from_db[0].user_id == '123456'
+
+    def test_get_user_ids(self, users_test_objs, async_db_session):
+        async def get_user_ids():
+            async with async_db_session() as session:
+                return await AsyncUserDatabase(session).get_user_ids()
+
+        assert asyncio.run(get_user_ids()) == [user.user_id for user in users_test_objs]
+
+    def test_broadcast_deliveries(self, users_test_objs, async_db_session):
+        delivery = {'broadcast': 'test', 'user_id': users_test_objs[0].user_id, 'delivered': True, 'error': None,
+                    'created_at': datetime.now()}
+
+        async def add_deliveries_twice():
+            async with async_db_session() as session:
+                udb = AsyncUserDatabase(session)
+                await udb.add_broadcast_deliveries([delivery])
+                await udb.add_broadcast_deliveries([delivery])
+                return await udb.get_broadcast_user_ids('test'), await udb.get_broadcast_user_ids('other')
+
+        assert asyncio.run(add_deliveries_twice()) == ({users_test_objs[0].user_id}, set())
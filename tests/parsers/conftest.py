@@ -1,6 +1,6 @@
 from sqlalchemy import select
 from sqlalchemy.orm import Session
-from src.dao.mentions_db import Chat, ChatContentType, Proxy, Post
+from src.dao.mentions_db import Chat, ChatContentType, Proxy, Post, PostRecord
 from tests.conftest import *
 
 """
@@ -33,19 +33,16 @@ expected_parsed_links = {
 }
 
 
-def get_skus_from_post(post: Post) -> set[int]:
+def get_skus_from_post(post: Post | PostRecord) -> set[int]:
     """
     Collects skus from post entity
-    :param post: db post entity
+    :param post: db post entity or post record of parser
     :return: set of skus
     """
-    skus = set()
-    for sku_per_post in post.sku_per_post:
-        skus.add(sku_per_post.sku.sku_code)
-    return skus
+    return set(post.sku_codes)
 
 
-def assert_parser_posts_result(parsed_posts: list[Post]) -> None:
+def assert_parser_posts_result(parsed_posts: list[Post] | set[PostRecord]) -> None:
     """
     iterates through the parsed posts and compares them with the expected_post_dict
     :param parsed_posts: list of posts from database
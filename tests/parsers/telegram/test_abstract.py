@@ -1,6 +1,19 @@
+import asyncio
 import datetime
+import time
+from types import SimpleNamespace
+from telethon.errors import FloodWaitError
 from telethon.tl.patched import Message
+from src.dao.mentions_db import Chat
+from src.parsers.telegram import abstract
 from src.parsers.telegram.abstract import AbstractTgChatParser
+from src.parsers.telegram.utils import FloodWaitScheduler
+
+
+def get_flood_wait_error(seconds: float) -> FloodWaitError:
+    error = FloodWaitError(request=None, capture=1)
+    error.seconds = seconds
+    return error
 
 
 class TestAbstractTgChatParser:
@@ -8,8 +21,229 @@ class TestAbstractTgChatParser:
     def test_parse_message(self):
         AbstractTgChatParser.__abstractmethods__ = set()
         parser = AbstractTgChatParser(0, [], datetime.datetime.now())
-        res = parser.parse_message(Message(0))
+        res = asyncio.run(parser.parse_message(Message(0)))
         assert res is None
 
         res = parser.get_parser_results()
         assert res is None
+
+    def test_joined_chats_are_scanned_during_flood_wait(self, monkeypatch):
+        AbstractTgChatParser.__abstractmethods__ = set()
+        parser = AbstractTgChatParser(0, [], datetime.datetime.now())
+        events = []
+
+        async def scan_messages(chat, start_date):
+            events.append(f'scan {chat.id}')
+
+        async def send_join_requests(client, tg_chats, session_id, scheduler):
+            for tg_chat in tg_chats:
+                attempts = []
+
+                async def join():
+                    attempts.append(1)
+                    if len(attempts) == 1:
+                        raise get_flood_wait_error(0.05)
+                    events.append(f'join {tg_chat.id}')
+                    return SimpleNamespace(id=tg_chat.id, title=str(tg_chat.id))
+
+                chat = await scheduler.request('join', join)
+                tg_chat.tg_id = str(chat.id)
+                yield tg_chat, chat
+
+        monkeypatch.setattr(parser, 'scan_messages', scan_messages)
+        monkeypatch.setattr(abstract, 'send_join_requests', send_join_requests)
+
+        async def process():
+            chats_to_scan = asyncio.Queue()
+            chats_to_scan.put_nowait(SimpleNamespace(id=1, title='1'))
+            chats_to_scan.put_nowait(SimpleNamespace(id=2, title='2'))
+            joining = asyncio.create_task(parser.join_chats([tg_chat_to_join], chats_to_scan))
+            await parser.process_chats(chats_to_scan)
+            await joining
+
+        tg_chat_to_join = SimpleNamespace(id=3, tg_id=None)
+        asyncio.run(process())
+
+        # already joined chats are scanned while join is parked, the parked join is resumed without recursion
+        assert events == ['scan 1', 'scan 2', 'join 3', 'scan 3']
+        assert parser.processed_chats_id == {1, 2, 3}
+        # joined chat is indexed by its tg_id
+        assert parser.get_tg_chat_by_tg_id(3) is tg_chat_to_join
+
+
+    def test_chats_are_scanned_concurrently(self, monkeypatch):
+        AbstractTgChatParser.__abstractmethods__ = set()
+        parser = AbstractTgChatParser(0, [], datetime.datetime.now())
+        parser.scan_concurrency = 2
+        scanning = []
+        max_scanning = []
+
+        async def scan_messages(chat, start_date):
+            scanning.append(chat.id)
+            max_scanning.append(len(scanning))
+            await asyncio.sleep(0.01)
+            scanning.remove(chat.id)
+            if chat.id == 3:
+                raise ConnectionError('chat is not available')
+            parser.total_message_counter += 1
+
+        monkeypatch.setattr(parser, 'scan_messages', scan_messages)
+
+        async def process():
+            chats_to_scan = asyncio.Queue()
+            for chat_id in [1, 2, 3, 2, 4, 5]:
+                chats_to_scan.put_nowait(SimpleNamespace(id=chat_id, title=str(chat_id)))
+            chats_to_scan.put_nowait(None)
+            await parser.process_chats(chats_to_scan)
+
+        asyncio.run(process())
+
+        assert max(max_scanning) == 2
+        # duplicated chat is scanned once, failed chat is not processed and doesn't stop other scans
+        assert parser.processed_chats_id == {1, 2, 4, 5}
+        assert parser.total_message_counter == 4
+
+    def test_results_are_put_per_chat(self, monkeypatch):
+        AbstractTgChatParser.__abstractmethods__ = set()
+        results_queue = asyncio.Queue(maxsize=1)
+        parser = AbstractTgChatParser(0, [], datetime.datetime.now(), results_queue)
+        parser.scan_concurrency = 2
+        scanned = []
+
+        async def scan_messages(chat, start_date):
+            parser.parsed_items.add(chat.id)
+            scanned.append(chat.id)
+
+        monkeypatch.setattr(parser, 'scan_messages', scan_messages)
+        monkeypatch.setattr(parser, 'get_parser_results', lambda: set(parser.parsed_items))
+
+        async def process():
+            chats_to_scan = asyncio.Queue()
+            for chat_id in [1, 2, 3]:
+                chats_to_scan.put_nowait(SimpleNamespace(id=chat_id, title=str(chat_id)))
+            chats_to_scan.put_nowait(None)
+            processing = asyncio.create_task(parser.process_chats(chats_to_scan))
+            await asyncio.sleep(0.01)
+            # the queue is full, so scans wait for the writer
+            blocked = not processing.done()
+            results = [await results_queue.get() for _ in range(3)]
+            await processing
+            return blocked, results
+
+        blocked, results = asyncio.run(process())
+
+        assert blocked
+        assert results == [{1}, {2}, {3}]
+        assert parser.parsed_items == set()
+
+    def test_scan_is_resumed_after_flood_wait(self):
+        AbstractTgChatParser.__abstractmethods__ = set()
+        parser = AbstractTgChatParser(0, [], datetime.datetime.now())
+        chat = SimpleNamespace(id=1, title='1')
+        calls = []
+
+        async def iter_messages(chat_, reverse, offset_date=None, offset_id=0):
+            calls.append(offset_id)
+            for message_id in range(offset_id + 1, 5):
+                if message_id == 3 and len(calls) == 1:
+                    raise get_flood_wait_error(0.01)
+                yield SimpleNamespace(id=message_id, message=str(message_id),
+                                      date=datetime.datetime.now())
+
+        async def parse_message(message):
+            return {message.message}
+
+        parser.client = SimpleNamespace(iter_messages=iter_messages)
+        parser.parse_message = parse_message
+
+        asyncio.run(parser.scan_messages(chat, parser.start_date))
+
+        assert calls == [0, 2]
+        assert parser.parsed_items == {'1', '2', '3', '4'}
+        assert parser.total_message_counter == 4
+
+    def test_scan_starts_from_checkpoint(self):
+        AbstractTgChatParser.__abstractmethods__ = set()
+        tg_chats = [Chat(tg_id='1', recent_parsed_post_tg_id=10), Chat(tg_id='2')]
+        parser = AbstractTgChatParser(0, tg_chats, datetime.datetime.now())
+        chats = [SimpleNamespace(id=1, title='1'), SimpleNamespace(id=2, title='2')]
+        for tg_chat in tg_chats:
+            parser.index_tg_chat(tg_chat)
+        calls = []
+
+        async def iter_messages(chat_, reverse, offset_date=None, offset_id=0):
+            calls.append((chat_.id, offset_date, offset_id))
+            first_message_id = offset_id + 1 if offset_date is None else 5
+            for message_id in range(first_message_id, 13):
+                yield SimpleNamespace(id=message_id, message=str(message_id), date=datetime.datetime.now())
+
+        async def parse_message(message):
+            return set()
+
+        parser.client = SimpleNamespace(iter_messages=iter_messages)
+        parser.parse_message = parse_message
+
+        async def scan():
+            for chat in chats:
+                await parser.scan_messages(chat, parser.start_date)
+
+        asyncio.run(scan())
+
+        # chat with checkpoint is scanned from it, chat without checkpoint from start_date
+        assert calls == [(1, None, 10), (2, parser.start_date, 0)]
+        assert parser.total_message_counter == 2 + 8
+        assert [tg_chat.recent_parsed_post_tg_id for tg_chat in tg_chats] == [12, 12]
+        assert all(tg_chat.update_required for tg_chat in tg_chats)
+        assert parser.get_tg_chats_to_update() == tg_chats
+
+    def test_fill_chats_indexes_joined_chats(self):
+        AbstractTgChatParser.__abstractmethods__ = set()
+        tg_chats = [Chat(tg_id='1', link='t.me/1'), Chat(link='t.me/2'), Chat(tg_id='1', link='t.me/3')]
+        parser = AbstractTgChatParser(0, tg_chats, datetime.datetime.now())
+
+        async def get_entity(tg_chat_ids):
+            return [SimpleNamespace(id=tg_chat_id) for tg_chat_id in tg_chat_ids]
+
+        async def iter_dialogs():
+            return
+            yield
+
+        parser.client = SimpleNamespace(get_entity=get_entity, iter_dialogs=iter_dialogs)
+
+        tg_chats_to_join = asyncio.run(parser.fill_chats(asyncio.Queue()))
+
+        assert tg_chats_to_join == [tg_chats[1]]
+        # the first of chats with the same tg_id is kept
+        assert parser.tg_chats_by_tg_id == {1: tg_chats[0]}
+        assert parser.get_tg_chat_by_tg_id(1) is tg_chats[0]
+        assert parser.get_tg_chat_by_tg_id(2) is None
+
+
+class TestFloodWaitScheduler:
+
+    def test_only_flooded_kind_is_parked(self):
+        scheduler = FloodWaitScheduler()
+        attempts = []
+
+        async def flooded_request():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise get_flood_wait_error(0.1)
+            return 'joined'
+
+        async def other_request():
+            return 'scanned', time.monotonic()
+
+        async def run_requests():
+            joining = asyncio.create_task(scheduler.request('join', flooded_request))
+            await asyncio.sleep(0.01)
+            scanned = await scheduler.request('scan', other_request)
+            return await joining, scanned
+
+        joined, (scanned, scanned_at) = asyncio.run(run_requests())
+
+        assert joined == 'joined' and scanned == 'scanned'
+        assert len(attempts) == 2
+        assert attempts[1] - attempts[0] >= 0.1
+        # request of other kind was not parked
+        assert scanned_at < attempts[1]
@@ -1,6 +1,10 @@
+import asyncio
+import time
 from datetime import datetime
+from types import SimpleNamespace
 from config import *
 from src.dao.mentions_db import Chat
+from src.parsers.telegram import chat as chat_parser
 from src.parsers.telegram.chat import TgChatAdChatParser
 from tests.parsers.conftest import expected_parsed_links
 
@@ -33,6 +37,66 @@ class TestTgChatAdChatParser:
                 assert chat.title == 'TestChannel'
 
 
+    def test_slow_link_does_not_block_other_sessions(self, monkeypatch):
+        def get_chat_info_by_link(link):
+            if link == 't.me/slow':
+                time.sleep(0.3)
+            return link, '1'
+
+        monkeypatch.setattr(chat_parser, 'get_chat_info_by_link', get_chat_info_by_link)
+        parsed_messages = []
+
+        async def parse_messages(parser, texts):
+            for text in texts:
+                message = SimpleNamespace(id=1, message=text, get_entities_text=lambda entity_type: [])
+                await parser.parse_message(message)
+                parsed_messages.append(text)
+
+        async def run_sessions():
+            slow_parser = TgChatAdChatParser(1, [], datetime.now())
+            fast_parser = TgChatAdChatParser(2, [], datetime.now())
+            await asyncio.gather(parse_messages(slow_parser, ['t.me/slow']),
+                                 parse_messages(fast_parser, ['t.me/fast_1', 't.me/fast_2']))
+
+        asyncio.run(run_sessions())
+
+        # link of the first session is resolved in a thread, so the second session parses meanwhile
+        assert parsed_messages == ['t.me/fast_1', 't.me/fast_2', 't.me/slow']
+
+
+    def test_scans_overlap_while_links_are_resolved(self, monkeypatch):
+        resolutions = []
+
+        def get_chat_info_by_link(link):
+            started_at = time.monotonic()
+            time.sleep(0.2)
+            resolutions.append((started_at, time.monotonic()))
+            return link, '1'
+
+        async def iter_messages(chat, reverse, offset_date=None, offset_id=0):
+            yield SimpleNamespace(id=1, message=f't.me/link_{chat.id}', date=datetime.now(),
+                                  get_entities_text=lambda entity_type: [])
+
+        monkeypatch.setattr(chat_parser, 'get_chat_info_by_link', get_chat_info_by_link)
+        parser = TgChatAdChatParser(1, [], datetime.now())
+        parser.scan_concurrency = 2
+        parser.client = SimpleNamespace(iter_messages=iter_messages)
+
+        async def process():
+            chats_to_scan = asyncio.Queue()
+            for chat_id in [1, 2]:
+                chats_to_scan.put_nowait(SimpleNamespace(id=chat_id, title=str(chat_id)))
+            chats_to_scan.put_nowait(None)
+            await parser.process_chats(chats_to_scan)
+
+        asyncio.run(process())
+
+        assert {tg_chat.link for tg_chat in parser.parsed_items} == {'t.me/link_1', 't.me/link_2'}
+        # link of the second chat is resolved while link of the first one is still being resolved
+        (_, first_end), (second_start, _) = sorted(resolutions)
+        assert second_start < first_end
+
+
 class TestTgChatAdChatParserResult:
 
     def test_merge_with(self):
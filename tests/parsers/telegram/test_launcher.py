@@ -1,4 +1,5 @@
 import asyncio
+import threading
 from tests.parsers.conftest import assert_parser_posts_result
 from freezegun import freeze_time
 
@@ -20,3 +21,71 @@ def test_launch_parser(chats_test_objs, proxy_test_obj, db_session):
     session = db_session()
     loaded_posts = session.query(Post).all()
     assert_parser_posts_result(loaded_posts)
+
+
+def test_run_parser_isolates_errors():
+    """
+    testing that error of one session doesn't stop parsers of other sessions in the same event loop
+    """
+    from src.parsers.telegram.launcher import ParserLauncher
+
+    class FakeParser:
+        def __init__(self, session_id: int, error: Exception | None):
+            self.session_id = session_id
+            self.error = error
+            self.done = False
+
+        async def parse(self, anon_path, api_id, api_hash, proxy_config):
+            await asyncio.sleep(0.01 * self.session_id)
+            if self.error is not None:
+                raise self.error
+            self.done = True
+
+        async def put_parser_results(self):
+            self.results_put = True
+
+    parsers = [FakeParser(1, ConnectionError('session is broken')), FakeParser(2, None), FakeParser(3, None)]
+
+    async def run_parsers():
+        await asyncio.gather(*[ParserLauncher.run_parser(parser, '', 0, '', None) for parser in parsers])
+
+    asyncio.run(run_parsers())
+    assert [parser.done for parser in parsers] == [False, True, True]
+    # results parsed before the error are uploaded too
+    assert all(parser.results_put for parser in parsers)
+
+
+def test_upload_results_retries_failed_upload():
+    """
+    testing that result which failed to upload is uploaded together with the next one
+    """
+    from types import SimpleNamespace
+    from src.parsers.telegram.chat import TgChatAdChatParser
+    from src.parsers.telegram.launcher import ParserLauncher
+    from src.dao.mentions_db import Chat
+
+    launcher = ParserLauncher.__new__(ParserLauncher)
+    rollbacks = []
+    launcher.database = SimpleNamespace(rollback=lambda: rollbacks.append(1))
+    uploads = []
+    loop_threads = []
+
+    def upload(parser_results):
+        loop_threads.append(threading.current_thread() is threading.main_thread())
+        uploads.append({tg_chat.link for tg_chat in parser_results.parsed_tg_chats})
+        if len(uploads) == 1:
+            raise ConnectionError('db is down')
+
+    async def upload_results():
+        results_queue = asyncio.Queue(maxsize=1)
+        writer = asyncio.create_task(launcher.upload_results(results_queue, upload))
+        for links in [{'t.me/1', 't.me/2'}, {'t.me/2', 't.me/3'}]:
+            await results_queue.put(TgChatAdChatParser.Result([], {Chat(link=link) for link in links}))
+        await results_queue.put(None)
+        return await writer
+
+    assert asyncio.run(upload_results()) == 3
+    assert uploads == [{'t.me/1', 't.me/2'}, {'t.me/1', 't.me/2', 't.me/3'}]
+    assert rollbacks == [1]
+    # uploads don't block event loop of telegram sessions
+    assert loop_threads == [False, False]
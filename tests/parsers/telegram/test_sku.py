@@ -1,6 +1,6 @@
 from datetime import datetime
 from config import *
-from src.dao.mentions_db import Chat, Post, Sku
+from src.dao.mentions_db import Chat, PostRecord
 from tests.parsers.conftest import assert_parser_posts_result, expected_parsed_links
 
 
@@ -34,15 +34,32 @@ class TestTgWbItemsAdChatParser:
         parser.launch(session_file_path, API_IDS[session_id], API_HASHES[session_id], None)
         assert parser.get_parser_results().get_parsed_items_count() == 0
 
+    def test_chat_lookups(self):
+        from src.parsers.telegram.sku import TgWbItemsAdChatParser
+        chats = [Chat(obj_id=1, tg_id='10', followers=3), Chat(obj_id=2, link='t.me/2', followers=5)]
+        parser = TgWbItemsAdChatParser(1, chats, datetime.now())
+        for chat in chats:
+            parser.index_tg_chat(chat)
+
+        assert (parser.get_chat_id_by_tg_chat_id(10), parser.get_followers_by_chat_id(10)) == (1, 3)
+        # chat that is not joined yet is not found
+        assert parser.get_chat_id_by_tg_chat_id(20) is None
+
+        chats[1].tg_id = '20'
+        parser.index_tg_chat(chats[1])
+        assert (parser.get_chat_id_by_tg_chat_id(20), parser.get_followers_by_chat_id(20)) == (2, 5)
+
 
 class TestTgWbItemsAdChatParserResult:
 
     def test_merge_with(self):
         from src.parsers.telegram.sku import TgWbItemsAdChatParser
         chats = [Chat(tg_id='1'), Chat(tg_id='2')]
-        posts = [Post(chat_id='1', message_id=1), Post(chat_id='1', message_id=2)]
-        res_1 = TgWbItemsAdChatParser.Result([], {chats[0]}, {posts[0]}, {1: Sku(sku_code=1)})
-        res_2 = TgWbItemsAdChatParser.Result([], {chats[1]}, {posts[1]}, {2: Sku(sku_code=2)})
+        posts = [PostRecord(chat_id=1, message_id='1', sku_codes=frozenset({1})),
+                 PostRecord(chat_id=1, message_id='2', sku_codes=frozenset({2}))]
+        res_1 = TgWbItemsAdChatParser.Result([], {chats[0]}, {posts[0]}, {1})
+        res_2 = TgWbItemsAdChatParser.Result([], {chats[1]}, {posts[1]}, {2})
         res_1.merge_with(res_2)
 
         assert res_1.get_parsed_items_count() == len(posts)
+        assert res_1.parsed_posts == set(posts)
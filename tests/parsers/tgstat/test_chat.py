@@ -1,6 +1,8 @@
 import os
 from datetime import datetime
 from pathlib import Path
+from types import SimpleNamespace
+import pytest
 from freezegun import freeze_time
 from sqlalchemy import select
 from src.dao.mentions_db import ChatContentType, Chat, MentionsDatabase
@@ -39,3 +41,26 @@ class TestChannelParser:
         updated_chat = session.execute(select(Chat).where(Chat.link == 't.me/testingpublicchannel')).scalar()
 
         assert updated_chat.recent_parsed_post_tg_id == 8
+        # data version is bumped once at the end of the run
+        assert database.get_data_version() == 1
+
+    def test_failed_chat_publishes_data_version(self, requests_mock, monkeypatch):
+        requests_mock.get('https://tgstat.ru', content=b'', headers={'Set-Cookie': ''})
+        calls = []
+        database = SimpleNamespace(rollback=lambda: calls.append('rollback'),
+                                   publish_data_version=lambda: calls.append('publish'))
+        cp = ChannelParser(start_date=datetime.min, database=database, proxy=None)
+        monkeypatch.setattr(cp.session, 'close', lambda: calls.append('close'))
+
+        def process_chat(chat):
+            if chat.link == 't.me/broken':
+                raise ConnectionError('tgstat is not available')
+            calls.append(f'process {chat.link}')
+
+        monkeypatch.setattr(cp, 'process_chat', process_chat)
+
+        with pytest.raises(ConnectionError):
+            cp.process_chats([Chat(link='t.me/chat'), Chat(link='t.me/broken'), Chat(link='t.me/other')])
+
+        # mentions of the chat that was loaded before the error are published, http session is closed
+        assert calls == ['process t.me/chat', 'rollback', 'publish', 'close']